@@ -1,7 +1,7 @@
 #![cfg_attr(windows, windows_subsystem = "windows")]
 use anyhow::{anyhow, Context, Result};
 use directories::BaseDirs;
-use rust_socketio::asynchronous::ClientBuilder;
+use rust_socketio::asynchronous::{Client, ClientBuilder};
 use rust_socketio::Payload;
 use serde::{Deserialize, Serialize};
 use serde_json::json;
@@ -9,8 +9,9 @@ use std::env;
 use std::fs;
 use std::path::{Path, PathBuf};
 use std::process::Stdio;
+use std::sync::atomic::{AtomicBool, AtomicU64, AtomicUsize, Ordering};
 use std::sync::Arc;
-use tokio::io::{AsyncBufReadExt, AsyncWriteExt, BufReader};
+use tokio::io::{AsyncBufReadExt, AsyncReadExt, AsyncSeekExt, AsyncWriteExt, BufReader};
 use tokio::process::{ChildStderr, ChildStdin, ChildStdout, Command};
 use tokio::sync::{mpsc, Mutex};
 use tokio::time::{sleep, Duration};
@@ -22,7 +23,10 @@ use screenshots::Screen;
 use std::io::Cursor;
 use base64::{engine::general_purpose, Engine as _};
 use sysinfo::System;
-use image::{imageops::FilterType, GenericImageView};
+use sha2::{Digest, Sha256};
+use flate2::{write::ZlibEncoder, Compression};
+use std::io::Write as _;
+use image::imageops::FilterType;
 // CommandExt moved to inline usage to avoid unused warning
 #[cfg(windows)]
 const CREATE_NO_WINDOW: u32 = 0x08000000;
@@ -32,6 +36,17 @@ const CONFIG_FILE: &str = "config.json";
 const UUID_FILE: &str = "client_id.txt";
 const DEFAULT_SERVER_URL: &str = "http://rcc.175852.xyz:36251";
 const SENTINEL_PREFIX: &str = "__RC_END__:";
+const DEFAULT_DOWNLOAD_CHUNK_SIZE: usize = 256 * 1024;
+const MAX_DOWNLOAD_CHUNK_SIZE: usize = 8 * 1024 * 1024;
+const DOWNLOAD_ACK_WINDOW: usize = 8; // 分块下载最多未确认的块数
+const DOWNLOAD_ACK_TIMEOUT: Duration = Duration::from_secs(30);
+const DOWNLOAD_CHUNK_RETRIES: u32 = 5; // 分块被拒绝或确认超时后连续重发的次数上限
+const STREAM_CHUNK_BYTES: usize = 16 * 1024;
+const STREAM_FLUSH_INTERVAL: Duration = Duration::from_millis(100);
+const SCREEN_MAX_EDGE: u32 = 1200; // 截图/画面推送的最大边长
+const SCREEN_TILE_SIZE: u32 = 64;
+const SCREEN_MAX_FPS: u32 = 30;
+const SCREEN_KEYFRAME_INTERVAL: Duration = Duration::from_secs(30);
 
 fn extract_first_json(payload: Payload) -> Option<serde_json::Value> {
     match payload {
@@ -42,10 +57,40 @@ fn extract_first_json(payload: Payload) -> Option<serde_json::Value> {
     }
 }
 
+// 服务端准入控制拒绝握手时，连接错误 {"message", "data": {"retry_after": 秒}} 中给出建议的重连等待时间；
+// rust_socketio 把 CONNECT_ERROR 作为 "error" 事件的文本（前缀说明 + JSON）交给回调
+fn extract_retry_after(payload: &Payload) -> Option<f64> {
+    let text = match payload {
+        rust_socketio::Payload::Text(values) => match values.get(0)? {
+            serde_json::Value::String(s) => s.clone(),
+            other => other.to_string(),
+        },
+        #[allow(deprecated)]
+        rust_socketio::Payload::String(s) => s.clone(),
+        _ => return None,
+    };
+    let val: serde_json::Value = serde_json::from_str(&text[text.find('{')?..]).ok()?;
+    val.pointer("/data/retry_after").and_then(|x| x.as_f64()).filter(|x| *x > 0.0)
+}
+
+// 0..max_ms 的随机抖动：服务端重启后大量客户端不在同一时刻重连
+fn jitter_ms(max_ms: u64) -> u64 {
+    (Uuid::new_v4().as_u128() % (max_ms as u128 + 1)) as u64
+}
+
+fn extract_binary(payload: Payload) -> Option<Vec<u8>> {
+    match payload {
+        rust_socketio::Payload::Binary(bytes) => Some(bytes.to_vec()),
+        _ => None,
+    }
+}
+
 #[derive(Debug, Clone, Serialize, Deserialize)]
 struct ClientConfig {
     server_url: String,
     shell: Option<String>,
+    #[serde(default)]
+    tags: Vec<String>, // 服务端批量执行按标签选择目标
 }
 
 async fn file_operation(op: &str, path: Option<String>, file_data: Option<String>) -> Result<serde_json::Value> {
@@ -55,11 +100,7 @@ async fn file_operation(op: &str, path: Option<String>, file_data: Option<String
             let mut entries = Vec::new();
             let mut read_dir = tokio::fs::read_dir(&p).await?;
             while let Some(entry) = read_dir.next_entry().await? {
-                let file_type = entry.file_type().await?;
-                entries.push(json!({
-                    "name": entry.file_name().to_string_lossy(),
-                    "is_dir": file_type.is_dir(),
-                }));
+                entries.push(dir_entry_json(&entry).await?);
             }
             Ok(json!(entries))
         }
@@ -92,6 +133,49 @@ async fn file_operation(op: &str, path: Option<String>, file_data: Option<String
     }
 }
 
+// 目录条目：名称、是否目录、大小（字节）、修改时间（Unix 秒）；读取元数据失败时大小与时间为 null
+async fn dir_entry_json(entry: &tokio::fs::DirEntry) -> Result<serde_json::Value> {
+    let file_type = entry.file_type().await?;
+    let meta = entry.metadata().await.ok();
+    let size = meta.as_ref().filter(|m| m.is_file()).map(|m| m.len());
+    let modified = meta
+        .and_then(|m| m.modified().ok())
+        .and_then(|t| t.duration_since(std::time::UNIX_EPOCH).ok())
+        .map(|d| d.as_secs());
+    Ok(json!({
+        "name": entry.file_name().to_string_lossy(),
+        "is_dir": file_type.is_dir(),
+        "size": size,
+        "modified": modified,
+    }))
+}
+
+// 分批列出目录：每读满 chunk_size 个条目发送一次 list_dir_chunk，最后一批带 eof；
+// 读取出错时发送带 error 的 eof 批次（已发送的条目保留）
+async fn stream_list_dir(socket: &Client, uuid: &str, request_id: &serde_json::Value, path: Option<String>, chunk_size: usize, compression: usize) {
+    let p = PathBuf::from(path.unwrap_or_else(|| ".".to_string()));
+    let mut seq: u64 = 0;
+    let mut batch = Vec::with_capacity(chunk_size);
+    let result: Result<()> = async {
+        let mut read_dir = tokio::fs::read_dir(&p).await?;
+        while let Some(entry) = read_dir.next_entry().await? {
+            batch.push(dir_entry_json(&entry).await?);
+            if batch.len() >= chunk_size {
+                let entries = std::mem::replace(&mut batch, Vec::with_capacity(chunk_size));
+                let msg = json!({"uuid": uuid, "request_id": request_id, "seq": seq, "entries": entries, "eof": false});
+                emit_maybe_compressed(socket, "list_dir_chunk", msg, &["entries"], compression).await;
+                seq += 1;
+            }
+        }
+        Ok(())
+    }.await;
+    let mut msg = json!({"uuid": uuid, "request_id": request_id, "seq": seq, "entries": batch, "eof": true});
+    if let Err(e) = result {
+        msg["error"] = json!(e.to_string());
+    }
+    emit_maybe_compressed(socket, "list_dir_chunk", msg, &["entries"], compression).await;
+}
+
 async fn upload_file_to_path(path: &Path, file_base64: &str) -> Result<()> {
     let bytes = general_purpose::STANDARD
         .decode(file_base64.as_bytes())
@@ -101,48 +185,297 @@ async fn upload_file_to_path(path: &Path, file_base64: &str) -> Result<()> {
     Ok(())
 }
 
-async fn download_file_as_base64(path: &Path) -> Result<String> {
-    let data = tokio::fs::read(path).await?;
-    Ok(general_purpose::STANDARD.encode(data))
+
+// 二进制分块帧：[4字节大端头长度][JSON头][原始数据]，与服务端 _unpack_binary_frame 对应
+fn pack_binary_frame(header: &serde_json::Value, data: &[u8]) -> Vec<u8> {
+    let header_bytes = header.to_string().into_bytes();
+    let mut frame = Vec::with_capacity(4 + header_bytes.len() + data.len());
+    frame.extend_from_slice(&(header_bytes.len() as u32).to_be_bytes());
+    frame.extend_from_slice(&header_bytes);
+    frame.extend_from_slice(data);
+    frame
+}
+
+fn unpack_binary_frame(frame: &[u8]) -> Result<(serde_json::Value, &[u8])> {
+    if frame.len() < 4 { return Err(anyhow!("frame too short")); }
+    let header_len = u32::from_be_bytes([frame[0], frame[1], frame[2], frame[3]]) as usize;
+    if header_len > frame.len() - 4 { return Err(anyhow!("invalid frame header length")); }
+    let header: serde_json::Value = serde_json::from_slice(&frame[4..4 + header_len])?;
+    Ok((header, &frame[4 + header_len..]))
+}
+
+// 将服务端转发的上传分块写入 offset 处（offset 为 0 时截断重建），返回写入后的 offset
+async fn write_upload_chunk(path: &Path, offset: u64, data: &[u8], crc32: Option<u32>) -> Result<u64> {
+    if let Some(expected) = crc32 {
+        if crc32fast::hash(data) != expected { return Err(anyhow!("chunk checksum mismatch")); }
+    }
+    if let Some(parent) = path.parent() { tokio::fs::create_dir_all(parent).await.ok(); }
+    let mut f = if offset == 0 {
+        tokio::fs::File::create(path).await?
+    } else {
+        tokio::fs::OpenOptions::new().write(true).open(path).await?
+    };
+    f.seek(std::io::SeekFrom::Start(offset)).await?;
+    f.write_all(data).await?;
+    f.flush().await?;
+    Ok(offset + data.len() as u64)
+}
+
+// 从 offset 开始按块读取文件并以二进制帧发送，每块附带 offset/length/crc32，服务端可据此续传。
+// 最多 DOWNLOAD_ACK_WINDOW 块未确认；服务端拒绝某块（offset/长度/CRC 不符）时回传其期望的 offset，
+// 从该处重新发送，此前已发出的后续分块服务端会按 offset 不符丢弃。确认超时同样从已确认处重发，
+// 连续失败 DOWNLOAD_CHUNK_RETRIES 次后放弃，由调用方回传失败结果
+async fn stream_file_chunks(socket: &Client, uuid: &str, transfer_id: &str, path: &Path, offset: u64, chunk_size: usize) -> Result<()> {
+    let mut f = tokio::fs::File::open(path).await?;
+    let total_size = f.metadata().await?.len();
+    let mut next = offset.min(total_size); // 下一块的 offset
+    let mut acked = next; // 服务端已确认写入的 offset
+    f.seek(std::io::SeekFrom::Start(next)).await?;
+    let mut buf = vec![0u8; chunk_size];
+    let (ack_tx, mut ack_rx) = mpsc::unbounded_channel::<(u64, serde_json::Value)>();
+    let mut generation: u64 = 0; // 每次重发递增，忽略此前发出的分块的确认
+    let mut in_flight = 0usize;
+    let mut eof_sent = false;
+    let mut failures = 0u32;
+    loop {
+        while in_flight < DOWNLOAD_ACK_WINDOW && !eof_sent {
+            // 尽量填满一个分块，避免短读产生过多小帧
+            let mut n = 0;
+            while n < buf.len() {
+                let read = f.read(&mut buf[n..]).await?;
+                if read == 0 { break; }
+                n += read;
+            }
+            let eof = next + n as u64 >= total_size;
+            let header = json!({
+                "uuid": uuid,
+                "transfer_id": transfer_id,
+                "offset": next,
+                "length": n,
+                "total_size": total_size,
+                "crc32": crc32fast::hash(&buf[..n]),
+                "eof": eof,
+            });
+            let ack_tx = ack_tx.clone();
+            let chunk_generation = generation;
+            socket
+                .emit_with_ack("download_file_chunk", pack_binary_frame(&header, &buf[..n]), DOWNLOAD_ACK_TIMEOUT,
+                    move |payload: Payload, _socket| {
+                        let ack = extract_first_json(payload).unwrap_or(serde_json::Value::Null);
+                        let _ = ack_tx.send((chunk_generation, ack));
+                        Box::pin(async {})
+                    })
+                .await
+                .map_err(|e| anyhow!("emit chunk failed: {}", e))?;
+            in_flight += 1;
+            next += n as u64;
+            eof_sent = eof;
+        }
+        let ack = match tokio::time::timeout(DOWNLOAD_ACK_TIMEOUT, ack_rx.recv()).await {
+            Ok(Some((chunk_generation, _))) if chunk_generation != generation => continue,
+            Ok(Some((_, ack))) => Some(ack),
+            _ => None, // 确认超时（连接断开时重连后由服务端重新下发 download_file）
+        };
+        if let Some(ack) = &ack {
+            in_flight -= 1;
+            let ok = ack.get("ok").and_then(|x| x.as_bool()).unwrap_or(false);
+            if ok {
+                acked = ack.get("offset").and_then(|x| x.as_u64()).unwrap_or(acked);
+                failures = 0;
+                if eof_sent && in_flight == 0 && acked >= total_size {
+                    return Ok(());
+                }
+                continue;
+            }
+        }
+        // 分块被拒绝或确认超时：从服务端期望的 offset（未给出时为已确认处）重新发送
+        let error = match &ack {
+            Some(ack) => match ack.get("offset").and_then(|x| x.as_u64()) {
+                Some(expected) => {
+                    acked = expected.min(total_size);
+                    ack.get("error").and_then(|x| x.as_str()).unwrap_or("chunk rejected").to_string()
+                }
+                // 服务端没有给出 offset（如传输已不存在），无法续传
+                None => return Err(anyhow!("chunk rejected: {}", ack.get("error").and_then(|x| x.as_str()).unwrap_or("unknown"))),
+            },
+            None => "chunk ack timeout".to_string(),
+        };
+        failures += 1;
+        if failures > DOWNLOAD_CHUNK_RETRIES {
+            return Err(anyhow!("download chunk failed after {} retries: {}", DOWNLOAD_CHUNK_RETRIES, error));
+        }
+        generation += 1;
+        in_flight = 0;
+        eof_sent = false;
+        next = acked;
+        f.seek(std::io::SeekFrom::Start(next)).await?;
+    }
+}
+
+// 处理带 transfer_id 的 download_file：digest_first 时只上报摘要，否则从 offset 起分块发送，失败时回传结果。
+// 在独立任务中运行，不占用 socket 的事件回调
+async fn serve_download_transfer(socket: Client, uuid: String, transfer_id: String, path: String, offset: u64, chunk_size: usize, digest_first: bool) {
+    let result = if digest_first {
+        // 只上报摘要，由服务端决定是否需要传输（需要时再次下发不带 digest_first 的 download_file）
+        match file_sha256(Path::new(&path)).await {
+            Ok((digest, size)) => socket.emit("download_file_digest", json!({
+                "uuid": uuid,
+                "transfer_id": transfer_id,
+                "sha256": digest,
+                "size": size,
+            })).await.map_err(|e| anyhow!("emit digest failed: {}", e)),
+            Err(e) => Err(e),
+        }
+    } else {
+        stream_file_chunks(&socket, &uuid, &transfer_id, Path::new(&path), offset, chunk_size).await
+    };
+    if let Err(e) = result {
+        let _ = socket.emit("download_file_result", json!({
+            "uuid": uuid,
+            "transfer_id": transfer_id,
+            "success": false,
+            "path": path,
+            "error": e.to_string(),
+        })).await;
+    }
+}
+
+// 计算文件的 SHA-256（十六进制）与大小，服务端据此判断是否已有相同内容而无需传输
+async fn file_sha256(path: &Path) -> Result<(String, u64)> {
+    let mut f = tokio::fs::File::open(path).await?;
+    let mut hasher = Sha256::new();
+    let mut buf = vec![0u8; 1024 * 1024];
+    let mut size: u64 = 0;
+    loop {
+        let n = f.read(&mut buf).await?;
+        if n == 0 { break; }
+        hasher.update(&buf[..n]);
+        size += n as u64;
+    }
+    let digest = hasher.finalize().iter().map(|b| format!("{:02x}", b)).collect::<String>();
+    Ok((digest, size))
+}
+
+// 截取指定显示器并按最大边长缩放（阻塞调用，需在 spawn_blocking 中执行）
+fn capture_rgba(display_index: Option<usize>, max_edge: u32, filter: FilterType) -> Result<image::RgbaImage> {
+    let screens = Screen::all().map_err(|e| anyhow!("list screens failed: {}", e))?;
+    if screens.is_empty() { return Err(anyhow!("no screens found")); }
+    let screen = match display_index {
+        Some(idx) if idx < screens.len() => &screens[idx],
+        _ => &screens[0],
+    };
+    
+    let rgba_img = screen.capture().map_err(|e| anyhow!("capture failed: {}", e))?;
+    let (w, h) = rgba_img.dimensions();
+    let max_dimension = w.max(h);
+    if max_dimension > max_edge {
+        let scale = max_edge as f32 / max_dimension as f32;
+        let new_w = (w as f32 * scale).round() as u32;
+        let new_h = (h as f32 * scale).round() as u32;
+        return Ok(image::imageops::resize(&rgba_img, new_w, new_h, filter));
+    }
+    Ok(rgba_img)
+}
+
+// 比较两帧中同一瓦片的像素是否有变化（逐行比较原始 RGBA 字节）
+fn tile_changed(prev: &image::RgbaImage, cur: &image::RgbaImage, x: u32, y: u32, w: u32, h: u32) -> bool {
+    let stride = cur.width() as usize * 4;
+    let (a, b) = (prev.as_raw(), cur.as_raw());
+    (y..y + h).any(|row| {
+        let start = row as usize * stride + x as usize * 4;
+        let end = start + w as usize * 4;
+        a[start..end] != b[start..end]
+    })
+}
+
+// 将帧按 SCREEN_TILE_SIZE 切分为瓦片，只编码相对 prev 有变化的瓦片（prev 为 None 时编码全部，即关键帧）；
+// 返回瓦片描述 [index, x, y, w, h, length] 与依次拼接的 PNG 数据
+fn encode_changed_tiles(cur: &image::RgbaImage, prev: Option<&image::RgbaImage>) -> Result<(Vec<serde_json::Value>, Vec<u8>)> {
+    use image::codecs::png::{CompressionType, FilterType as PngFilter, PngEncoder};
+    use image::ImageEncoder;
+    let (width, height) = cur.dimensions();
+    let columns = (width + SCREEN_TILE_SIZE - 1) / SCREEN_TILE_SIZE;
+    let mut tiles = Vec::new();
+    let mut data = Vec::new();
+    for y in (0..height).step_by(SCREEN_TILE_SIZE as usize) {
+        for x in (0..width).step_by(SCREEN_TILE_SIZE as usize) {
+            let w = SCREEN_TILE_SIZE.min(width - x);
+            let h = SCREEN_TILE_SIZE.min(height - y);
+            if let Some(prev) = prev {
+                if !tile_changed(prev, cur, x, y, w, h) { continue; }
+            }
+            let tile = image::imageops::crop_imm(cur, x, y, w, h).to_image();
+            let start = data.len();
+            PngEncoder::new_with_quality(&mut data, CompressionType::Fast, PngFilter::Sub)
+                .write_image(tile.as_raw(), w, h, image::ColorType::Rgba8)?;
+            let index = (y / SCREEN_TILE_SIZE) * columns + x / SCREEN_TILE_SIZE;
+            tiles.push(json!([index, x, y, w, h, data.len() - start]));
+        }
+    }
+    Ok((tiles, data))
+}
+
+// 连续画面推送：按 fps 上限截屏，首帧与每 SCREEN_KEYFRAME_INTERVAL 发送关键帧，其余只发送变化的瓦片；
+// generation 变化（收到 stop 或新的 start）时退出
+async fn run_screen_stream(socket: Client, uuid: String, stream_id: String, display_index: Option<usize>, fps: u32, generation: Arc<AtomicU64>, my_generation: u64) {
+    let interval = Duration::from_millis(1000 / fps.clamp(1, SCREEN_MAX_FPS) as u64);
+    let mut prev: Option<image::RgbaImage> = None;
+    let mut last_keyframe = tokio::time::Instant::now();
+    let mut seq: u64 = 0;
+    while generation.load(Ordering::SeqCst) == my_generation {
+        let started = tokio::time::Instant::now();
+        let base = if last_keyframe.elapsed() >= SCREEN_KEYFRAME_INTERVAL { None } else { prev.take() };
+        let res = tokio::task::spawn_blocking(move || -> Result<_> {
+            let cur = capture_rgba(display_index, SCREEN_MAX_EDGE, FilterType::Triangle)?;
+            // 分辨率变化时退化为关键帧
+            let base = base.filter(|p| p.dimensions() == cur.dimensions());
+            let keyframe = base.is_none();
+            let (tiles, data) = encode_changed_tiles(&cur, base.as_ref())?;
+            Ok((cur, keyframe, tiles, data))
+        }).await.map_err(|e| anyhow!("task join error: {}", e)).and_then(|r| r);
+        match res {
+            Ok((cur, keyframe, tiles, data)) => {
+                let (width, height) = cur.dimensions();
+                prev = Some(cur);
+                if keyframe { last_keyframe = tokio::time::Instant::now(); }
+                if !tiles.is_empty() {
+                    let header = json!({
+                        "uuid": uuid, "stream_id": stream_id, "seq": seq, "keyframe": keyframe,
+                        "width": width, "height": height, "tile_size": SCREEN_TILE_SIZE, "tiles": tiles,
+                    });
+                    if socket.emit("screen_frame", pack_binary_frame(&header, &data)).await.is_err() { break; }
+                    seq += 1;
+                }
+            }
+            Err(e) => {
+                let _ = socket.emit("screen_stream_error", json!({"uuid": uuid, "stream_id": stream_id, "error": e.to_string()})).await;
+                break;
+            }
+        }
+        let elapsed = started.elapsed();
+        if elapsed < interval { sleep(interval - elapsed).await; }
+    }
 }
 
-async fn capture_screenshot(display_index: Option<usize>) -> Result<String> {
+// 返回 PNG 字节；服务端协商了二进制载荷时原样发送，否则由调用方 base64 编码
+async fn capture_screenshot(display_index: Option<usize>) -> Result<Vec<u8>> {
     use tokio::task;
     use tokio::time::timeout;
     
     // 设置超时避免长时间阻塞，返回扁平化的Result
-    let task_handle = task::spawn_blocking(move || -> Result<String> {
-        let screens = Screen::all().map_err(|e| anyhow!("list screens failed: {}", e))?;
-        if screens.is_empty() { return Err(anyhow!("no screens found")); }
-        let screen = match display_index {
-            Some(idx) if idx < screens.len() => &screens[idx],
-            _ => &screens[0],
-        };
-        
-        let rgba_img = screen.capture().map_err(|e| anyhow!("capture failed: {}", e))?;
-        let mut dyn_img = image::DynamicImage::ImageRgba8(rgba_img);
-        
+    let task_handle = task::spawn_blocking(move || -> Result<Vec<u8>> {
         // 限制截图尺寸避免过大数据导致传输失败
-        let (w, h) = dyn_img.dimensions();
-        let max_edge = 1200u32; // 最大边长限制
-        let max_dimension = w.max(h);
-        if max_dimension > max_edge {
-            let scale = max_edge as f32 / max_dimension as f32;
-            let new_w = (w as f32 * scale).round() as u32;
-            let new_h = (h as f32 * scale).round() as u32;
-            dyn_img = dyn_img.resize_exact(new_w, new_h, FilterType::Lanczos3);
-        }
+        let dyn_img = image::DynamicImage::ImageRgba8(capture_rgba(display_index, SCREEN_MAX_EDGE, FilterType::Lanczos3)?);
         
         let mut png_bytes = Vec::new();
         dyn_img.write_to(&mut Cursor::new(&mut png_bytes), image::ImageOutputFormat::Png)?;
         
         // 检查生成数据大小，避免过大
-        let b64 = general_purpose::STANDARD.encode(&png_bytes);
-        if b64.len() > 20 * 1024 * 1024 { // 20MB限制
-            return Err(anyhow!("screenshot too large: {} bytes", b64.len()));
+        if png_bytes.len() > 15 * 1024 * 1024 { // 15MB限制（base64 后约 20MB）
+            return Err(anyhow!("screenshot too large: {} bytes", png_bytes.len()));
         }
         
-        Ok(b64)
+        Ok(png_bytes)
     });
     
     match timeout(Duration::from_secs(30), task_handle).await {
@@ -156,7 +489,7 @@ async fn capture_screenshot(display_index: Option<usize>) -> Result<String> {
 
 impl Default for ClientConfig {
     fn default() -> Self {
-        Self { server_url: DEFAULT_SERVER_URL.to_string(), shell: Some("powershell".to_string()) }
+        Self { server_url: DEFAULT_SERVER_URL.to_string(), shell: Some("powershell".to_string()), tags: Vec::new() }
     }
 }
 
@@ -279,6 +612,18 @@ impl ShellManager {
     }
 
     async fn exec_shared(&mut self, command: &str) -> Result<CmdResult> {
+        let (tx, mut rx) = mpsc::unbounded_channel::<(bool, String)>();
+        self.exec_shared_streaming(command, tx).await?;
+        let mut stdout_buf = String::new();
+        let mut stderr_buf = String::new();
+        while let Ok((is_err, line)) = rx.try_recv() {
+            if is_err { stderr_buf.push_str(&format!("{line}\n")); } else { stdout_buf.push_str(&format!("{line}\n")); }
+        }
+        Ok(CmdResult { stdout: stdout_buf, stderr: stderr_buf })
+    }
+
+    // 在共享会话中执行命令，输出逐行送入 tx（不含结束标记行），命令结束后返回
+    async fn exec_shared_streaming(&mut self, command: &str, tx: mpsc::UnboundedSender<(bool, String)>) -> Result<()> {
         self.ensure_shared().await?;
         let _guard = self.shared_lock.lock().await; // serialize
 
@@ -306,22 +651,18 @@ impl ShellManager {
                 stdin.flush().await?;
             }
 
-            let mut stdout_buf = String::new();
-            let mut stderr_buf = String::new();
-
-            loop {
-                let mut rx = shared.rx.lock().await;
-                if let Some((is_err, line)) = rx.recv().await {
-                    if line.contains(&sentinel) {
-                        break;
-                    }
-                    if is_err { stderr_buf.push_str(&format!("{line}\n")); } else { stdout_buf.push_str(&format!("{line}\n")); }
-                } else {
+            let mut rx = shared.rx.lock().await;
+            while let Some((is_err, line)) = rx.recv().await {
+                if line.contains(&sentinel) {
                     break;
                 }
+                // 与服务端清理规则一致：丢弃残留的结束标记行与 PowerShell 提示符行，输出可原样转发给控制台
+                if is_marker_line(&line) {
+                    continue;
+                }
+                let _ = tx.send((is_err, line));
             }
-
-            return Ok(CmdResult { stdout: stdout_buf, stderr: stderr_buf });
+            return Ok(());
         }
         Err(anyhow!("shared shell not available"))
     }
@@ -358,7 +699,214 @@ impl ShellManager {
             }
         }
     }
+
+    // 在独立进程中执行命令，stdout/stderr 逐行送入 tx，进程退出后返回
+    async fn exec_new_streaming(&self, command: &str, tx: mpsc::UnboundedSender<(bool, String)>) -> Result<()> {
+        let mut cmd = match self.shell_kind {
+            ShellKind::PowerShell => {
+                let mut cmd = Command::new("powershell.exe");
+                cmd.args(["-NoLogo", "-NoProfile", "-ExecutionPolicy", "Bypass", "-Command", command]);
+                cmd
+            }
+            ShellKind::Cmd => {
+                let mut cmd = Command::new("cmd.exe");
+                cmd.args(["/C", command]);
+                cmd
+            }
+        };
+        #[cfg(windows)]
+        { 
+            #[allow(unused_imports)]
+            use std::os::windows::process::CommandExt;
+            cmd.creation_flags(CREATE_NO_WINDOW); 
+        }
+        let mut child = cmd
+            .stdin(Stdio::null())
+            .stdout(Stdio::piped())
+            .stderr(Stdio::piped())
+            .spawn()
+            .context("spawn shell failed")?;
+        let stdout = child.stdout.take().ok_or_else(|| anyhow!("no stdout"))?;
+        let stderr = child.stderr.take().ok_or_else(|| anyhow!("no stderr"))?;
+
+        let tx_err = tx.clone();
+        let out_task = tokio::spawn(async move {
+            let mut lines = BufReader::new(stdout).lines();
+            while let Ok(Some(line)) = lines.next_line().await {
+                let _ = tx.send((false, line));
+            }
+        });
+        let err_task = tokio::spawn(async move {
+            let mut lines = BufReader::new(stderr).lines();
+            while let Ok(Some(line)) = lines.next_line().await {
+                let _ = tx_err.send((true, line));
+            }
+        });
+        let _ = out_task.await;
+        let _ = err_task.await;
+        child.wait().await?;
+        Ok(())
+    }
+}
+
+// 共享会话输出中的结束标记行与 PowerShell 提示符行（与服务端清理规则一致，不转发给控制台）
+fn is_marker_line(line: &str) -> bool {
+    line.starts_with(SENTINEL_PREFIX) || (line.starts_with("PS ") && line.ends_with('>'))
+}
+
+// 与服务端 sanitize_output_text 相同的清理：丢弃结束标记行与提示符行，\r\n 统一为 \n，去掉首尾空白
+fn clean_output(text: &str) -> String {
+    let lines: Vec<&str> = text.lines().filter(|line| !is_marker_line(line)).collect();
+    lines.join("\n").trim().to_string()
+}
+
+// 发送事件：服务端协商了压缩（threshold > 0）且 fields 中字段的 JSON 达到阈值时，
+// 将这些字段 zlib 压缩后作为二进制帧 [4字节大端头长度][JSON头][压缩数据] 发送，其余字段（含 encoding）放在帧头
+async fn emit_maybe_compressed(socket: &Client, event: &str, mut msg: serde_json::Value, fields: &[&str], threshold: usize) {
+    if threshold > 0 {
+        if let Some(obj) = msg.as_object_mut() {
+            let mut bulk = serde_json::Map::new();
+            for field in fields {
+                if let Some(value) = obj.remove(*field) {
+                    bulk.insert(field.to_string(), value);
+                }
+            }
+            let raw = serde_json::to_vec(&bulk).unwrap_or_default();
+            if raw.len() >= threshold {
+                let mut encoder = ZlibEncoder::new(Vec::with_capacity(raw.len() / 4), Compression::fast());
+                if encoder.write_all(&raw).is_ok() {
+                    if let Ok(body) = encoder.finish() {
+                        if body.len() < raw.len() {
+                            obj.insert("encoding".to_string(), json!("zlib"));
+                            let _ = socket.emit(event, pack_binary_frame(&msg, &body)).await;
+                            return;
+                        }
+                    }
+                }
+            }
+            obj.extend(bulk);
+        }
+    }
+    let _ = socket.emit(event, msg).await;
+}
+
+// 从 buf 头部取出不超过 max 字节的一段（按字符边界切分）
+fn take_stream_piece(buf: &mut String, max: usize) -> String {
+    if buf.len() <= max {
+        return std::mem::take(buf);
+    }
+    let mut cut = max;
+    while cut > 0 && !buf.is_char_boundary(cut) {
+        cut -= 1;
+    }
+    let rest = buf.split_off(cut);
+    std::mem::replace(buf, rest)
+}
+
+// 将逐行输出攒批为 command_output_chunk 事件：缓冲达到 STREAM_CHUNK_BYTES 或每隔 STREAM_FLUSH_INTERVAL 发送一次，
+// seq 从 0 递增，stdout 与 stderr 共用同一序列；返回已发送的分块数
+async fn forward_output_chunks(socket: &Client, uuid: &str, request_id: &serde_json::Value, mut rx: mpsc::UnboundedReceiver<(bool, String)>, compression: &AtomicUsize) -> u64 {
+    let mut seq: u64 = 0;
+    let mut bufs = [String::new(), String::new()]; // [stdout, stderr]
+    let mut ticker = tokio::time::interval(STREAM_FLUSH_INTERVAL);
+    ticker.set_missed_tick_behavior(tokio::time::MissedTickBehavior::Delay);
+    loop {
+        let (closed, force) = tokio::select! {
+            msg = rx.recv() => match msg {
+                Some((is_err, line)) => {
+                    let buf = &mut bufs[is_err as usize];
+                    buf.push_str(&line);
+                    buf.push('\n');
+                    (false, false)
+                }
+                None => (true, true),
+            },
+            _ = ticker.tick() => (false, true),
+        };
+        for (idx, stream) in ["stdout", "stderr"].iter().enumerate() {
+            while bufs[idx].len() >= STREAM_CHUNK_BYTES || (force && !bufs[idx].is_empty()) {
+                let data = take_stream_piece(&mut bufs[idx], STREAM_CHUNK_BYTES);
+                // clean：输出已逐行去掉结束标记与提示符行，服务端无需再清理
+                let msg = json!({"uuid": uuid, "request_id": request_id, "seq": seq, "stream": stream, "data": data, "clean": true});
+                emit_maybe_compressed(socket, "command_output_chunk", msg, &["data"], compression.load(Ordering::Relaxed)).await;
+                seq += 1;
+            }
+        }
+        if closed {
+            return seq;
+        }
+    }
+}
+
+// 执行控制台下发的命令（run_command 事件与 run_batch 中的条目）并回传 command_output
+async fn run_command(socket: &Client, uuid: &str, shell: &Mutex<ShellManager>, compression: &AtomicUsize, val: &serde_json::Value) {
+    let command = val.get("command").and_then(|x| x.as_str()).unwrap_or("").to_string();
+    let use_shared = val.get("use_shared_context").and_then(|x| x.as_bool()).unwrap_or(true);
+    let request_id = val.get("request_id").cloned().unwrap_or(serde_json::Value::Null);
+    let stream = val.get("stream").and_then(|x| x.as_bool()).unwrap_or(false);
+    if command.is_empty() { return; }
+    if stream {
+        // 流式模式：边执行边发送输出分块，结束后发送汇总事件（不再重复携带输出）
+        let (tx, rx) = mpsc::unbounded_channel::<(bool, String)>();
+        let exec = async {
+            if use_shared {
+                shell.lock().await.exec_shared_streaming(&command, tx).await
+            } else {
+                shell.lock().await.exec_new_streaming(&command, tx).await
+            }
+        };
+        let (res, chunks) = tokio::join!(exec, forward_output_chunks(socket, uuid, &request_id, rx, compression));
+        let error = match res { Ok(()) => String::new(), Err(e) => e.to_string() };
+        let msg = json!({"uuid": uuid, "request_id": request_id, "command": command, "output": "", "error": error, "streamed": true, "chunks": chunks});
+        let _ = socket.emit("command_output", msg).await;
+        return;
+    }
+    let res = if use_shared {
+        // 对于 PowerShell，强制输出结束标记以保证读取完整
+        shell.lock().await.exec_shared(&command).await
+    } else {
+        shell.lock().await.exec_new(&command).await
+    };
+    match res {
+        Ok(out) => {
+            // clean：已按服务端的规则清理，服务端可把压缩数据原样转发给控制台
+            let msg = json!({"uuid": uuid, "request_id": request_id, "command": command, "output": clean_output(&out.stdout), "error": clean_output(&out.stderr), "clean": true});
+            emit_maybe_compressed(socket, "command_output", msg, &["output", "error"], compression.load(Ordering::Relaxed)).await;
+        }
+        Err(e) => {
+            let msg = json!({"uuid": uuid, "request_id": request_id, "command": command, "output": "", "error": e.to_string()});
+            let _ = socket.emit("command_output", msg).await;
+        }
+    }
+}
+
+// 执行控制台下发的文件操作（do_file_operation 事件与 run_batch 中的条目）并回传结果
+async fn do_file_operation(socket: &Client, uuid: &str, compression: &AtomicUsize, val: &serde_json::Value) {
+    let op = val.get("operation").and_then(|x| x.as_str()).unwrap_or("").to_string();
+    let path = val.get("path").and_then(|x| x.as_str()).map(|s| s.to_string());
+    let file_data = val.get("file_data").and_then(|x| x.as_str()).map(|s| s.to_string());
+    let request_id = val.get("request_id").cloned().unwrap_or(serde_json::Value::Null);
+    // 服务端指定 chunk_size 时目录列表分批回传，大目录不必等全部读完
+    let chunk_size = val.get("chunk_size").and_then(|x| x.as_u64()).map(|n| n.clamp(1, 10_000) as usize);
+    if let (Some(chunk_size), "list_dir") = (chunk_size, op.as_str()) {
+        stream_list_dir(socket, uuid, &request_id, path, chunk_size, compression.load(Ordering::Relaxed)).await;
+        return;
+    }
+    let (success, data_json, err) = match file_operation(&op, path, file_data).await {
+        Ok(value) => (true, value, String::new()),
+        Err(e) => (false, serde_json::Value::Null, e.to_string()),
+    };
+    let msg = json!({
+        "uuid": uuid,
+        "request_id": request_id,
+        "operation": op,
+        "success": success,
+        "data": data_json,
+        "error": err,
+    });
+    emit_maybe_compressed(socket, "file_operation_result", msg, &["data"], compression.load(Ordering::Relaxed)).await;
 }
+
 fn appdata_dir() -> Result<PathBuf> {
     let base = BaseDirs::new().ok_or_else(|| anyhow!("failed to get base dirs"))?;
     Ok(base.data_dir().join(APP_FOLDER_NAME))
@@ -479,7 +1027,11 @@ async fn main() -> Result<()> {
         _ => ShellKind::PowerShell,
     };
     let shell_manager = std::sync::Arc::new(tokio::sync::Mutex::new(ShellManager::new(shell_kind).await?));
-    let shell_manager_for_api = shell_manager.clone();
+    let screen_generation = Arc::new(AtomicU64::new(0)); // 画面推送代数：递增即令当前推送任务退出
+    let compression = Arc::new(AtomicUsize::new(0)); // 服务端协商的压缩阈值（字节），0 表示不压缩
+    let binary_payloads = Arc::new(AtomicBool::new(false)); // 服务端接受二进制附件时截图等原始字节不再 base64
+    let retry_after_ms = Arc::new(AtomicU64::new(0)); // 服务端拒绝握手时建议的重连等待（毫秒）
+    let refused = Arc::new(tokio::sync::Notify::new());
 
     // 重连循环
     loop {
@@ -488,93 +1040,121 @@ async fn main() -> Result<()> {
             .namespace("/")
             .reconnect_on_disconnect(true)
             .reconnect_delay(5, 30)
-            .auth(json!({"uuid": client_uuid}))
+            .auth(json!({"uuid": client_uuid, "tags": cfg.tags, "capabilities": {"compression": ["zlib"], "binary": true, "batch": true}}))
             .on("connect", {
                 let uid = client_uuid.clone();
+                let compression = compression.clone();
+                let binary_payloads = binary_payloads.clone();
                 move |_payload: Payload, socket| {
                     let uid = uid.clone();
+                    // 新连接可能是旧服务端：等待 server_capabilities 后再启用压缩与二进制载荷
+                    compression.store(0, Ordering::Relaxed);
+                    binary_payloads.store(false, Ordering::Relaxed);
                     Box::pin(async move {
                         // 冗余兼容：连接成功后再尝试一次事件注册，保证服务器收到
                         let _ = socket.emit("register_client", json!({"uuid": uid})).await;
                     })
                 }
             })
+            .on("server_capabilities", {
+                let compression = compression.clone();
+                let binary_payloads = binary_payloads.clone();
+                move |payload: Payload, _socket| {
+                    let compression = compression.clone();
+                    let binary_payloads = binary_payloads.clone();
+                    Box::pin(async move {
+                        if let Some(val) = extract_first_json(payload) {
+                            let threshold = match val.get("compression").and_then(|x| x.as_str()) {
+                                Some("zlib") => val.get("threshold").and_then(|x| x.as_u64()).unwrap_or(1024).max(1) as usize,
+                                _ => 0,
+                            };
+                            compression.store(threshold, Ordering::Relaxed);
+                            let binary = val.get("binary").and_then(|x| x.as_bool()).unwrap_or(false);
+                            binary_payloads.store(binary, Ordering::Relaxed);
+                        }
+                    })
+                }
+            })
             .on("run_command", {
                 let uuid = client_uuid.clone();
                 let shell = shell_manager.clone();
+                let compression = compression.clone();
                 move |payload: Payload, socket| {
                     let uuid = uuid.clone();
                     let shell = shell.clone();
+                    let compression = compression.clone();
                     Box::pin(async move {
-                        let v = extract_first_json(payload);
-                        if let Some(val) = v {
-                            let command = val.get("command").and_then(|x| x.as_str()).unwrap_or("").to_string();
-                            let use_shared = val.get("use_shared_context").and_then(|x| x.as_bool()).unwrap_or(true);
-                            if command.is_empty() { return; }
-            let res = if use_shared {
-                // 对于 PowerShell，强制输出结束标记以保证读取完整
-                shell.lock().await.exec_shared(&command).await
-            } else {
-                shell.lock().await.exec_new(&command).await
-            };
-                            match res {
-                                Ok(out) => {
-                                    let msg = json!({"uuid": uuid, "command": command, "output": out.stdout, "error": out.stderr});
-                                    let _ = socket.emit("command_output", msg).await;
-                                }
-                                Err(e) => {
-                                    let msg = json!({"uuid": uuid, "command": command, "output": "", "error": e.to_string()});
-                                    let _ = socket.emit("command_output", msg).await;
-                                }
-                            }
+                        if let Some(val) = extract_first_json(payload) {
+                            run_command(&socket, &uuid, &shell, &compression, &val).await;
                         }
                     })
                 }
             })
             .on("do_file_operation", {
                 let uuid = client_uuid.clone();
-                let _shell = shell_manager_for_api.clone();
+                let compression = compression.clone();
                 move |payload: Payload, socket| {
                     let uuid = uuid.clone();
+                    let compression = compression.clone();
                     Box::pin(async move {
-                        let v = extract_first_json(payload);
-                        if let Some(val) = v {
-                            let op = val.get("operation").and_then(|x| x.as_str()).unwrap_or("").to_string();
-                            let path = val.get("path").and_then(|x| x.as_str()).map(|s| s.to_string());
-                            let file_data = val.get("file_data").and_then(|x| x.as_str()).map(|s| s.to_string());
-                            let (success, data_json, err) = match file_operation(&op, path, file_data).await {
-                                Ok(value) => (true, value, String::new()),
-                                Err(e) => (false, serde_json::Value::Null, e.to_string()),
-                            };
-                            let _ = socket.emit("file_operation_result", json!({
-                                "uuid": uuid,
-                                "operation": op,
-                                "success": success,
-                                "data": data_json,
-                                "error": err,
-                            })).await;
+                        if let Some(val) = extract_first_json(payload) {
+                            do_file_operation(&socket, &uuid, &compression, &val).await;
+                        }
+                    })
+                }
+            })
+            .on("run_batch", {
+                // 离线期间排队的请求在重连后成批下发：按顺序逐条执行，每条照常回传各自的结果
+                let uuid = client_uuid.clone();
+                let shell = shell_manager.clone();
+                let compression = compression.clone();
+                move |payload: Payload, socket| {
+                    let uuid = uuid.clone();
+                    let shell = shell.clone();
+                    let compression = compression.clone();
+                    Box::pin(async move {
+                        let items = extract_first_json(payload)
+                            .and_then(|val| val.get("items").and_then(|x| x.as_array()).cloned())
+                            .unwrap_or_default();
+                        for item in items {
+                            let data = item.get("data").cloned().unwrap_or(serde_json::Value::Null);
+                            match item.get("event").and_then(|x| x.as_str()) {
+                                Some("run_command") => run_command(&socket, &uuid, &shell, &compression, &data).await,
+                                Some("do_file_operation") => do_file_operation(&socket, &uuid, &compression, &data).await,
+                                _ => {}
+                            }
                         }
                     })
                 }
             })
             .on("screenshot", {
                 let uuid = client_uuid.clone();
+                let binary_payloads = binary_payloads.clone();
                 move |payload: Payload, socket| {
                     let uuid = uuid.clone();
+                    let binary = binary_payloads.load(Ordering::Relaxed);
                     Box::pin(async move {
                         let v = extract_first_json(payload);
+                        let request_id = v.as_ref().and_then(|val| val.get("request_id").cloned()).unwrap_or(serde_json::Value::Null);
                         let display_index = v.and_then(|val| val.get("display_index").and_then(|x| x.as_u64())).map(|n| n as usize);
                         match capture_screenshot(display_index).await {
-                            Ok(png_base64) => {
+                            Ok(png) if binary => {
+                                // 二进制帧：[4字节大端头长度][JSON头][PNG]
+                                let header = json!({"uuid": uuid, "request_id": request_id, "success": true});
+                                let _ = socket.emit("screenshot_result", pack_binary_frame(&header, &png)).await;
+                            }
+                            Ok(png) => {
                                 let _ = socket.emit("screenshot_result", json!({
                                     "uuid": uuid,
+                                    "request_id": request_id,
                                     "success": true,
-                                    "image_base64": png_base64,
+                                    "image_base64": general_purpose::STANDARD.encode(&png),
                                 })).await;
                             }
                             Err(e) => {
                                 let _ = socket.emit("screenshot_result", json!({
                                     "uuid": uuid,
+                                    "request_id": request_id,
                                     "success": false,
                                     "error": e.to_string(),
                                 })).await;
@@ -583,6 +1163,32 @@ async fn main() -> Result<()> {
                     })
                 }
             })
+            .on("start_screen_stream", {
+                let uuid = client_uuid.clone();
+                let generation = screen_generation.clone();
+                move |payload: Payload, socket| {
+                    let uuid = uuid.clone();
+                    let generation = generation.clone();
+                    Box::pin(async move {
+                        let v = extract_first_json(payload).unwrap_or(serde_json::Value::Null);
+                        let stream_id = v.get("stream_id").and_then(|x| x.as_str()).unwrap_or("").to_string();
+                        let display_index = v.get("display_index").and_then(|x| x.as_u64()).map(|n| n as usize);
+                        let fps = v.get("fps").and_then(|x| x.as_u64()).unwrap_or(5) as u32;
+                        // 同一时间只保留一路推送，新的 start 会替换旧的
+                        let my_generation = generation.fetch_add(1, Ordering::SeqCst) + 1;
+                        tokio::spawn(run_screen_stream(socket, uuid, stream_id, display_index, fps, generation, my_generation));
+                    })
+                }
+            })
+            .on("stop_screen_stream", {
+                let generation = screen_generation.clone();
+                move |_payload: Payload, _socket| {
+                    let generation = generation.clone();
+                    Box::pin(async move {
+                        generation.fetch_add(1, Ordering::SeqCst);
+                    })
+                }
+            })
             .on("upload_file", {
                 let uuid = client_uuid.clone();
                 move |payload: Payload, socket| {
@@ -614,22 +1220,83 @@ async fn main() -> Result<()> {
                     })
                 }
             })
+            .on("upload_file_chunk", {
+                let uuid = client_uuid.clone();
+                move |payload: Payload, socket| {
+                    let uuid = uuid.clone();
+                    Box::pin(async move {
+                        let Some(frame) = extract_binary(payload) else { return; };
+                        let Ok((header, data)) = unpack_binary_frame(&frame) else { return; };
+                        let transfer_id = header.get("transfer_id").and_then(|x| x.as_str()).unwrap_or("");
+                        let path = header.get("path").and_then(|x| x.as_str()).unwrap_or("");
+                        let offset = header.get("offset").and_then(|x| x.as_u64()).unwrap_or(0);
+                        let crc32 = header.get("crc32").and_then(|x| x.as_u64()).map(|n| n as u32);
+                        let eof = header.get("eof").and_then(|x| x.as_bool()).unwrap_or(false);
+                        match write_upload_chunk(Path::new(path), offset, data, crc32).await {
+                            Ok(new_offset) => {
+                                // 每块确认一次，服务端据此推进发送窗口；最后一块直接回传结果
+                                if eof {
+                                    let _ = socket.emit("upload_file_result", json!({
+                                        "uuid": uuid,
+                                        "transfer_id": transfer_id,
+                                        "success": true,
+                                        "path": path,
+                                    })).await;
+                                } else {
+                                    let _ = socket.emit("upload_file_ack", json!({
+                                        "uuid": uuid,
+                                        "transfer_id": transfer_id,
+                                        "offset": new_offset,
+                                    })).await;
+                                }
+                            }
+                            Err(e) => {
+                                let _ = socket.emit("upload_file_result", json!({
+                                    "uuid": uuid,
+                                    "transfer_id": transfer_id,
+                                    "success": false,
+                                    "path": path,
+                                    "error": e.to_string(),
+                                })).await;
+                            }
+                        }
+                    })
+                }
+            })
             .on("download_file", {
                 let uuid = client_uuid.clone();
+                let binary_payloads = binary_payloads.clone();
                 move |payload: Payload, socket| {
                     let uuid = uuid.clone();
+                    let binary = binary_payloads.load(Ordering::Relaxed);
                     Box::pin(async move {
                         let v = extract_first_json(payload);
                         if let Some(val) = v {
                             let path = val.get("path").and_then(|x| x.as_str()).unwrap_or("");
-                            let res = download_file_as_base64(Path::new(path)).await;
-                            match res {
-                                Ok(b64) => {
+                            // 新协议：携带 transfer_id 时按分块二进制帧发送，支持从 offset 续传
+                            if let Some(transfer_id) = val.get("transfer_id").and_then(|x| x.as_str()) {
+                                let offset = val.get("offset").and_then(|x| x.as_u64()).unwrap_or(0);
+                                let chunk_size = val.get("chunk_size").and_then(|x| x.as_u64())
+                                    .map(|n| (n as usize).clamp(1, MAX_DOWNLOAD_CHUNK_SIZE))
+                                    .unwrap_or(DEFAULT_DOWNLOAD_CHUNK_SIZE);
+                                let digest_first = val.get("digest_first").and_then(|x| x.as_bool()).unwrap_or(false);
+                                // 分块发送需要等待服务端确认，而确认要由 socket 的事件循环投递；
+                                // 在回调里直接 await 会阻塞事件循环，确认只能等到超时，因此放到独立任务中执行
+                                tokio::spawn(serve_download_transfer(socket, uuid, transfer_id.to_string(), path.to_string(), offset, chunk_size, digest_first));
+                                return;
+                            }
+                            // 旧协议：整文件一次回传（二进制帧或 base64）
+                            match tokio::fs::read(path).await {
+                                Ok(data) if binary => {
+                                    let header = json!({"uuid": uuid, "success": true, "path": path});
+                                    let _ = socket.emit("download_file_result", pack_binary_frame(&header, &data)).await;
+                                }
+                                Ok(data) => {
                                     let _ = socket.emit("download_file_result", json!({
                                         "uuid": uuid,
                                         "success": true,
                                         "path": path,
-                                        "file_base64": b64,
+                                        "file_base64": general_purpose::STANDARD.encode(data),
                                     })).await;
                                 }
                                 Err(e) => {
@@ -675,21 +1342,42 @@ async fn main() -> Result<()> {
                     })
                 }
             })
-            .on("error", |err: Payload, _socket| {
-                Box::pin(async move {
-                    eprintln!("socket error: {:?}", err);
-                })
+            .on("error", {
+                let retry_after_ms = retry_after_ms.clone();
+                let refused = refused.clone();
+                move |err: Payload, _socket| {
+                    let retry_after_ms = retry_after_ms.clone();
+                    let refused = refused.clone();
+                    Box::pin(async move {
+                        eprintln!("socket error: {:?}", err);
+                        if let Some(secs) = extract_retry_after(&err) {
+                            retry_after_ms.store((secs * 1000.0) as u64, Ordering::Relaxed);
+                            refused.notify_one();
+                        }
+                    })
+                }
             });
 
         match builder.connect().await {
-            Ok(_socket) => {
+            Ok(socket) => {
                 println!("connected. uuid registered.");
-                // 简单阻塞，等待服务器端断开，由 rust_socketio 自动重连
-                loop { sleep(Duration::from_secs(60)).await; }
+                // 等待服务器端断开，由 rust_socketio 自动重连；握手被拒绝（含自动重连时）则停止自动重连，
+                // 按服务端给出的 retry_after 加不超过 20% 的抖动等待后重新建立连接
+                loop {
+                    refused.notified().await;
+                    let delay = retry_after_ms.swap(0, Ordering::Relaxed);
+                    if delay > 0 {
+                        let _ = socket.disconnect().await;
+                        let delay = delay + jitter_ms(delay / 5);
+                        println!("server busy, reconnecting in {} ms", delay);
+                        sleep(Duration::from_millis(delay)).await;
+                        break;
+                    }
+                }
             }
             Err(e) => {
                 eprintln!("connect failed: {}", e);
-                sleep(Duration::from_secs(5)).await;
+                sleep(Duration::from_millis(5000 + jitter_ms(5000))).await;
             }
         }
     }
@@ -0,0 +1,41 @@
+"""客户端握手准入控制
+
+令牌桶限制每秒接受的握手数（允许 burst 的突发），并限制同时进行中的握手数（从接受到连接后的续传、
+离线队列下发等收尾工作完成）。拒绝时给出 retry_after：被拒绝的握手按令牌产生速度依次预约之后的时间槽，
+服务端重启后同时重连的大量客户端因此被摊开到 N / rate 秒内，而不是在同一时刻再次涌入。
+"""
+import time
+
+
+class AdmissionControl:
+    def __init__(self, rate, burst, max_pending, min_retry_after=1, max_retry_after=60, clock=time.monotonic):
+        self.rate = rate  # 每秒补充的令牌数
+        self.burst = burst  # 令牌桶容量
+        self.max_pending = max_pending  # 同时进行中的握手数上限
+        self.min_retry_after = min_retry_after
+        self.max_retry_after = max_retry_after
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._reserved_until = 0.0  # 已分配给被拒绝握手的最晚重试时间
+        self.pending = 0
+
+    def try_acquire(self):
+        """接受时返回 None 并占用一个进行中名额（完成后须 release）；拒绝时返回建议的重试等待秒数"""
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1 and self.pending < self.max_pending:
+            self._tokens -= 1
+            self.pending += 1
+            return None
+        # 每个被拒绝的握手顺延一个令牌间隔，超过上限后从头轮转（由客户端的随机抖动错开）
+        earliest = now + max(self.min_retry_after, (1 - self._tokens) / self.rate)
+        slot = max(self._reserved_until, earliest) + 1 / self.rate
+        if slot - now > self.max_retry_after:
+            slot = earliest
+        self._reserved_until = slot
+        return slot - now
+
+    def release(self):
+        self.pending = max(0, self.pending - 1)
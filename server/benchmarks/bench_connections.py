@@ -0,0 +1,154 @@
+"""连接表与握手准入基准：不建立真实连接，测量每个连接的登记内存与查询耗时，并模拟重连风暴下的准入过程
+
+用法（在 server 目录下）：python benchmarks/bench_connections.py [--sizes 10000,50000] [--ips 200]
+                                                                  [--rate 500] [--burst 1000] [--max-pending 1000]
+
+内存：分别以旧版每连接一个 dict（connect_time 为 datetime，tags 为列表，另有 {uuid: sid} 映射）与 ConnectionTable
+登记 N 个连接，用 tracemalloc 统计登记后保留的字节数（含 sid / uuid / ip 字符串；客户端分布在 --ips 个出口 IP 后）。
+查询：统计控制台数、列出某 IP 的连接，旧版为遍历全部连接（按 UUID 查连接两者都是一次字典查找）。
+准入：N 个客户端在同一时刻重连（服务端重启），被拒绝的客户端按 retry_after 加不超过 20% 的抖动重试，
+每个握手的收尾耗时 --handshake-ms；以模拟时钟统计全部连上的用时、每秒接受数峰值与拒绝次数。
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid as uuid_lib
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionControl  # noqa: E402
+from connections import ConnectionTable, WEB  # noqa: E402
+
+
+def make_connections(n, ips, seed=0):
+    """每次调用都生成新的字符串对象，与每个连接从 environ / auth JSON 中解析出的一样"""
+    rnd = random.Random(seed)
+    for i in range(n):
+        sid = ''.join(rnd.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-', k=20))
+        ip = '.'.join(str(x) for x in (10, 20, i % ips // 250, i % ips % 250))
+        yield sid, str(uuid_lib.UUID(int=rnd.getrandbits(128))), ip, json.loads('["office", "bench"]')
+
+
+def build_legacy(n, ips):
+    clients, mapping = {}, {}
+    for sid, client_uuid, ip, tags in make_connections(n, ips):
+        clients[sid] = {
+            'uuid': client_uuid,
+            'connect_time': datetime.now(),
+            'ip': ip,
+            'tags': tags,
+            'type': 'agent',
+            'compression': 'zlib',
+            'binary': True,
+            'batch': True
+        }
+        mapping[client_uuid] = sid
+    return clients, mapping
+
+
+def build_table(n, ips):
+    table = ConnectionTable()
+    for sid, client_uuid, ip, tags in make_connections(n, ips):
+        table.add(sid, ip, uuid=client_uuid, tags=tags, compression='zlib', binary=True, batch=True)
+    return table
+
+
+def retained_bytes(build, n, ips):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(n, ips)
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return retained, result
+
+
+def best_of(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_memory(n, ips):
+    legacy_bytes, (clients, _) = retained_bytes(build_legacy, n, ips)
+    table_bytes, table = retained_bytes(build_table, n, ips)
+    some_ip = next(iter(clients.values()))['ip']
+    legacy_queries = {
+        'web': lambda: sum(1 for info in clients.values() if info['type'] == 'web'),
+        'ip': lambda: [sid for sid, info in clients.items() if info['ip'] == some_ip],
+    }
+    table_queries = {
+        'web': lambda: table.count(WEB),
+        'ip': lambda: table.sids_for_ip(some_ip),
+    }
+    print(f'{n:>7} {legacy_bytes / n:11.0f} {table_bytes / n:11.0f} {legacy_bytes / table_bytes:6.2f}x'
+          + ''.join(f' {best_of(legacy_queries[k]) * 1e6:10.1f} {best_of(table_queries[k]) * 1e6:8.1f}'
+                    for k in ('web', 'ip')))
+
+
+def simulate_herd(n, rate, burst, max_pending, handshake_s, seed=0):
+    """返回 (全部连上的用时, 每秒接受数峰值, 拒绝总次数, 单个客户端最多被拒绝次数)；rate 为 None 时不做准入控制"""
+    rnd = random.Random(seed)
+    now = [0.0]
+    admission = AdmissionControl(rate, burst, max_pending, clock=lambda: now[0]) if rate else None
+    events = [(0.0, 0, i) for i in range(n)]  # (时间, 类型 0=握手 1=收尾完成, 客户端)
+    heapq.heapify(events)
+    refusals = [0] * n
+    accepted_per_second = {}
+    connected, finished_at = 0, 0.0
+    while events:
+        now[0], kind, agent = heapq.heappop(events)
+        if kind == 1:
+            admission.release()
+            continue
+        retry_after = admission.try_acquire() if admission else None
+        if retry_after is None:
+            second = int(now[0])
+            accepted_per_second[second] = accepted_per_second.get(second, 0) + 1
+            connected += 1
+            finished_at = now[0]
+            if admission:
+                heapq.heappush(events, (now[0] + handshake_s, 1, agent))
+        else:
+            refusals[agent] += 1
+            heapq.heappush(events, (now[0] + retry_after * (1 + rnd.random() * 0.2), 0, agent))
+    return finished_at, max(accepted_per_second.values()), sum(refusals), max(refusals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='连接表与握手准入基准')
+    parser.add_argument('--sizes', default='10000,50000', help='连接数')
+    parser.add_argument('--ips', type=int, default=200, help='客户端的出口 IP 数')
+    parser.add_argument('--rate', type=float, default=500, help='准入：每秒接受的握手数（HANDSHAKE_RATE）')
+    parser.add_argument('--burst', type=int, default=1000, help='准入：令牌桶容量（HANDSHAKE_BURST）')
+    parser.add_argument('--max-pending', type=int, default=1000, help='准入：进行中的握手数上限（HANDSHAKE_MAX_PENDING）')
+    parser.add_argument('--handshake-ms', type=float, default=5, help='准入：每个握手的收尾耗时（毫秒）')
+    args = parser.parse_args()
+    sizes = [int(x) for x in args.sizes.split(',')]
+
+    print('每个连接的登记内存（字节）与查询耗时（微秒）')
+    print(f'{"连接数":>7} {"旧版dict":>11} {"连接表":>11} {"节省":>7}'
+          f' {"控制台数旧":>10} {"新":>8} {"按IP旧":>10} {"新":>8}')
+    for n in sizes:
+        bench_memory(n, args.ips)
+
+    print()
+    print(f'重连风暴（rate={args.rate:g}/s burst={args.burst} max_pending={args.max_pending}）')
+    print(f'{"客户端数":>8} {"准入":>6} {"全部连上(s)":>12} {"每秒接受峰值":>12} {"拒绝次数":>10} {"单客户端最多":>12}')
+    for n in sizes:
+        for label, rate in (('无', None), ('有', args.rate)):
+            elapsed, peak, refused, worst = simulate_herd(n, rate, args.burst, args.max_pending,
+                                                          args.handshake_ms / 1000)
+            print(f'{n:>8} {label:>6} {elapsed:12.1f} {peak:12} {refused:10} {worst:12}')
+
+
+if __name__ == '__main__':
+    main()
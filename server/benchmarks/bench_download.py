@@ -0,0 +1,196 @@
+"""下载发送基准：对比原 /download 实现（send_from_directory，经 Python 分块读取）与 sendfile 路径
+
+用法（在 server 目录下）：python benchmarks/bench_download.py [--size 512M] [--clients 1,4] [--gzip]
+
+在子进程中以 eventlet WSGI 启动服务端（与生产相同的 main.app），把测试文件存入下载存储，
+另注册 /legacy/<name> 路由作为原实现的对照；子进程内有一个每 10ms 唤醒一次的协程，记录事件循环的最大延迟。
+父进程用多个线程并发下载完整文件，统计总吞吐与下载期间的事件循环延迟，并校验 Range 续传返回的数据。
+--gzip 时使用可压缩的文本内容，另测发送预压缩版本（Accept-Encoding: gzip）的情况。
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'bench'
+
+
+def make_file(path, size, compressible):
+    rnd = random.Random(0)
+    block = 1024 * 1024
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            n = min(block, size - written)
+            if compressible:
+                line = f'2024-05-01 12:00:{rnd.randint(0, 59):02d} INFO worker-{rnd.randint(0, 15)} request ok\r\n'
+                data = (line.encode() * (n // len(line) + 1))[:n]
+            else:
+                data = rnd.randbytes(n)
+            f.write(data)
+            written += n
+
+
+def serve(port_queue, download_dir, source_path, precompress):
+    """子进程：启动 eventlet WSGI 服务端并登记测试文件"""
+    import eventlet
+    from eventlet import wsgi
+    os.environ.update({'DOWNLOAD_DIR': download_dir, 'ADMIN_PASSWORD': PASSWORD,
+                       'HISTORY_DB': os.path.join(download_dir, 'history.db')})
+    sys.path.insert(0, SERVER_DIR)
+    import main
+    from flask import send_from_directory
+
+    hasher = hashlib.sha256()
+    with open(source_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    digest = hasher.hexdigest()
+    size = os.path.getsize(source_path)
+    temp_path = os.path.join(download_dir, 'bench.tmp')
+    os.link(source_path, temp_path)
+    record, _ = main.download_store.add_file(temp_path, digest, size, 'bench', source_path, 'bench.bin')
+    if precompress:
+        main._precompress_download(digest)
+    blob_path = record['blob_path']
+
+    @main.app.route('/legacy/<path:filename>')
+    def legacy_download(filename):
+        # 原 download_saved_file 的实现（对照）
+        return send_from_directory(os.path.dirname(blob_path), os.path.basename(blob_path), as_attachment=True)
+
+    lag = {'max': 0.0}
+
+    @main.app.route('/bench/lag')
+    def bench_lag():
+        value, lag['max'] = lag['max'], 0.0
+        return {'max_lag_ms': value * 1000}
+
+    def monitor():
+        while True:
+            start = time.perf_counter()
+            eventlet.sleep(0.01)
+            lag['max'] = max(lag['max'], time.perf_counter() - start - 0.01)
+
+    eventlet.spawn(monitor)
+    listener = eventlet.listen(('127.0.0.1', 0))
+    port_queue.put((listener.getsockname()[1], f"/download/{record['id']}/bench.bin", digest))
+    wsgi.server(listener, main.app, log_output=False)
+
+
+def login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/login', urllib.parse.urlencode({'password': PASSWORD}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    resp = conn.getresponse()
+    resp.read()
+    cookie = resp.getheader('Set-Cookie').split(';', 1)[0]
+    conn.close()
+    return cookie
+
+
+def fetch(port, path, headers, digest=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    conn.request('GET', path, headers=headers)
+    resp = conn.getresponse()
+    hasher = hashlib.sha256() if digest else None
+    total = 0
+    while True:
+        data = resp.read(1024 * 1024)
+        if not data:
+            break
+        total += len(data)
+        if hasher:
+            hasher.update(data)
+    conn.close()
+    if hasher and hasher.hexdigest() != digest:
+        raise AssertionError('下载内容校验失败')
+    return resp.status, total, dict(resp.getheaders())
+
+
+def run_case(port, path, headers, clients):
+    results = []
+
+    def worker():
+        results.append(fetch(port, path, headers))
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return sum(r[1] for r in results), elapsed
+
+
+def read_lag(port, headers):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/bench/lag', headers=headers)
+    value = json.loads(conn.getresponse().read())['max_lag_ms']
+    conn.close()
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='下载发送基准')
+    parser.add_argument('--size', default='512M', help='测试文件大小（支持 K/M/G 后缀）')
+    parser.add_argument('--clients', default='1,4', help='并发下载数，逗号分隔')
+    parser.add_argument('--gzip', action='store_true', help='使用可压缩内容并测试预压缩版本')
+    args = parser.parse_args()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    label = args.size.strip().upper()
+    size = int(label[:-1]) * units[label[-1]] if label[-1] in units else int(label)
+
+    workdir = tempfile.mkdtemp(prefix='bench_download_')
+    source_path = os.path.join(workdir, 'source.bin')
+    make_file(source_path, size, args.gzip)
+    ctx = multiprocessing.get_context('spawn')
+    port_queue = ctx.Queue()
+    server = ctx.Process(target=serve, args=(port_queue, os.path.join(workdir, 'downloads'), source_path, args.gzip),
+                         daemon=True)
+    server.start()
+    try:
+        port, store_path, digest = port_queue.get(timeout=120)
+        headers = {'Cookie': login(port)}
+
+        # 正确性：完整下载与 Range 续传
+        status, total, _ = fetch(port, store_path, headers, digest)
+        assert status == 200 and total == size, (status, total)
+        with open(source_path, 'rb') as f:
+            f.seek(size // 2)
+            expected_tail = hashlib.sha256(f.read()).hexdigest()
+        status, total, resp_headers = fetch(port, store_path, {**headers, 'Range': f'bytes={size // 2}-'},
+                                            expected_tail)
+        assert status == 206 and total == size - size // 2, (status, total)
+        print(f'结果校验通过（完整下载 + Range 续传，{resp_headers.get("Accept-Ranges")}）')
+
+        cases = [('原实现', '/legacy/bench.bin', headers), ('sendfile', store_path, headers)]
+        if args.gzip:
+            cases.append(('预压缩 gzip', store_path, {**headers, 'Accept-Encoding': 'gzip'}))
+        print(f'{"实现":<12} {"并发":>4} {"耗时(s)":>8} {"传输(MB)":>9} {"文件吞吐(MB/s)":>15} {"循环最大延迟(ms)":>17}')
+        for name, path, case_headers in cases:
+            for clients in (int(c) for c in args.clients.split(',')):
+                read_lag(port, headers)  # 清零
+                transferred, elapsed = run_case(port, path, case_headers, clients)
+                max_lag = read_lag(port, headers)
+                print(f'{name:<12} {clients:>4} {elapsed:8.2f} {transferred / 1024 ** 2:9.1f}'
+                      f' {size * clients / elapsed / 1024 ** 2:15.1f} {max_lag:17.1f}')
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
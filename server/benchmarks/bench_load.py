@@ -0,0 +1,895 @@
+"""负载基准：在本机启动服务端，模拟 N 个客户端 Agent 与 M 个控制台，测量延迟分位数、吞吐与服务端内存
+
+依赖：除服务端依赖外，模拟客户端需要 wsproto（pip install wsproto），它不是服务端的运行依赖。
+
+用法（在 server 目录下）：
+  python benchmarks/bench_load.py [--agents 200] [--consoles 4] [--scenarios connect,reconnect,command,transfer,screenshot,mixed,offline]
+                                  [--json result.json] [--baseline result.json]
+
+服务端在子进程中以与 socketio.run 相同的 eventlet WSGI 方式运行（main.app，数据目录为临时目录）。
+模拟客户端按 client/src/main.rs 的协议收发：握手 auth 注册并补发 register_client，run_command → command_output，
+screenshot → screenshot_result（二进制帧，--legacy 时为 base64），download_file → download_file_digest 与
+download_file_chunk 二进制分块。控制台加入 web_clients 并发起请求，按收到结果的时间计算往返延迟。
+
+场景：
+  connect     N 个客户端同时连接：连接用时（含被准入控制拒绝后按 retry_after 等待的时间）、被拒绝次数、
+              每个连接占用的服务端内存（RSS 增量 / N），以及控制台看到全部客户端所需的时间
+  reconnect   全部客户端同时断开并立即重连（重连风暴）
+  command     每个控制台每轮向全部客户端各发一条命令（扇出），统计 execute_command → command_response 往返，
+              以及控制台收到客户端原样压缩数据（未经服务端解压）的结果数
+  transfer    控制台并发从多个客户端下载文件，统计请求到 file_download_response 的时间与传输吞吐
+  screenshot  控制台以固定并发持续请求截图（不使用缓存），统计往返与吞吐
+  mixed       向 --concurrency 个客户端各并发上传 --writes 个文件（/upload），上传期间向它们逐条执行命令，统计命令往返
+              （配合 --agent-bandwidth 模拟慢速客户端，上传分块才会在服务端积压）
+  offline     断开 --concurrency 个客户端，向每个排队 --queued 条命令（queue_if_offline），重连后统计全部结果回传的用时
+              （往返从重连开始计算；客户端声明 batch 时服务端以 run_batch 成批下发，--legacy 时逐条下发）
+每个场景同时采样服务端 RSS（/proc）与 /metrics 中的事件循环延迟。--json 保存结果，--baseline 与保存的结果逐项对比。
+"""
+import argparse
+import base64
+import hashlib
+import http.client
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import zlib
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS_TOKEN = 'bench'
+PASSWORD = 'bench'
+CHUNK_SIZE = 256 * 1024  # 与服务端 DOWNLOAD_CHUNK_SIZE 默认值一致
+
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    return int(text[:-1]) * units[text[-1]] if text[-1] in units else int(text)
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(workdir):
+    """子进程：启动服务端，把监听端口写到 stdout"""
+    import eventlet
+    from eventlet import wsgi
+    raise_fd_limit()
+    os.environ.update({'DOWNLOAD_DIR': os.path.join(workdir, 'downloads'), 'ADMIN_PASSWORD': PASSWORD,
+                       'HISTORY_DB': os.path.join(workdir, 'history.db'), 'METRICS_TOKEN': METRICS_TOKEN,
+                       'UPLOAD_STAGING_DIR': os.path.join(workdir, 'upload_staging'),
+                       'OFFLINE_QUEUE_DB': os.path.join(workdir, 'offline_queue.db')})
+    sys.path.insert(0, SERVER_DIR)
+    import main
+    listener = eventlet.listen(('127.0.0.1', 0), backlog=1024)
+    print(listener.getsockname()[1], flush=True)
+    wsgi.server(listener, main.app, log_output=False, max_size=main.MAX_CONNECTIONS)
+
+
+# ============ 最小 Socket.IO 客户端 ============
+
+class WebSocket:
+    """基于 wsproto 的 websocket 客户端，直接读写（eventlet 协程化的）socket，不创建读线程
+    read_rate（字节/秒）限制接收速度，模拟慢速链路上的客户端"""
+
+    def __init__(self, port, target, timeout=30, read_rate=None):
+        import socket
+        from wsproto import ConnectionType, WSConnection
+        from wsproto.events import AcceptConnection, Request
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+        self.conn = WSConnection(ConnectionType.CLIENT)
+        self.messages = []
+        self._parts = []
+        self.closed = False
+        self.read_rate = read_rate
+        self.sock.sendall(self.conn.send(Request(host=f'127.0.0.1:{port}', target=target)))
+        while not any(isinstance(event, AcceptConnection) for event in self._read()):
+            if self.closed:
+                raise ConnectionError('websocket 握手失败')
+
+    def _read(self):
+        """读取一次 socket 并处理其中的帧，返回收到的事件"""
+        from wsproto.events import CloseConnection, Message, Ping
+        data = self.sock.recv(65536 if self.read_rate else 262144)
+        if not data:
+            self.closed = True
+            return []
+        if self.read_rate:
+            time.sleep(len(data) / self.read_rate)
+        self.conn.receive_data(data)
+        events = list(self.conn.events())
+        for event in events:
+            if isinstance(event, Message):
+                self._parts.append(event.data)
+                if event.message_finished:
+                    joined = (b'' if isinstance(event.data, bytes) else '').join(self._parts)
+                    self._parts = []
+                    self.messages.append(joined)
+            elif isinstance(event, Ping):
+                self.sock.sendall(self.conn.send(event.response()))
+            elif isinstance(event, CloseConnection):
+                self.closed = True
+        return events
+
+    def receive(self, timeout=None):
+        """返回下一条消息（str 或 bytes）；超时返回 None，连接关闭时抛出 ConnectionError"""
+        import socket
+        self.sock.settimeout(timeout)
+        while not self.messages:
+            if self.closed:
+                raise ConnectionError('websocket 已关闭')
+            try:
+                self._read()
+            except socket.timeout:
+                return None
+        return self.messages.pop(0)
+
+    def send(self, data):
+        from wsproto.events import BytesMessage, TextMessage
+        message = BytesMessage(data=data) if isinstance(data, bytes) else TextMessage(data=data)
+        self.sock.sendall(self.conn.send(message))
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+class ConnectionRefused(ConnectionError):
+    """服务端拒绝 Socket.IO 连接（CONNECT_ERROR）；准入控制拒绝时 data 中带 retry_after"""
+
+    def __init__(self, payload):
+        super().__init__(f'Socket.IO 连接被拒绝: {payload.get("message")}')
+        self.data = payload.get('data') or {}
+
+
+class SocketIOClient:
+    """Socket.IO v5 客户端的最小实现（Engine.IO v4，仅 websocket 传输，默认命名空间），
+    支持事件、二进制附件与确认；每个连接一个读取协程，收到的事件在新协程中处理"""
+
+    def __init__(self, port, auth=None, read_rate=None):
+        self.port = port
+        self.auth = auth
+        self.read_rate = read_rate
+        self.sid = None
+        self.handlers = {}
+        self.ws = None
+        self._send_lock = None
+        self._acks = {}
+        self._ack_id = 0
+        self._binary = None  # 正在接收附件的二进制包 [类型, 确认ID, 数据, 附件数, 已收到的附件]
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+
+    def connect(self, timeout=30):
+        """完成 websocket 与 Socket.IO 握手，返回握手耗时（秒）"""
+        import eventlet
+        from eventlet.semaphore import Semaphore
+        start = time.perf_counter()
+        self.ws = WebSocket(self.port, '/socket.io/?EIO=4&transport=websocket', timeout, self.read_rate)
+        self._send_lock = Semaphore()
+        opened = self.ws.receive(timeout=timeout)
+        if not opened or not opened.startswith('0'):
+            raise ConnectionError(f'Engine.IO 握手失败: {opened!r}')
+        self._send('40' + (json.dumps(self.auth, separators=(',', ':')) if self.auth else ''))
+        while True:
+            message = self.ws.receive(timeout=timeout)
+            if message is None:
+                raise ConnectionError('Socket.IO 握手超时')
+            if message == '2':
+                self._send('3')
+            elif message.startswith('40'):
+                self.sid = json.loads(message[2:] or '{}').get('sid')
+                break
+            elif message.startswith('44'):
+                raise ConnectionRefused(json.loads(message[2:] or '{}'))
+        elapsed = time.perf_counter() - start
+        eventlet.spawn(self._read_loop)
+        return elapsed
+
+    def close(self):
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+    def _send(self, *frames):
+        with self._send_lock:
+            for frame in frames:
+                self.ws.send(frame)
+
+    def emit(self, event, *args, callback=None):
+        attachments = []
+
+        def encode(value):
+            if isinstance(value, (bytes, bytearray)):
+                attachments.append(bytes(value))
+                return {'_placeholder': True, 'num': len(attachments) - 1}
+            return value
+
+        data = [event] + [encode(arg) for arg in args]
+        ack = ''
+        if callback:
+            self._ack_id += 1
+            ack = str(self._ack_id)
+            self._acks[self._ack_id] = callback
+        body = json.dumps(data, separators=(',', ':'))
+        if attachments:
+            self._send(f'45{len(attachments)}-{ack}{body}', *attachments)
+        else:
+            self._send(f'42{ack}{body}')
+
+    def _read_loop(self):
+        import eventlet
+        while True:
+            try:
+                message = self.ws.receive()
+            except Exception:
+                return
+            if isinstance(message, bytes):
+                if self._binary:
+                    self._binary[4].append(message)
+                    if len(self._binary[4]) == self._binary[3]:
+                        kind, ack_id, data, _, parts = self._binary
+                        self._binary = None
+                        self._dispatch(kind, ack_id, self._fill(data, parts), eventlet)
+                continue
+            if message == '2':
+                self._send('3')
+                continue
+            if not message.startswith('4') or len(message) < 2:
+                continue
+            kind, rest = message[1], message[2:]
+            if kind not in '2356':
+                continue
+            count = 0
+            if kind in '56':
+                dash = rest.index('-')
+                count, rest = int(rest[:dash]), rest[dash + 1:]
+            digits = 0
+            while digits < len(rest) and rest[digits].isdigit():
+                digits += 1
+            ack_id = int(rest[:digits]) if digits else None
+            data = json.loads(rest[digits:]) if rest[digits:] else []
+            if count:
+                self._binary = [kind, ack_id, data, count, []]
+            else:
+                self._dispatch(kind, ack_id, data, eventlet)
+
+    def _fill(self, value, parts):
+        if isinstance(value, dict):
+            if value.get('_placeholder'):
+                return parts[value['num']]
+            return {key: self._fill(item, parts) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._fill(item, parts) for item in value]
+        return value
+
+    def _dispatch(self, kind, ack_id, data, eventlet):
+        if kind in '36':
+            callback = self._acks.pop(ack_id, None)
+            if callback:
+                eventlet.spawn(callback, *data)
+            return
+        handler = self.handlers.get(data[0]) if data else None
+        if handler:
+            eventlet.spawn(handler, *data[1:])
+
+
+# ============ 模拟客户端与控制台 ============
+
+def file_content(path, size):
+    """按路径生成文件内容：每个路径的内容不同（避免下载存储去重），大部分字节共享以节省内存"""
+    block = SimAgent.BLOCK
+    prefix = hashlib.sha256(path.encode()).digest()
+    body = (block * (size // len(block) + 1))[:max(0, size - len(prefix))]
+    return (prefix + body)[:size]
+
+
+class SimAgent:
+    """按 client/src/main.rs 的协议应答服务端请求"""
+    BLOCK = random.Random(0).randbytes(1024 * 1024)
+
+    def __init__(self, port, uuid, opts):
+        self.port = port
+        self.uuid = uuid
+        self.opts = opts
+        self.client = None
+        self.binary = False
+        self.compression = 0  # 服务端协商的压缩阈值（字节），0 表示不压缩
+        self.refusals = 0  # 被准入控制拒绝的次数
+        self._digests = {}
+
+    def connect(self):
+        """连接并注册，返回从开始到连接成功的用时（含被拒绝后按 retry_after 等待的时间）"""
+        import eventlet
+        capabilities = {} if self.opts.legacy else {'compression': ['zlib'], 'binary': True, 'batch': True}
+        start = time.perf_counter()
+        while True:
+            self.client = SocketIOClient(self.port, {'uuid': self.uuid, 'tags': ['bench'],
+                                                     'capabilities': capabilities}, self.opts.agent_bandwidth)
+            self.binary, self.compression = False, 0
+            for event in ('server_capabilities', 'run_command', 'run_batch', 'upload_file_chunk', 'screenshot',
+                          'download_file'):
+                self.client.on(event, getattr(self, 'on_' + event))
+            try:
+                self.client.connect()
+                break
+            except ConnectionRefused as e:
+                retry_after = e.data.get('retry_after')
+                if retry_after is None:
+                    raise
+                # 与真实客户端一致：断开后等待 retry_after 加不超过 20% 的随机抖动再重连
+                self.client.close()
+                self.refusals += 1
+                eventlet.sleep(retry_after * (1 + random.random() * 0.2))
+        # 与真实客户端一致：连接成功后冗余发送一次事件注册
+        self.client.emit('register_client', {'uuid': self.uuid})
+        return time.perf_counter() - start
+
+    def close(self):
+        if self.client:
+            self.client.close()
+
+    def on_server_capabilities(self, data):
+        self.binary = bool(data.get('binary'))
+        self.compression = (data.get('threshold') or 1024) if data.get('compression') == 'zlib' else 0
+
+    def on_run_command(self, data):
+        import eventlet
+        if self.opts.exec_ms:
+            eventlet.sleep(self.opts.exec_ms / 1000)
+        command = data.get('command', '')
+        output = (command + '\n' + 'x' * self.opts.output_size)[:max(self.opts.output_size, len(command) + 1)]
+        # 与真实客户端一致：输出已清理（clean），达到阈值时 output/error 以 zlib 压缩帧发送
+        msg = {'uuid': self.uuid, 'request_id': data.get('request_id'), 'command': command, 'clean': True}
+        fields = json.dumps({'output': output, 'error': ''}).encode()
+        if self.compression and len(fields) >= self.compression:
+            header = json.dumps({**msg, 'encoding': 'zlib'}).encode()
+            self.client.emit('command_output', len(header).to_bytes(4, 'big') + header + zlib.compress(fields, 1))
+        else:
+            self.client.emit('command_output', {**msg, 'output': output, 'error': ''})
+
+    def on_run_batch(self, data):
+        # 与真实客户端一致：批内按顺序逐条执行
+        for item in data.get('items', []):
+            if item.get('event') == 'run_command':
+                self.on_run_command(item.get('data') or {})
+
+    def on_upload_file_chunk(self, frame):
+        # 不落盘：每块确认一次，最后一块直接回传结果
+        length = int.from_bytes(frame[:4], 'big')
+        header = json.loads(frame[4:4 + length])
+        if header.get('eof'):
+            self.client.emit('upload_file_result', {'uuid': self.uuid, 'transfer_id': header['transfer_id'],
+                                                    'success': True, 'path': header['path']})
+        else:
+            self.client.emit('upload_file_ack', {'uuid': self.uuid, 'transfer_id': header['transfer_id'],
+                                                 'offset': header['offset'] + header['length']})
+
+    def on_screenshot(self, data):
+        png = b'\x89PNG\r\n\x1a\n' + random.randbytes(self.opts.screenshot_size)
+        if self.binary:
+            header = json.dumps({'uuid': self.uuid, 'request_id': data.get('request_id'), 'success': True}).encode()
+            self.client.emit('screenshot_result', len(header).to_bytes(4, 'big') + header + png)
+        else:
+            self.client.emit('screenshot_result', {'uuid': self.uuid, 'request_id': data.get('request_id'),
+                                                   'success': True, 'image_base64': base64.b64encode(png).decode()})
+
+    def on_download_file(self, data):
+        path = data.get('path', '')
+        size = int(path.rsplit('_', 1)[-1].split('.')[0])
+        transfer_id = data.get('transfer_id')
+        if data.get('digest_first'):
+            if path not in self._digests:
+                self._digests[path] = hashlib.sha256(file_content(path, size)).hexdigest()
+            self.client.emit('download_file_digest', {'uuid': self.uuid, 'transfer_id': transfer_id,
+                                                      'sha256': self._digests[path], 'size': size})
+            return
+        content = file_content(path, size)
+        offset = min(int(data.get('offset') or 0), size)
+        chunk_size = int(data.get('chunk_size') or CHUNK_SIZE)
+        while True:
+            chunk = content[offset:offset + chunk_size]
+            eof = offset + len(chunk) >= size
+            header = json.dumps({'uuid': self.uuid, 'transfer_id': transfer_id, 'offset': offset,
+                                 'length': len(chunk), 'total_size': size, 'crc32': zlib.crc32(chunk),
+                                 'eof': eof}).encode()
+            self.client.emit('download_file_chunk', len(header).to_bytes(4, 'big') + header + chunk)
+            offset += len(chunk)
+            if eof:
+                break
+
+
+class SimConsole:
+    """模拟 Web 控制台：发起请求并按结果匹配等待者，记录往返时间"""
+
+    def __init__(self, port):
+        self.port = port
+        self.client = SocketIOClient(port)
+        self.visible = set()
+        self.visible_changed = None
+        self.waiters = {}  # {key: (start, Event)}
+        for event in ('client_list', 'client_list_delta', 'command_response', 'screenshot_response',
+                      'file_download_response', 'upload_file_response', 'request_queued'):
+            self.client.on(event, getattr(self, 'on_' + event))
+
+    def connect(self):
+        from eventlet.event import Event
+        self.visible_changed = Event()
+        self.client.connect()
+        self.client.emit('join_web_client')
+
+    def close(self):
+        self.client.close()
+
+    def _notify_visible(self):
+        if not self.visible_changed.ready():
+            self.visible_changed.send()
+
+    def on_client_list(self, data):
+        self.visible = {client['uuid'] for client in data.get('clients', [])}
+        self._notify_visible()
+
+    def on_client_list_delta(self, data):
+        self.visible.difference_update(data.get('removed', []))
+        self.visible.update(client['uuid'] for client in data.get('added', []) + data.get('changed', []))
+        self._notify_visible()
+
+    def wait_visible(self, count, timeout):
+        from eventlet.event import Event
+        deadline = time.perf_counter() + timeout
+        while len(self.visible) < count:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            self.visible_changed = Event()
+            self.visible_changed.wait(timeout=remaining)
+        return True
+
+    def request(self, key, event, payload, timeout):
+        """发出请求并等待 key 对应的结果，返回 (往返秒数, 结果)；超时返回 (None, None)"""
+        return self._wait(key, lambda: self.client.emit(event, payload), timeout)
+
+    def upload(self, cookie, target_uuid, path, body, timeout):
+        """经 HTTP /upload 流式上传到客户端，等待 upload_file_response"""
+        def send():
+            query = urllib.parse.urlencode({'target_uuid': target_uuid, 'path': path, 'sid': self.client.sid})
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+            try:
+                conn.request('POST', f'/upload?{query}', body, {'Cookie': cookie})
+                conn.getresponse().read()
+            finally:
+                conn.close()
+        return self._wait(('upload', path), send, timeout)
+
+    def _wait(self, key, send, timeout):
+        from eventlet.event import Event
+        done = Event()
+        start = time.perf_counter()
+        self.waiters[key] = (start, done)
+        send()
+        result = done.wait(timeout=timeout)
+        self.waiters.pop(key, None)
+        if result is None:
+            return None, None
+        return time.perf_counter() - start, result
+
+    def _resolve(self, key, data):
+        waiter = self.waiters.get(key)
+        if waiter and not waiter[1].ready():
+            waiter[1].send(data)
+
+    def on_command_response(self, data):
+        self._resolve(('command', data.get('command')), data)
+
+    def on_screenshot_response(self, data):
+        self._resolve(('screenshot', data.get('uuid')), data)
+
+    def on_file_download_response(self, data):
+        self._resolve(('download', data.get('path')), data)
+
+    def on_upload_file_response(self, data):
+        self._resolve(('upload', data.get('path')), data)
+
+    def on_request_queued(self, data):
+        self._resolve(('queued', data.get('command')), data)
+
+
+# ============ 采样与统计 ============
+
+class ServerSampler:
+    """场景运行期间每 0.5 秒采样服务端 RSS 与事件循环延迟（/metrics 中的 rc_eventloop_lag_seconds）"""
+
+    def __init__(self, pid, port):
+        self.pid = pid
+        self.port = port
+        self.rss_peak = 0
+        self.lag_max = 0.0
+        self._running = False
+
+    def rss(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def loop_lag(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            conn.request('GET', '/metrics', headers={'Authorization': f'Bearer {METRICS_TOKEN}'})
+            for line in conn.getresponse().read().decode().splitlines():
+                if line.startswith('rc_eventloop_lag_seconds '):
+                    return float(line.split()[1])
+        except Exception:
+            pass
+        finally:
+            conn.close()
+        return 0.0
+
+    def _run(self):
+        import eventlet
+        while self._running:
+            self.rss_peak = max(self.rss_peak, self.rss())
+            self.lag_max = max(self.lag_max, self.loop_lag())
+            eventlet.sleep(0.5)
+
+    def __enter__(self):
+        import eventlet
+        self.rss_peak, self.lag_max, self._running = self.rss(), 0.0, True
+        eventlet.spawn(self._run)
+        return self
+
+    def __exit__(self, *exc):
+        self._running = False
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def completed(results):
+    """请求结果 (往返秒数, 结果) 中成功的往返时间，以及失败（超时或 success 为假）的数量"""
+    ok = [rtt for rtt, data in results if rtt is not None and data.get('success', True)]
+    return ok, len(results) - len(ok)
+
+
+def summarize(name, latencies, errors, elapsed, sampler, transferred=0, extra=None):
+    result = {
+        'scenario': name,
+        'ops': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'max_ms': max(latencies) * 1000 if latencies else None,
+        'ops_per_s': len(latencies) / elapsed if elapsed else None,
+        'mb_per_s': transferred / elapsed / 1024 ** 2 if elapsed and transferred else None,
+        'elapsed_s': elapsed,
+        'rss_peak_mb': sampler.rss_peak / 1024 ** 2,
+        'rss_end_mb': sampler.rss() / 1024 ** 2,
+        'loop_lag_max_ms': sampler.lag_max * 1000,
+    }
+    result.update(extra or {})
+    return result
+
+
+# ============ 场景 ============
+
+def run_parallel(jobs, concurrency):
+    """以有限并发运行 jobs（无参函数），返回各自的结果"""
+    from eventlet import GreenPool
+    pool = GreenPool(concurrency)
+    return list(pool.imap(lambda job: job(), jobs))
+
+
+def scenario_connect(ctx, name='connect'):
+    opts = ctx['opts']
+    for agent in ctx['agents']:
+        agent.refusals = 0
+    with ServerSampler(ctx['pid'], ctx['port']) as sampler:
+        rss_before = sampler.rss()
+        start = time.perf_counter()
+
+        def connect(agent):
+            try:
+                return agent.connect()
+            except Exception:
+                return None
+        latencies = run_parallel([lambda a=agent: connect(a) for agent in ctx['agents']], opts.connect_concurrency)
+        visible = ctx['consoles'][0].wait_visible(len(ctx['agents']), opts.timeout)
+        elapsed = time.perf_counter() - start
+        rss_after = sampler.rss()
+    ok = [x for x in latencies if x is not None]
+    refusals = [agent.refusals for agent in ctx['agents']]
+    return summarize(name, ok, len(latencies) - len(ok), elapsed, sampler,
+                     extra={'all_visible_s': elapsed if visible else None,
+                            'refusals': sum(refusals), 'max_refusals_per_agent': max(refusals, default=0),
+                            'rss_per_conn_kb': (rss_after - rss_before) / 1024 / len(ok) if ok and name == 'connect'
+                            else None})
+
+
+def scenario_reconnect(ctx):
+    for agent in ctx['agents']:
+        agent.close()
+    return scenario_connect(ctx, 'reconnect')
+
+
+def scenario_command(ctx):
+    opts = ctx['opts']
+    results = []
+    with ServerSampler(ctx['pid'], ctx['port']) as sampler:
+        start = time.perf_counter()
+        for round_no in range(opts.rounds):
+            jobs = []
+            for c, console in enumerate(ctx['consoles']):
+                for agent in ctx['agents']:
+                    command = f'echo bench-{round_no}-{c}-{agent.uuid}'
+                    jobs.append(lambda console=console, agent=agent, command=command: console.request(
+                        ('command', command), 'execute_command',
+                        {'target_uuid': agent.uuid, 'command': command, 'use_shared_context': True,
+                         'compression': None if opts.legacy else 'zlib'},
+                        opts.timeout))
+            results.extend(run_parallel(jobs, len(jobs)))
+        elapsed = time.perf_counter() - start
+    latencies, errors = completed(results)
+    # 控制台声明了 zlib：达到阈值的结果应收到客户端原样的压缩数据，而不是服务端解压后的文本
+    compressed = sum(1 for rtt, data in results if rtt is not None and 'compressed' in data)
+    return summarize('command', latencies, errors, elapsed, sampler,
+                     transferred=len(latencies) * opts.output_size, extra={'compressed_responses': compressed})
+
+
+def scenario_transfer(ctx):
+    opts = ctx['opts']
+    consoles, agents = ctx['consoles'], ctx['agents']
+    jobs = []
+    for i in range(opts.transfers):
+        console, agent = consoles[i % len(consoles)], agents[i % len(agents)]
+        path = f'C:\\bench\\{agent.uuid}\\{i}_{time.time_ns()}_{opts.file_size}.bin'
+        jobs.append(lambda console=console, agent=agent, path=path: console.request(
+            ('download', path), 'download_file_from_client', {'target_uuid': agent.uuid, 'path': path},
+            opts.timeout))
+    with ServerSampler(ctx['pid'], ctx['port']) as sampler:
+        start = time.perf_counter()
+        results = run_parallel(jobs, opts.concurrency * len(consoles))
+        elapsed = time.perf_counter() - start
+    latencies, errors = completed(results)
+    return summarize('transfer', latencies, errors, elapsed, sampler, transferred=len(latencies) * opts.file_size)
+
+
+def scenario_screenshot(ctx):
+    opts = ctx['opts']
+    consoles, agents = ctx['consoles'], ctx['agents']
+    results = []
+    remaining = [opts.screenshots]
+    workers = min(opts.concurrency, len(agents))
+
+    def worker(console, offset):
+        # 客户端按序号分给同一控制台的各个并发协程：同一控制台对同一客户端同时只有一个截图请求
+        # （服务端按客户端合并进行中的截图，同一控制台的重复请求无法区分各自的结果）
+        own = agents[offset::workers]
+        index = 0
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            agent = own[index % len(own)]
+            index += 1
+            results.append(console.request(('screenshot', agent.uuid), 'screenshot',
+                                            {'target_uuid': agent.uuid, 'display_index': 0, 'max_age': 0},
+                                            opts.timeout))
+
+    jobs = [lambda console=console, n=n: worker(console, n) for console in consoles for n in range(workers)]
+    with ServerSampler(ctx['pid'], ctx['port']) as sampler:
+        start = time.perf_counter()
+        run_parallel(jobs, len(jobs))
+        elapsed = time.perf_counter() - start
+    latencies, errors = completed(results)
+    return summarize('screenshot', latencies, errors, elapsed, sampler,
+                     transferred=len(latencies) * opts.screenshot_size)
+
+
+def login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/login', urllib.parse.urlencode({'password': PASSWORD}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    return resp.getheader('Set-Cookie').split(';', 1)[0]
+
+
+def scenario_mixed(ctx):
+    """向部分客户端各并发上传多个文件（/upload 流式上传，服务端分块转发），上传期间另一个控制台向同一批客户端
+    逐条执行命令；结果为这些命令的往返时间，反映批量传输在途时交互命令的响应"""
+    import eventlet
+    opts = ctx['opts']
+    consoles, agents = ctx['consoles'], ctx['agents'][:opts.concurrency]
+    writer, commander = consoles[0], consoles[-1]
+    cookie = login(ctx['port'])
+    body = b'A' * opts.write_size
+    write_results, command_results = [], []
+
+    def write(agent, n):
+        path = f'C:\\bench\\{agent.uuid}\\upload_{n}_{time.time_ns()}.bin'
+        write_results.append(writer.upload(cookie, agent.uuid, path, body, opts.timeout))
+
+    def commands(agent):
+        eventlet.sleep(0.5)  # 等上传开始转发
+        n = 0
+        while len(write_results) < len(agents) * opts.writes:
+            n += 1
+            command = f'echo mixed-{n}-{agent.uuid}'
+            command_results.append(commander.request(
+                ('command', command), 'execute_command',
+                {'target_uuid': agent.uuid, 'command': command, 'use_shared_context': True}, opts.timeout))
+
+    jobs = [lambda agent=agent, n=n: write(agent, n) for agent in agents for n in range(opts.writes)]
+    jobs += [lambda agent=agent: commands(agent) for agent in agents]
+    with ServerSampler(ctx['pid'], ctx['port']) as sampler:
+        start = time.perf_counter()
+        run_parallel(jobs, len(jobs))
+        elapsed = time.perf_counter() - start
+    latencies, errors = completed(command_results)
+    writes_ok, write_errors = completed(write_results)
+    return summarize('mixed', latencies, errors, elapsed, sampler,
+                     transferred=len(writes_ok) * opts.write_size,
+                     extra={'writes': len(writes_ok), 'write_errors': write_errors})
+
+
+def scenario_offline(ctx):
+    """客户端离线期间排队大量命令，重连后由服务端成批下发；结果为每条命令从重连开始到收到结果的时间"""
+    import eventlet
+    opts = ctx['opts']
+    console, agents = ctx['consoles'][-1], ctx['agents'][:opts.concurrency]
+    offline = {agent.uuid for agent in agents}
+    for agent in agents:
+        agent.close()
+    deadline = time.perf_counter() + opts.timeout
+    while console.visible & offline and time.perf_counter() < deadline:
+        eventlet.sleep(0.05)
+    targets = [(agent.uuid, f'echo offline-{n}-{agent.uuid}') for agent in agents for n in range(opts.queued)]
+    commands = [command for _, command in targets]
+    enqueue_start = time.perf_counter()
+    queued = run_parallel([lambda uuid=uuid, command=command: console.request(
+        ('queued', command), 'execute_command',
+        {'target_uuid': uuid, 'command': command, 'use_shared_context': True, 'queue_if_offline': True},
+        opts.timeout) for uuid, command in targets], 100)
+    enqueue_s = time.perf_counter() - enqueue_start
+    with ServerSampler(ctx['pid'], ctx['port']) as sampler:
+        start = time.perf_counter()
+        waiters = [eventlet.spawn(console._wait, ('command', command), lambda: None, opts.timeout)
+                   for command in commands]
+        eventlet.sleep(0)
+        run_parallel([agent.connect for agent in agents], len(agents))
+        results = [waiter.wait() for waiter in waiters]
+        elapsed = time.perf_counter() - start
+    latencies, errors = completed(results)
+    return summarize('offline', latencies, errors, elapsed, sampler, transferred=len(latencies) * opts.output_size,
+                     extra={'queued': len(completed(queued)[0]), 'enqueue_s': enqueue_s})
+
+
+SCENARIOS = {'connect': scenario_connect, 'reconnect': scenario_reconnect, 'command': scenario_command,
+             'transfer': scenario_transfer, 'screenshot': scenario_screenshot, 'mixed': scenario_mixed,
+             'offline': scenario_offline}
+COLUMNS = [('p50_ms', 'p50(ms)'), ('p99_ms', 'p99(ms)'), ('ops_per_s', '次/秒'), ('mb_per_s', 'MB/s'),
+           ('rss_peak_mb', 'RSS峰值(MB)'), ('loop_lag_max_ms', '循环延迟(ms)')]
+
+
+def fmt(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+def print_header():
+    print(f'{"场景":<11} {"完成":>6} {"失败":>5} ' + ' '.join(f'{label:>12}' for _, label in COLUMNS))
+
+
+def print_results(results, baseline):
+    for result in results:
+        print(f'{result["scenario"]:<11} {result["ops"]:>6} {result["errors"]:>5} '
+              + ' '.join(f'{fmt(result[key]):>12}' for key, _ in COLUMNS))
+        if result.get('all_visible_s') is not None:
+            print(f'{"":<11} 控制台看到全部客户端用时 {result["all_visible_s"]:.2f}s')
+        if result.get('compressed_responses') is not None:
+            print(f'{"":<11} 以压缩数据转发给控制台 {result["compressed_responses"]}/{result["ops"]}')
+        if result.get('refusals'):
+            print(f'{"":<11} 握手被拒绝 {result["refusals"]} 次（单个客户端最多 {result["max_refusals_per_agent"]} 次）')
+        if result.get('rss_per_conn_kb') is not None:
+            print(f'{"":<11} 每个连接的服务端内存约 {result["rss_per_conn_kb"]:.1f} KB')
+        if result.get('queued') is not None:
+            print(f'{"":<11} 排队 {result["queued"]} 条用时 {result["enqueue_s"]:.2f}s，重连后全部回传用时 {result["elapsed_s"]:.2f}s')
+        if result.get('writes') is not None:
+            print(f'{"":<11} 同时完成上传 {result["writes"]} 个，失败 {result["write_errors"]} 个')
+        base = baseline.get(result['scenario'])
+        if base:
+            deltas = []
+            for key, label in COLUMNS:
+                if result[key] is not None and base.get(key):
+                    deltas.append(f'{label} {(result[key] - base[key]) / base[key] * 100:+.0f}%')
+            print(f'{"":<11} 相对基线: ' + ', '.join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='服务端负载基准')
+    parser.add_argument('--serve', metavar='WORKDIR', help=argparse.SUPPRESS)
+    parser.add_argument('--agents', type=int, default=200, help='模拟客户端数量')
+    parser.add_argument('--consoles', type=int, default=4, help='模拟控制台数量')
+    parser.add_argument('--scenarios', default='connect,reconnect,command,transfer,screenshot,mixed,offline')
+    parser.add_argument('--connect-concurrency', type=int, default=500, help='连接风暴中同时握手的连接数')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='command：每个控制台向全部客户端扇出的轮数')
+    parser.add_argument('--output-size', type=parse_size, default=parse_size('4K'), help='command：每条命令的输出大小')
+    parser.add_argument('--exec-ms', type=int, default=0, help='command：模拟命令执行耗时（毫秒）')
+    parser.add_argument('--transfers', type=int, default=20, help='transfer：下载文件数')
+    parser.add_argument('--file-size', type=parse_size, default=parse_size('8M'), help='transfer：单个文件大小')
+    parser.add_argument('--screenshots', type=int, default=500, help='screenshot：截图请求总数')
+    parser.add_argument('--screenshot-size', type=parse_size, default=parse_size('200K'), help='screenshot：单张 PNG 大小')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='transfer/screenshot：每个控制台的并发请求数；mixed/offline：参与的客户端数')
+    parser.add_argument('--writes', type=int, default=4, help='mixed：每个客户端同时进行的上传数')
+    parser.add_argument('--write-size', type=parse_size, default=parse_size('4M'), help='mixed：单个上传的文件大小')
+    parser.add_argument('--queued', type=int, default=1000, help='offline：每个离线客户端排队的命令数')
+    parser.add_argument('--agent-bandwidth', type=parse_size, default=None,
+                        help='限制每个模拟客户端的接收速度（字节/秒，如 2M），模拟慢速链路')
+    parser.add_argument('--legacy', action='store_true', help='模拟不支持二进制载荷的旧版客户端（截图走 base64）')
+    parser.add_argument('--timeout', type=float, default=120, help='单个请求的超时（秒）')
+    parser.add_argument('--json', help='把结果保存为 JSON，可作为后续运行的基线')
+    parser.add_argument('--baseline', help='与之前保存的 JSON 结果对比')
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+
+    import eventlet
+    eventlet.monkey_patch()
+    raise_fd_limit()
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'未知场景: {",".join(sorted(unknown))}')
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result['scenario']: result for result in json.load(f)['results']}
+
+    workdir = tempfile.mkdtemp(prefix='bench_load_')
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', workdir],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=SERVER_DIR)
+    try:
+        port = int(server.stdout.readline())
+        agents = [SimAgent(port, f'bench-{i:05d}', args) for i in range(args.agents)]
+        consoles = [SimConsole(port) for _ in range(args.consoles)]
+        for console in consoles:
+            console.connect()
+        ctx = {'opts': args, 'port': port, 'pid': server.pid, 'agents': agents, 'consoles': consoles}
+        if 'connect' not in args.scenarios.split(','):
+            scenario_connect(ctx)  # 其余场景需要客户端已连接
+        print(f'客户端 {args.agents}，控制台 {args.consoles}，{"旧版 base64" if args.legacy else "二进制载荷"}')
+        print_header()
+        results = []
+        for name in args.scenarios.split(','):
+            results.append(SCENARIOS[name](ctx))
+            print_results(results[-1:], baseline)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'options': {k: v for k, v in vars(args).items() if k not in ('json', 'baseline', 'serve')},
+                           'results': results}, f, ensure_ascii=False, indent=2)
+        for client in agents + consoles:
+            client.close()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
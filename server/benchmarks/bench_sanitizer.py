@@ -0,0 +1,130 @@
+"""输出清理基准：对比旧版按行拆分实现与 sanitizer 模块
+
+用法（在 server 目录下）：python benchmarks/bench_sanitizer.py [--sizes 1K,64K,1M,10M,50M] [--chunk 16K]
+
+生成接近真实的 PowerShell 会话输出（\\r\\n 换行、目录列表、进程表，每条命令结束处有提示符行与结束标记），
+先校验新实现与旧实现结果一致，再分别测量一次性清理与按分块流式清理的耗时。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sanitizer import OutputSanitizer, sanitize_output_text  # noqa: E402
+
+
+def legacy_sanitize_output_text(text: str) -> str:
+    """main.py 中原 _sanitize_output_text 的实现（基准对照）"""
+    try:
+        if not text:
+            return text
+        text = text.replace('\r\n', '\n')
+        cleaned_lines = []
+        for line in text.split('\n'):
+            if not line:
+                cleaned_lines.append(line)
+                continue
+            if line.startswith('__RC_END__:'):
+                continue
+            if line.startswith('PS ') and line.endswith('>'):
+                continue
+            cleaned_lines.append(line)
+        return '\n'.join(cleaned_lines).strip()
+    except Exception:
+        return text
+
+
+def make_transcript(size, seed=0):
+    rnd = random.Random(seed)
+    parts = []
+    total = 0
+    while total < size:
+        kind = rnd.random()
+        if kind < 0.5:
+            block = ['', '    目录: C:\\Users\\admin\\Documents', '',
+                     'Mode                 LastWriteTime         Length Name',
+                     '----                 -------------         ------ ----']
+            for i in range(rnd.randint(5, 40)):
+                block.append(f'-a----        2024/5/{rnd.randint(1, 28)}     {rnd.randint(0, 23):2d}:{rnd.randint(0, 59):02d}'
+                             f'        {rnd.randint(0, 10 ** 7):7d} file_{i}_{rnd.randint(0, 99999)}.txt')
+        elif kind < 0.8:
+            block = ['Handles  NPM(K)    PM(K)      WS(K)     CPU(s)     Id  SI ProcessName',
+                     '-------  ------    -----      -----     ------     --  -- -----------']
+            for _ in range(rnd.randint(5, 60)):
+                block.append(f'{rnd.randint(50, 3000):7d} {rnd.randint(5, 100):7d} {rnd.randint(1000, 500000):8d}'
+                             f' {rnd.randint(1000, 500000):10d} {rnd.random() * 100:10.2f} {rnd.randint(4, 40000):6d}'
+                             f'   1 proc{rnd.randint(0, 500)}')
+        else:
+            block = [f'Pinging 10.0.0.{rnd.randint(1, 254)} with 32 bytes of data:'] + \
+                    [f'Reply from 10.0.0.1: bytes=32 time={rnd.randint(1, 50)}ms TTL=128' for _ in range(4)]
+        # 约每 20 段输出结束一条命令：提示符行 + 结束标记
+        if rnd.random() < 0.05:
+            block.append('PS C:\\Users\\admin>')
+            block.append(f'__RC_END__:{rnd.getrandbits(64):016x}')
+        text = '\r\n'.join(block) + '\r\n'
+        parts.append(text)
+        total += len(text)
+    return ''.join(parts)[:size]
+
+
+def stream_sanitize(text, chunk_size):
+    sanitizer = OutputSanitizer()
+    out = [sanitizer.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    out.append(sanitizer.finish())
+    return ''.join(out)
+
+
+def check_correctness():
+    rnd = random.Random(42)
+    samples = [make_transcript(rnd.randint(0, 20000), seed=i) for i in range(50)]
+    samples += ['', '\r\n', 'PS C:\\>', '__RC_END__:x', 'a\r\nPS C:\\>\r\nb', 'PS >\nPS x>y\n', '  x  \r\n',
+                'a\rb\r\n__RC_END__:1\r\n', 'PS C:\\> dir\r\n',
+                '\r\n'.join(['PS C:\\>', '__RC_END__:1', 'x', ''] * 50)]
+    for text in samples:
+        assert sanitize_output_text(text) == legacy_sanitize_output_text(text), repr(text[:200])
+        for chunk_size in (1, 2, 3, 7, 64, 4096):
+            assert stream_sanitize(text, chunk_size).strip() == legacy_sanitize_output_text(text), \
+                (chunk_size, repr(text[:200]))
+
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2}
+    value = value.strip().upper()
+    return int(value[:-1]) * units[value[-1]] if value[-1] in units else int(value)
+
+
+def best_of(func, arg, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='输出清理基准')
+    parser.add_argument('--sizes', default='1K,64K,1M,10M,50M')
+    parser.add_argument('--chunk', default='16K', help='流式清理的分块大小')
+    args = parser.parse_args()
+    chunk_size = parse_size(args.chunk)
+
+    check_correctness()
+    print('结果校验通过')
+    print(f'{"大小":>8} {"旧版(ms)":>10} {"一次性(ms)":>11} {"流式(ms)":>10} {"加速比":>7} {"吞吐(MB/s)":>11}')
+    for label in args.sizes.split(','):
+        size = parse_size(label)
+        text = make_transcript(size)
+        repeat = max(3, min(200, (10 * 1024 ** 2) // max(size, 1)))
+        legacy = best_of(legacy_sanitize_output_text, text, repeat)
+        oneshot = best_of(sanitize_output_text, text, repeat)
+        streamed = best_of(lambda t: stream_sanitize(t, chunk_size), text, repeat)
+        print(f'{label:>8} {legacy * 1000:10.3f} {oneshot * 1000:11.3f} {streamed * 1000:10.3f}'
+              f' {legacy / oneshot:6.1f}x {size / oneshot / 1024 ** 2:11.1f}')
+
+
+if __name__ == '__main__':
+    main()
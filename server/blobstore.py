@@ -0,0 +1,136 @@
+"""下载文件的内容寻址存储
+
+文件内容按 SHA-256 只保存一份（blobs/<前两位>/<hash>），每次下载另记一条元数据（来源客户端、路径、文件名）
+指向对应内容；同一文件从多台客户端下载时不重复占用磁盘。
+总大小超过配额或长时间未被访问的内容按 LRU 淘汰，指向它的下载记录一并删除。
+可压缩的内容可另存一份 gzip 预压缩版本（<hash>.gz），计入配额并随原内容一同淘汰。
+"""
+import os
+import secrets
+import sqlite3
+import time
+
+
+class BlobStore:
+    def __init__(self, root, max_bytes, max_age_days=30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(root, 'store.db'), timeout=5, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS blobs '
+                         '(hash TEXT PRIMARY KEY, size INTEGER NOT NULL, created_at REAL NOT NULL, '
+                         'last_access REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS blobs_access ON blobs (last_access)')
+        try:
+            self._db.execute('ALTER TABLE blobs ADD COLUMN gz_size INTEGER')
+        except sqlite3.OperationalError:
+            pass  # 已有该列
+        self._db.execute('CREATE TABLE IF NOT EXISTS downloads '
+                         '(id TEXT PRIMARY KEY, hash TEXT NOT NULL, uuid TEXT, path TEXT, name TEXT NOT NULL, '
+                         'created_at REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS downloads_hash ON downloads (hash)')
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    def variant_path(self, digest):
+        return self.blob_path(digest) + '.gz'
+
+    def set_variant(self, digest, gz_size):
+        """登记已生成的 gzip 预压缩版本（计入配额，超出时按 LRU 淘汰）；原内容已被淘汰时删除该文件"""
+        cur = self._db.execute('UPDATE blobs SET gz_size = ? WHERE hash = ?', (gz_size, digest))
+        if cur.rowcount == 0:
+            try:
+                os.remove(self.variant_path(digest))
+            except FileNotFoundError:
+                pass
+            return False
+        self.evict()
+        return self.has(digest) is not None
+
+    def has(self, digest):
+        """内容已存在时返回其大小，否则返回 None"""
+        row = self._db.execute('SELECT size FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        if row and os.path.exists(self.blob_path(digest)):
+            return row[0]
+        return None
+
+    def total_bytes(self):
+        return self._db.execute('SELECT COALESCE(SUM(size + COALESCE(gz_size, 0)), 0) FROM blobs').fetchone()[0]
+
+    def add_file(self, temp_path, digest, size, uuid, path, name):
+        """将已下载的临时文件存入（内容已存在时直接删除临时文件），返回 (下载记录, 是否去重)"""
+        deduplicated = self.has(digest) is not None
+        if deduplicated:
+            os.remove(temp_path)
+        else:
+            if size > self.max_bytes:
+                raise ValueError('文件大小超过下载存储配额')
+            self.evict(incoming=size)
+            blob_path = self.blob_path(digest)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_path, blob_path)
+            now = time.time()
+            self._db.execute('INSERT OR REPLACE INTO blobs (hash, size, created_at, last_access) VALUES (?, ?, ?, ?)',
+                             (digest, size, now, now))
+        return self._add_record(digest, uuid, path, name), deduplicated
+
+    def add_existing(self, digest, uuid, path, name):
+        """内容已存在（客户端先上报摘要命中）时只新增下载记录；内容已被淘汰时返回 None"""
+        if self.has(digest) is None:
+            return None
+        return self._add_record(digest, uuid, path, name)
+
+    def _add_record(self, digest, uuid, path, name):
+        record_id = secrets.token_hex(8)
+        now = time.time()
+        self._db.execute('INSERT INTO downloads (id, hash, uuid, path, name, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                         (record_id, digest, uuid, path, name, now))
+        self._db.execute('UPDATE blobs SET last_access = ? WHERE hash = ?', (now, digest))
+        return self.get(record_id, touch=False)
+
+    def get(self, record_id, touch=True):
+        """按下载记录ID返回 {id, hash, size, gz_size, uuid, path, name, created_at, blob_path, gz_path}，
+        touch 时刷新 LRU 时间"""
+        row = self._db.execute('SELECT d.id, d.hash, b.size, d.uuid, d.path, d.name, d.created_at, b.gz_size '
+                               'FROM downloads d JOIN blobs b ON b.hash = d.hash WHERE d.id = ?',
+                               (record_id,)).fetchone()
+        if not row:
+            return None
+        if touch:
+            self._db.execute('UPDATE blobs SET last_access = ? WHERE hash = ?', (time.time(), row[1]))
+        return {'id': row[0], 'hash': row[1], 'size': row[2], 'uuid': row[3], 'path': row[4], 'name': row[5],
+                'created_at': row[6], 'gz_size': row[7], 'blob_path': self.blob_path(row[1]),
+                'gz_path': self.variant_path(row[1])}
+
+    def _remove_blob(self, digest):
+        for path in (self.blob_path(digest), self.variant_path(digest)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._db.execute('DELETE FROM downloads WHERE hash = ?', (digest,))
+        self._db.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+
+    def evict(self, incoming=0):
+        """删除超过保留时长未被访问的内容，再按最久未访问的顺序淘汰，直到能再放入 incoming 字节；返回淘汰的数量"""
+        removed = 0
+        cutoff = time.time() - self.max_age
+        for (digest,) in self._db.execute('SELECT hash FROM blobs WHERE last_access < ?', (cutoff,)).fetchall():
+            self._remove_blob(digest)
+            removed += 1
+        excess = self.total_bytes() + incoming - self.max_bytes
+        if excess <= 0:
+            return removed
+        for digest, size in self._db.execute('SELECT hash, size + COALESCE(gz_size, 0) FROM blobs '
+                                             'ORDER BY last_access').fetchall():
+            self._remove_blob(digest)
+            removed += 1
+            excess -= size
+            if excess <= 0:
+                break
+        return removed
@@ -0,0 +1,94 @@
+"""本 worker 上的 Socket.IO 连接表
+
+每个连接一条 __slots__ 记录（没有实例 __dict__），连接时间存为时间戳，标签为元组，IP 字符串驻留（同一出口 IP
+的大量客户端共用一个对象）。按 UUID、IP 与类型建立索引：统计已注册的客户端数、列出某 IP 的连接、按类型计数都不需要遍历全部连接。
+修改 uuid / ip / type 须经 ConnectionTable 的方法，以便同步索引；其余字段可直接赋值。
+"""
+import sys
+import time
+
+AGENT, WEB = 'agent', 'web'
+
+
+class Connection:
+    __slots__ = ('sid', 'uuid', 'ip', 'type', 'connect_time', 'tags', 'compression', 'binary', 'batch')
+
+    def __init__(self, sid, uuid, ip, type_, tags, compression, binary, batch):
+        self.sid = sid
+        self.uuid = uuid
+        self.ip = ip
+        self.type = type_
+        self.connect_time = time.time()
+        self.tags = tags
+        self.compression = compression
+        self.binary = binary
+        self.batch = batch
+
+
+class ConnectionTable:
+    def __init__(self):
+        self._by_sid = {}
+        self._by_uuid = {}  # {uuid: sid} 同一 UUID 新旧连接并存时指向最新的连接
+        self._by_ip = {}  # {ip: {sid, ...}}
+        self._by_type = {AGENT: set(), WEB: set()}
+
+    def add(self, sid, ip, uuid=None, tags=(), type_=AGENT, compression=None, binary=False, batch=False):
+        ip = sys.intern(ip)
+        conn = Connection(sid, uuid, ip, type_, tuple(tags), compression, binary, batch)
+        self._by_sid[sid] = conn
+        if uuid:
+            self._by_uuid[uuid] = sid
+        self._by_ip.setdefault(ip, set()).add(sid)
+        self._by_type[type_].add(sid)
+        return conn
+
+    def remove(self, sid):
+        """移除连接并返回其记录，不存在时返回 None"""
+        conn = self._by_sid.pop(sid, None)
+        if conn is None:
+            return None
+        if conn.uuid and self._by_uuid.get(conn.uuid) == sid:
+            del self._by_uuid[conn.uuid]
+        sids = self._by_ip.get(conn.ip)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._by_ip[conn.ip]
+        self._by_type[conn.type].discard(sid)
+        return conn
+
+    def set_uuid(self, sid, uuid):
+        conn = self._by_sid[sid]
+        if conn.uuid and self._by_uuid.get(conn.uuid) == sid:
+            del self._by_uuid[conn.uuid]
+        conn.uuid = uuid
+        if uuid:
+            self._by_uuid[uuid] = sid
+
+    def set_type(self, sid, type_):
+        conn = self._by_sid[sid]
+        self._by_type[conn.type].discard(sid)
+        conn.type = type_
+        self._by_type[type_].add(sid)
+
+    def get(self, sid):
+        return self._by_sid.get(sid)
+
+    def __getitem__(self, sid):
+        return self._by_sid[sid]
+
+    def __contains__(self, sid):
+        return sid in self._by_sid
+
+    def __len__(self):
+        return len(self._by_sid)
+
+    def sids_for_ip(self, ip):
+        return set(self._by_ip.get(ip, ()))
+
+    def count(self, type_):
+        return len(self._by_type[type_])
+
+    def registered_agents(self):
+        """已提供 UUID 的客户端连接数（每个 UUID 计一次）"""
+        return len(self._by_uuid)
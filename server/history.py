@@ -0,0 +1,115 @@
+"""命令/结果历史（SQLite，仅追加）
+
+控制台收到的命令与结果按全局递增序号写入，按客户端、时间、请求ID建立索引；
+控制台重连时按序号补发，滚动查看更早记录时按页读取。保留时长与总条数有上限，超出部分定期清理。
+"""
+import json
+import sqlite3
+import time
+
+PRUNE_EVERY = 1000  # 每追加多少条检查一次保留上限
+
+
+def _truncate(payload, max_field):
+    """单个字段超过 max_field 时截断（字符串）或丢弃（嵌套结构），并标记 truncated"""
+    result = {}
+    truncated = False
+    for key, value in payload.items():
+        if isinstance(value, str) and len(value) > max_field:
+            value = value[:max_field]
+            truncated = True
+        elif isinstance(value, (dict, list)) and len(json.dumps(value, ensure_ascii=False)) > max_field:
+            value = None
+            truncated = True
+        result[key] = value
+    if truncated:
+        result['truncated'] = True
+    return result
+
+
+class HistoryStore:
+    def __init__(self, path, retention_days=7, max_rows=100000, max_field=64 * 1024):
+        self.retention = retention_days * 86400
+        self.max_rows = max_rows
+        self.max_field = max_field
+        self._appends = 0
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS history '
+                         '(seq INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT, request_id TEXT, event TEXT NOT NULL, '
+                         'created_at REAL NOT NULL, payload TEXT NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS history_uuid ON history (uuid, seq)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS history_time ON history (created_at)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS history_request ON history (request_id)')
+
+    def append(self, uuid, event, request_id, payload):
+        """追加一条记录，返回其序号"""
+        cur = self._db.execute(
+            'INSERT INTO history (uuid, request_id, event, created_at, payload) VALUES (?, ?, ?, ?, ?)',
+            (uuid, request_id, event, time.time(),
+             json.dumps(_truncate(payload, self.max_field), ensure_ascii=False)))
+        self._appends += 1
+        if self._appends % PRUNE_EVERY == 0:
+            self.prune()
+        return cur.lastrowid
+
+    @staticmethod
+    def _entry(row):
+        return {'seq': row[0], 'uuid': row[1], 'request_id': row[2], 'event': row[3],
+                'created_at': row[4], 'payload': json.loads(row[5])}
+
+    @staticmethod
+    def _scope(clauses, params, uuids, request_ids):
+        """uuids / request_ids 不同时为 None 时只取属于这些客户端或请求的记录（两者皆空则没有记录）"""
+        if uuids is None and request_ids is None:
+            return
+        parts = []
+        for column, values in (('uuid', uuids), ('request_id', request_ids)):
+            if values:
+                parts.append(f'{column} IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+        clauses.append(f'({" OR ".join(parts)})' if parts else '0')
+
+    def page(self, uuid=None, request_id=None, before_seq=None, since=None, limit=100, uuids=None, request_ids=None):
+        """按序号倒序取一页（before_seq 之前），返回 (记录按序号升序, 下一页的 before_seq 或 None)
+        uuids / request_ids 限定范围，见 _scope"""
+        clauses, params = [], []
+        self._scope(clauses, params, uuids, request_ids)
+        if uuid:
+            clauses.append('uuid = ?')
+            params.append(uuid)
+        if request_id:
+            clauses.append('request_id = ?')
+            params.append(request_id)
+        if before_seq is not None:
+            clauses.append('seq < ?')
+            params.append(before_seq)
+        if since is not None:
+            clauses.append('created_at >= ?')
+            params.append(since)
+        where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+        rows = self._db.execute(f'SELECT seq, uuid, request_id, event, created_at, payload FROM history {where} '
+                                'ORDER BY seq DESC LIMIT ?', (*params, limit + 1)).fetchall()
+        more = len(rows) > limit
+        entries = [self._entry(row) for row in reversed(rows[:limit])]
+        return entries, (entries[0]['seq'] if more and entries else None)
+
+    def since(self, seq, uuid=None, limit=500, uuids=None, request_ids=None):
+        """取序号大于 seq 的记录（升序），返回 (记录, 是否还有更多)；uuids / request_ids 限定范围，见 _scope"""
+        clauses, params = ['seq > ?'], [seq]
+        if uuid:
+            clauses.append('uuid = ?')
+            params.append(uuid)
+        self._scope(clauses, params, uuids, request_ids)
+        rows = self._db.execute(f'SELECT seq, uuid, request_id, event, created_at, payload FROM history '
+                                f'WHERE {" AND ".join(clauses)} ORDER BY seq LIMIT ?', (*params, limit + 1)).fetchall()
+        return [self._entry(row) for row in rows[:limit]], len(rows) > limit
+
+    def latest_seq(self):
+        return self._db.execute('SELECT COALESCE(MAX(seq), 0) FROM history').fetchone()[0]
+
+    def prune(self):
+        """删除超过保留时长的记录，并把总条数限制在 max_rows 以内"""
+        self._db.execute('DELETE FROM history WHERE created_at < ?', (time.time() - self.retention,))
+        self._db.execute('DELETE FROM history WHERE seq <= (SELECT MAX(seq) FROM history) - ?', (self.max_rows,))
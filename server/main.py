@@ -1,14 +1,44 @@
-from flask import Flask, render_template, request, session, redirect, url_for, send_from_directory
-from flask_socketio import SocketIO, emit, disconnect, join_room, leave_room
 import os
 from dotenv import load_dotenv
-import logging
-from datetime import datetime
-import json
 
 # 加载环境变量
 load_dotenv()
 
+# 多进程模式下消息队列/共享注册表会进行阻塞式网络IO，需要在其他导入之前为 eventlet 打补丁
+if os.getenv('SOCKETIO_MESSAGE_QUEUE') or os.getenv('AGENT_REGISTRY', '').startswith(('redis://', 'rediss://')):
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, Response, render_template, request, session, redirect, url_for, send_file
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
+from flask_socketio import SocketIO, ConnectionRefusedError, emit, join_room, leave_room, rooms
+import logging
+from datetime import datetime, timezone
+import base64
+import functools
+import hashlib
+import inspect
+import io
+import json
+import ntpath
+import platform
+import re
+import secrets
+import shutil
+import time
+import zlib
+from collections import OrderedDict, deque
+from registry import create_registry
+from connections import ConnectionTable, AGENT, WEB
+from admission import AdmissionControl
+from sanitizer import OutputSanitizer, sanitize_output_text
+from history import HistoryStore
+from offline_queue import OfflineQueue
+from blobstore import BlobStore
+from metrics import MetricsRegistry, SIZE_BUCKETS, ROUNDTRIP_BUCKETS, payload_size
+from outbound import OutboundScheduler, QueueFull, CONTROL, COMMAND, BULK, PRIORITY_NAMES
+
 # 初始化Flask应用
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
@@ -22,41 +52,347 @@ socketio = SocketIO(
     engineio_logger=False,     # 关闭 Engine.IO 层面的详细日志（避免打印大报文）
     ping_timeout=120,          # 适当放宽心跳超时，防止长时间操作导致误判
     ping_interval=25,          # 心跳间隔保持默认或适当
-    max_http_buffer_size=30*1024*1024  # 增大消息缓冲区到30MB支持截图传输
+    max_http_buffer_size=30*1024*1024,  # 增大消息缓冲区到30MB支持截图传输
+    # 多进程/多节点：通过消息队列在 worker 间路由 emit（例如 redis://localhost:6379/0），未配置时为单进程
+    message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE') or None
 )
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-# 文本清理，去除客户端标记行与提示符行
+# 文本清理，去除客户端标记行与提示符行（实现见 sanitizer.py）
 def _sanitize_output_text(text: str) -> str:
     try:
-        if not text:
-            return text
-        text = text.replace('\r\n', '\n')
-        cleaned_lines = []
-        for line in text.split('\n'):
-            if not line:
-                cleaned_lines.append(line)
-                continue
-            if line.startswith('__RC_END__:'):
-                continue
-            # 过滤可能的 PowerShell 提示符行，例如: PS C:\path>
-            if line.startswith('PS ') and line.endswith('>'):
-                continue
-            cleaned_lines.append(line)
-        return '\n'.join(cleaned_lines).strip()
+        return sanitize_output_text(text)
     except Exception:
         return text
 
-# 全局变量存储连接的客户端信息
-connected_clients = {}  # {sid: {uuid: str, connect_time: datetime, ip: str}}
-client_uuid_mapping = {}  # {uuid: sid} 用于通过UUID快速查找sid
+# 本 worker 上的连接（客户端与控制台）：紧凑的连接表，按 UUID / IP / 类型索引
+connected_clients = ConnectionTable()
+
+# 握手准入控制：服务端重启后大量客户端同时重连时限速，被拒绝的客户端按 retry_after 延后重连
+HANDSHAKE_RATE = float(os.getenv('HANDSHAKE_RATE', 500))  # 每秒接受的客户端握手数
+HANDSHAKE_BURST = int(os.getenv('HANDSHAKE_BURST', 1000))  # 令牌桶容量（允许的突发握手数）
+HANDSHAKE_MAX_PENDING = int(os.getenv('HANDSHAKE_MAX_PENDING', 1000))  # 同时进行中（连接后收尾未完成）的握手数
+HANDSHAKE_MAX_RETRY_AFTER = int(os.getenv('HANDSHAKE_MAX_RETRY_AFTER', 60))  # 建议客户端等待的最长时间（秒）
+HANDSHAKE_REFUSED_CLOSE_DELAY = 1  # 拒绝后等待错误包送达再关闭底层连接（秒），旧版客户端随即按自身退避重连
+MAX_CONNECTIONS = int(os.getenv('MAX_CONNECTIONS', 20000))  # eventlet WSGI 同时保持的连接数（其默认 1024）
+admission = AdmissionControl(HANDSHAKE_RATE, HANDSHAKE_BURST, HANDSHAKE_MAX_PENDING,
+                             max_retry_after=HANDSHAKE_MAX_RETRY_AFTER)
+
+# 客户端注册表：{uuid: {sid, worker, info}}，默认进程内；多进程部署时使用共享后端（sqlite:///… 或 redis://…）
+agent_registry = create_registry(os.getenv('AGENT_REGISTRY', 'memory'))
+WORKER_ID = f'{platform.node()}:{os.getpid()}'
+WORKER_HEARTBEAT_INTERVAL = 10  # 共享注册表中的 worker 心跳间隔（秒）
+WORKER_TIMEOUT = int(os.getenv('WORKER_TIMEOUT', 60))  # 超过该时长未心跳的 worker 视为下线，清理其客户端
+_forwarded_handlers = {}  # {event: handler} 可转发到客户端所在 worker 执行的控制台请求
+_worker_tasks_started = False
+
+# 请求ID与待回复请求表：结果只回送给发起请求的控制台及订阅了该客户端的观察房间
+REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', 300))  # 待回复请求的超时时间（秒）
+REQUEST_SWEEP_INTERVAL = 5
+pending_requests = {}  # {request_id: {uuid, requester_sid, event, created_at, deadline}}
+_pending_sweeper_started = False
+
+# 批量执行（fan-out）：有界并发派发同一命令到多台客户端，并聚合结果为一个任务记录
+FLEET_DEFAULT_CONCURRENCY = int(os.getenv('FLEET_DEFAULT_CONCURRENCY', 50))
+FLEET_MAX_CONCURRENCY = int(os.getenv('FLEET_MAX_CONCURRENCY', 500))
+FLEET_DEFAULT_TIMEOUT = int(os.getenv('FLEET_DEFAULT_TIMEOUT', 120))  # 单台客户端的超时（秒）
+FLEET_PROGRESS_INTERVAL = 0.5  # 进度汇总推送的最小间隔（秒）
+FLEET_JOB_HISTORY = int(os.getenv('FLEET_JOB_HISTORY', 100))  # 保留的已完成任务数
+fleet_jobs = {}  # {job_id: {command, requester_sid, queue, inflight, results, ...}}
+
+# 客户端列表增量推送：变化在合并窗口内累积，按序号推送 added/removed/changed
+CLIENT_LIST_DEBOUNCE = float(os.getenv('CLIENT_LIST_DEBOUNCE', 0.2))  # 合并窗口（秒）
+_client_list_dirty = set()  # 合并窗口内发生变化的 UUID
+_client_list_published = set()  # 截至最新序号，控制台视图中在线的（本 worker 负责推送的）UUID
+_client_list_flush_scheduled = False
+
+# 运行数据目录：SQLite 数据库等默认放在 instance/ 下，不写入源码目录
+DATA_DIR = os.path.abspath(os.getenv('DATA_DIR', app.instance_path))
+os.makedirs(DATA_DIR, exist_ok=True)
 
 # 服务器端下载保存目录（使用绝对路径，默认放在应用根目录下的 downloads/）
 _default_download = os.path.join(app.root_path, 'downloads')
 DOWNLOAD_DIR = os.path.abspath(os.getenv('DOWNLOAD_DIR', _default_download))
 
+# 分块下载：未完成的分块写入临时目录，完成后再移动到 DOWNLOAD_DIR
+DOWNLOAD_PARTIAL_DIR = os.path.join(DOWNLOAD_DIR, '.partial')
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 256 * 1024))
+DOWNLOAD_TRANSFER_TTL = int(os.getenv('DOWNLOAD_TRANSFER_TTL', 24 * 3600))  # 未完成传输的保留时长（秒）
+download_transfers = {}  # {transfer_id: {uuid, path, offset, size, temp_path, requester_sid, resume_sid, updated_at, phase, sha256, hasher}}
+
+# 下载存储：按内容 SHA-256 去重保存，超过配额或长期未访问时按 LRU 淘汰
+DOWNLOAD_STORE_DIR = os.path.join(DOWNLOAD_DIR, '.store')
+DOWNLOAD_STORE_MAX_BYTES = int(os.getenv('DOWNLOAD_STORE_MAX_BYTES', 10 * 1024 ** 3))  # 磁盘配额（字节）
+DOWNLOAD_STORE_MAX_AGE_DAYS = float(os.getenv('DOWNLOAD_STORE_MAX_AGE_DAYS', 30))  # 未被访问的内容保留天数
+download_store = BlobStore(DOWNLOAD_STORE_DIR, DOWNLOAD_STORE_MAX_BYTES, DOWNLOAD_STORE_MAX_AGE_DAYS)
+DOWNLOAD_STORE_SWEEP_INTERVAL = int(os.getenv('DOWNLOAD_STORE_SWEEP_INTERVAL', 3600))  # 定期淘汰与清理旧版下载文件的间隔（秒）
+LEGACY_DOWNLOAD_NAME = re.compile(r'^\d{8}_\d{6}_')  # 旧版直接保存在下载目录中的文件：{时间戳}_{文件名}
+_download_sweeper_started = False
+download_digest_leaders = {}  # {sha256: transfer_id} 同一内容正在传输的传输，其余同内容的传输等待其完成
+
+# 下载文件的 HTTP 发送：大文件在 eventlet 明文连接上改用 os.sendfile 由内核直接发送；可压缩内容预先生成 gzip 版本
+SENDFILE_MIN_SIZE = int(os.getenv('SENDFILE_MIN_SIZE', 1024 * 1024))  # 小于该大小的响应照常经 Python 发送
+SENDFILE_BLOCK = 4 * 1024 * 1024  # 每次 sendfile 的最大字节数，两次之间让出事件循环
+SENDFILE_IDLE_TIMEOUT = 60  # 客户端长时间不接收数据时中止发送（秒）
+DOWNLOAD_PRECOMPRESS = os.getenv('DOWNLOAD_PRECOMPRESS', 'True').lower() == 'true'
+PRECOMPRESS_MIN_SIZE = 64 * 1024
+PRECOMPRESS_SAMPLE = 1024 * 1024  # 先压缩开头这部分估算压缩率
+PRECOMPRESS_MAX_RATIO = 0.9  # 压缩后大于原大小的该比例时不保留压缩版本
+
+# 流式上传：浏览器上传的文件先落盘到暂存目录，再按窗口分块转发给客户端
+_default_upload_staging = os.path.join(app.root_path, 'upload_staging')
+UPLOAD_STAGING_DIR = os.path.abspath(os.getenv('UPLOAD_STAGING_DIR', _default_upload_staging))
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 256 * 1024))
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', 4 * 1024 ** 3))  # 单次上传的大小上限（字节），超出时拒绝且不留暂存文件
+UPLOAD_WINDOW_SIZE = int(os.getenv('UPLOAD_WINDOW_SIZE', 1024 * 1024))  # 每个客户端未确认的最大在途字节数（多个上传共享）
+UPLOAD_PROGRESS_INTERVAL = 0.5  # 向控制台推送进度的最小间隔（秒）
+upload_stagings = {}  # {staging_id: {file_path, size, refs}}
+upload_relays = {}  # {transfer_id: {uuid, sid, path, staging_id, size, sent, acked, eof_sent, requester_sid, last_progress}}
+
+# 发往客户端的出站调度：每个连接按 控制 > 命令 > 批量传输 排队，各优先级限制排队条数与字节数，超出时拒绝并通知控制台
+OUTBOUND_QUEUE_DEPTH = int(os.getenv('OUTBOUND_QUEUE_DEPTH', 100))  # 每个优先级最多排队的消息数
+OUTBOUND_QUEUE_BYTES = (1024 * 1024, 8 * 1024 * 1024,  # 控制、命令、批量传输各自最多排队的字节数
+                        int(os.getenv('OUTBOUND_BULK_BYTES', 64 * 1024 * 1024)))
+
+# 截图缓存：每个客户端（按显示器）保留最近一帧，经 HTTP 提供（ETag/Last-Modified），Socket.IO 只推送更新通知
+SCREENSHOT_MAX_AGE = float(os.getenv('SCREENSHOT_MAX_AGE', 2))  # 该时间内的截图请求直接复用缓存帧（秒）
+SCREENSHOT_CACHE_TTL = int(os.getenv('SCREENSHOT_CACHE_TTL', 300))  # 缓存帧的保留时长（秒）
+SCREENSHOT_CACHE_MAX_BYTES = int(os.getenv('SCREENSHOT_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # 超出后按 LRU 淘汰
+screenshot_cache = OrderedDict()  # {(uuid, display_index): {data, etag, captured_at}}，按最近使用排序
+_screenshot_cache_bytes = 0
+screenshot_inflight = {}  # {(uuid, display_index): {request_id, waiters}} 进行中的截图，期间的同类请求只等待结果
+SCREENSHOT_TIMEOUT = int(os.getenv('SCREENSHOT_TIMEOUT', 30))  # 客户端未返回截图时通知等待的控制台（秒）
+# 多 worker 部署时最近一帧另写入各 worker 共享的目录，图片请求落到其他 worker 时从这里读取
+SCREENSHOT_SHARED_DIR = os.path.abspath(os.getenv('SCREENSHOT_SHARED_DIR', os.path.join(DATA_DIR, 'screenshots')))
+
+# 实时画面：客户端推送关键帧 + 变化瓦片，服务端保存完整画面并按观看者合并待发送瓦片（慢观看者丢弃过期帧）
+SCREEN_DEFAULT_FPS = int(os.getenv('SCREEN_DEFAULT_FPS', 5))
+SCREEN_MAX_FPS = int(os.getenv('SCREEN_MAX_FPS', 15))  # 帧率上限
+SCREEN_VIEWER_TIMEOUT = 30  # 观看者超过该时间未确认画面帧则视为离开（秒）
+screen_streams = {}  # {uuid: {stream_id, display_index, fps, width, height, tiles: {index: (x, y, w, h, png)}, viewers: {sid: viewer}}}
+
+# 消息压缩：客户端握手时声明支持的压缩方式，超过阈值的大字段（命令输出、文件内容等）压缩后以二进制帧发送；
+# 支持解压的控制台直接收到客户端的压缩数据，服务端不重新压缩
+COMPRESSION_THRESHOLD = int(os.getenv('COMPRESSION_THRESHOLD', 1024))  # 字段 JSON 超过该字节数才压缩
+COMPRESSION_CODECS = ('zlib',)  # 浏览器 DecompressionStream('deflate') 可直接解压 zlib 格式
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024  # 单条消息解压后的上限，防止压缩炸弹
+
+# 二进制载荷：握手声明 capabilities.binary 的客户端以 Socket.IO 二进制附件回传截图、整文件等原始字节，
+# 不再 base64 编码；未声明的旧版客户端仍走 JSON/base64，置为 False 可让全部客户端退回 base64
+BINARY_PAYLOADS = os.getenv('BINARY_PAYLOADS', 'True').lower() == 'true'
+
+# 目录列表：客户端分批回传，服务端按 (客户端, 路径) 缓存并按游标分页返回；写入/删除/上传时失效
+LISTING_CACHE_TTL = float(os.getenv('LISTING_CACHE_TTL', 10))  # 已读取列表的缓存时长（秒）
+LISTING_PAGE_SIZE = int(os.getenv('LISTING_PAGE_SIZE', 200))  # 默认每页条目数
+LISTING_MAX_PAGE_SIZE = 1000
+LISTING_CHUNK_SIZE = 500  # 客户端每批回传的条目数
+LISTING_CACHE_MAX_ENTRIES = int(os.getenv('LISTING_CACHE_MAX_ENTRIES', 200000))  # 缓存的条目总数上限
+LISTING_SORT_KEYS = ('name', 'size', 'modified')
+listing_cache = OrderedDict()  # {(uuid, 规范化路径): {version, path, entries, complete, error, fetched_at, request_id, sorted, waiters, invalidated}}
+_listing_cache_entries = 0
+listing_fetches = {}  # {request_id: (uuid, 规范化路径)} 进行中的目录读取
+
+# 命令/结果历史：持久化到 SQLite，控制台重连时按序号补发，滚动查看时分页加载
+HISTORY_DB = os.path.abspath(os.getenv('HISTORY_DB', os.path.join(DATA_DIR, 'history.db')))
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', 7))
+HISTORY_MAX_ROWS = int(os.getenv('HISTORY_MAX_ROWS', 100000))
+HISTORY_REPLAY_LIMIT = int(os.getenv('HISTORY_REPLAY_LIMIT', 200))  # 加入控制台时单次补发的最大条数
+history_store = HistoryStore(HISTORY_DB, HISTORY_RETENTION_DAYS, HISTORY_MAX_ROWS)
+
+# 离线请求队列：目标客户端未连接时按控制台的选择排队（SQLite），客户端重连后成批下发
+OFFLINE_QUEUE_DB = os.path.abspath(os.getenv('OFFLINE_QUEUE_DB', os.path.join(DATA_DIR, 'offline_queue.db')))
+OFFLINE_QUEUE_TTL = int(os.getenv('OFFLINE_QUEUE_TTL', 24 * 3600))  # 未指定 ttl 时的过期时间（秒）
+OFFLINE_QUEUE_MAX_TTL = int(os.getenv('OFFLINE_QUEUE_MAX_TTL', 7 * 24 * 3600))
+OFFLINE_QUEUE_MAX_PER_CLIENT = int(os.getenv('OFFLINE_QUEUE_MAX_PER_CLIENT', 10000))  # 每个客户端最多排队的请求数
+OFFLINE_FLUSH_BATCH = int(os.getenv('OFFLINE_FLUSH_BATCH', 100))  # 重连后每批下发的请求数
+OFFLINE_FLUSH_BATCH_BYTES = int(os.getenv('OFFLINE_FLUSH_BATCH_BYTES', 4 * 1024 * 1024))  # 每批载荷的字节上限
+OFFLINE_FLUSH_POLL = 0.2  # 等待上一批结果的检查间隔（秒）
+OFFLINE_AGENT_EVENTS = {'execute_command': 'run_command', 'file_operation': 'do_file_operation'}
+offline_queue = OfflineQueue(OFFLINE_QUEUE_DB, OFFLINE_QUEUE_MAX_PER_CLIENT)
+offline_flushes = {}  # {uuid: sid} 正在下发离线队列的客户端连接
+
+# ============ 运行指标 ============
+# 每个 Socket.IO 事件的收发次数、载荷大小与处理耗时，请求往返时间，各客户端收发字节数与事件循环延迟，经 /metrics 导出
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # 设置后 /metrics 需携带 Authorization: Bearer <token>，否则需要登录
+LOOP_LAG_INTERVAL = 0.5  # 事件循环延迟的采样间隔（秒）
+metrics = MetricsRegistry()
+metric_events_received = metrics.counter('rc_socketio_events_received_total', '收到的 Socket.IO 事件数', ('event',))
+metric_received_bytes = metrics.histogram('rc_socketio_event_received_bytes', '收到的事件载荷大小（估算）',
+                                          ('event',), SIZE_BUCKETS)
+metric_handler_seconds = metrics.histogram('rc_socketio_handler_seconds', '事件处理函数耗时', ('event',))
+metric_handler_errors = metrics.counter('rc_socketio_handler_errors_total', '处理函数抛出的未捕获异常数', ('event',))
+metric_events_sent = metrics.counter('rc_socketio_events_sent_total', '发送的 Socket.IO 事件数', ('event',))
+metric_sent_bytes = metrics.histogram('rc_socketio_event_sent_bytes', '发送的事件载荷大小（估算）', ('event',), SIZE_BUCKETS)
+metric_roundtrip = metrics.histogram('rc_request_roundtrip_seconds', '控制台请求从下发到客户端回传结果的时间',
+                                     ('event',), ROUNDTRIP_BUCKETS)
+metric_request_timeouts = metrics.counter('rc_request_timeouts_total', '超时未回传结果的请求数', ('event',))
+metric_agent_received = metrics.counter('rc_agent_received_bytes_total', '从客户端收到的字节数（估算）', ('uuid',))
+metric_agent_sent = metrics.counter('rc_agent_sent_bytes_total', '发送给客户端的字节数（估算）', ('uuid',))
+metric_loop_lag = metrics.gauge('rc_eventloop_lag_seconds', '最近一次采样的事件循环延迟')
+metric_loop_lag_hist = metrics.histogram('rc_eventloop_lag_observed_seconds', '事件循环延迟分布')
+metrics.gauge('rc_connected_agents', '本 worker 上已注册的客户端连接数', function=connected_clients.registered_agents)
+metrics.gauge('rc_connected_consoles', '本 worker 上的控制台连接数', function=lambda: connected_clients.count(WEB))
+metric_handshakes = metrics.counter('rc_handshakes_total', '客户端握手数（accepted / rejected）', ('outcome',))
+metrics.gauge('rc_handshakes_pending', '进行中（连接后收尾未完成）的客户端握手数', function=lambda: admission.pending)
+metrics.gauge('rc_pending_requests', '等待客户端回传结果的请求数', function=lambda: len(pending_requests))
+metrics.gauge('rc_active_transfers', '进行中的传输数', ('kind',),
+              function=lambda: {('download',): len(download_transfers), ('upload',): len(upload_relays),
+                                ('listing',): len(listing_fetches), ('screen_stream',): len(screen_streams)})
+metric_offline_requests = metrics.counter('rc_offline_requests_total', '离线队列中请求的去向', ('outcome',))
+metrics.gauge('rc_offline_queued_requests', '离线队列中等待下发的请求数', function=offline_queue.count)
+_loop_monitor_started = False
+
+def _agent_uuid(sid):
+    """sid 为本 worker 上已注册的客户端连接时返回其 UUID"""
+    info = connected_clients.get(sid) if isinstance(sid, str) else None
+    return info.uuid if info and info.type == AGENT else None
+
+def _instrument_handler(event, handler):
+    """包装事件处理函数：统计次数、载荷大小、耗时与客户端收到的字节数"""
+    params = list(inspect.signature(handler).parameters.values())
+    # 与 Flask-SocketIO 调用约定一致：只传处理函数声明的参数个数（如 connect 的 auth、无参的 disconnect）
+    max_args = None if any(p.kind == p.VAR_POSITIONAL for p in params) else len(params)
+
+    @functools.wraps(handler)
+    def instrumented(*args):
+        if max_args is not None:
+            args = args[:max_args]
+        start = time.perf_counter()
+        size = payload_size(args)
+        metric_events_received.inc(event)
+        metric_received_bytes.observe(size, event)
+        client_uuid = _agent_uuid(getattr(request, 'sid', None))
+        if client_uuid:
+            metric_agent_received.inc(client_uuid, amount=size)
+        try:
+            return handler(*args)
+        except ConnectionRefusedError:
+            raise  # 拒绝握手属于正常流程，不计为处理函数异常
+        except Exception:
+            metric_handler_errors.inc(event)
+            raise
+        finally:
+            metric_handler_seconds.observe(time.perf_counter() - start, event)
+    return instrumented
+
+def _instrumented_on(register):
+    def on(message, namespace=None):
+        decorator = register(message, namespace)
+
+        def wrap(handler):
+            decorator(_instrument_handler(message, handler))
+            return handler
+        return wrap
+    return on
+
+def _instrumented_emit(send):
+    def emit_event(event, *args, **kwargs):
+        size = payload_size(args)
+        metric_events_sent.inc(event)
+        metric_sent_bytes.observe(size, event)
+        client_uuid = _agent_uuid(kwargs.get('to') or kwargs.get('room'))
+        if client_uuid:
+            metric_agent_sent.inc(client_uuid, amount=size)
+        return send(event, *args, **kwargs)
+    return emit_event
+
+# 所有 @socketio.on 处理函数与 emit（含 flask_socketio.emit，其内部调用 socketio.emit）经过统计
+socketio.on = _instrumented_on(socketio.on)
+socketio.emit = _instrumented_emit(socketio.emit)
+
+def _observe_roundtrip(pending):
+    """请求收到最终结果时记录往返时间"""
+    metric_roundtrip.observe(time.time() - pending['created_at'], pending['event'])
+
+def _ensure_loop_monitor():
+    global _loop_monitor_started
+    if not _loop_monitor_started:
+        _loop_monitor_started = True
+        socketio.start_background_task(_loop_lag_monitor)
+
+def _loop_lag_monitor():
+    """后台任务：定时休眠并测量实际唤醒的延迟，反映事件循环被阻塞的程度"""
+    while True:
+        start = time.perf_counter()
+        socketio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - start - LOOP_LAG_INTERVAL)
+        metric_loop_lag.set(lag)
+        metric_loop_lag_hist.observe(lag)
+
+# ============ 出站调度 ============
+
+def _transport_backlog(sid):
+    """连接在 engine.io 发送队列中尚未写出的包数；连接不在本 worker（或测试客户端）时返回 None"""
+    server = socketio.server
+    try:
+        return server.eio.sockets[server.manager.eio_sid_from_sid(sid, '/')].queue.qsize()
+    except (KeyError, AttributeError):
+        return None
+
+def _emit_outbound(sid, event, payload):
+    socketio.emit(event, payload, room=sid)
+
+metric_outbound_wait = metrics.histogram('rc_outbound_queue_wait_seconds', '发往客户端的消息在出站队列中的等待时间',
+                                         ('priority',))
+outbound = OutboundScheduler(
+    _emit_outbound, _transport_backlog, socketio.start_background_task, socketio.sleep,
+    OUTBOUND_QUEUE_DEPTH, OUTBOUND_QUEUE_BYTES,
+    on_sent=lambda priority, waited: metric_outbound_wait.observe(waited, PRIORITY_NAMES[priority]),
+    on_dropped=lambda sid, messages, error: _fail_discarded(messages, f'发送失败（{error}）'))
+metric_outbound_rejected = metrics.counter('rc_outbound_rejected_total', '出站队列已满被拒绝的消息数', ('priority',))
+metrics.gauge('rc_outbound_queued_messages', '出站队列中等待发送的消息数', ('priority',),
+              function=lambda: {(name,): count for name, count in zip(PRIORITY_NAMES, outbound.stats()[0])})
+metrics.gauge('rc_outbound_queued_bytes', '出站队列中等待发送的字节数（估算）', ('priority',),
+              function=lambda: {(name,): size for name, size in zip(PRIORITY_NAMES, outbound.stats()[1])})
+
+def _send_to_agent(target_sid, event, payload, priority, force=False):
+    """经出站调度发送给客户端，返回是否已发送或排队
+    队列已满时，载荷带 request_id 的按请求失败通知发起者；其余由调用方处理返回值"""
+    try:
+        outbound.submit(target_sid, priority, event, payload, payload_size(payload), force)
+        return True
+    except QueueFull as e:
+        metric_outbound_rejected.inc(PRIORITY_NAMES[e.priority])
+        error = f'客户端 {_agent_uuid(target_sid)} 的发送队列已满（{e}），请稍后重试'
+        logger.info(f'拒绝发送 {event}: {error}')
+        request_id = payload.get('request_id') if isinstance(payload, dict) else None
+        if request_id:
+            _fail_unsent_request(request_id, error, priority=PRIORITY_NAMES[e.priority])
+        return False
+
+def _fail_unsent_request(request_id, error, priority=None):
+    """请求未能发给客户端（队列已满、排队期间客户端断开或发送出错）：结束待回复记录并通知发起者"""
+    pending = pending_requests.pop(request_id, None)
+    if not pending:
+        return
+    if request_id in listing_fetches:
+        handle_list_dir_chunk({'request_id': request_id, 'error': error, 'eof': True})
+        return
+    if pending['job_id']:
+        _report_fleet_result(pending, request_id, 'failed', error=error)
+        return
+    if pending.get('screenshot_key'):
+        _fail_screenshot(pending, request_id, error)
+        return
+    socketio.emit('request_rejected', {
+        'request_id': request_id,
+        'uuid': pending['uuid'],
+        'event': pending['event'],
+        'priority': priority,
+        'error': error,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }, to=pending['requester_sid'])
+
+def _fail_discarded(messages, cause):
+    """出站队列中未发出的消息被丢弃（客户端断开或发送出错）：带请求ID的逐条结束（run_batch 按其中每条请求）"""
+    for _, event, payload in messages:
+        unsent = [(item['event'], item['data']) for item in payload['items']] if event == 'run_batch' else [(event, payload)]
+        for unsent_event, data in unsent:
+            if isinstance(data, dict) and data.get('request_id'):
+                _fail_unsent_request(data['request_id'], f'{cause}，{unsent_event} 请求未发出')
+
 # 简单的认证密码
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
 
@@ -85,55 +421,480 @@ def logout():
     session.pop('authenticated', None)
     return redirect(url_for('login'))
 
+def _client_entry(uuid, registry_entry=None):
+    """构造单个客户端的列表条目；客户端不在线时返回 None"""
+    registry_entry = registry_entry or agent_registry.get_entry(uuid)
+    if not registry_entry:
+        return None
+    return {'uuid': uuid, **registry_entry['info']}
+
 def get_client_list():
-    """获取当前连接的客户端列表（按UUID去重，仅返回最新SID对应的客户端）"""
-    clients = []
-    for uuid, sid in client_uuid_mapping.items():
+    """获取当前连接的客户端列表（按UUID去重，仅返回最新SID对应的客户端；多进程时包含所有 worker）"""
+    return [_client_entry(uuid, entry) for uuid, entry in agent_registry.entries()]
+
+def _register_agent(client_uuid, sid):
+    """将本 worker 上的连接登记到注册表（覆盖为最新 SID）"""
+    info = connected_clients[sid]
+    agent_registry.register(client_uuid, sid, WORKER_ID, {
+        'connect_time': datetime.fromtimestamp(info.connect_time).strftime('%Y-%m-%d %H:%M:%S'),
+        'ip': info.ip,
+        'tags': list(info.tags)
+    })
+
+# ============ 多进程/多节点：跨 worker 转发 ============
+
+def forward_to_agent_worker(event):
+    """装饰器：目标客户端连接在其他 worker 时，把控制台请求转发到该 worker 执行，
+    使待回复请求、传输等状态与客户端位于同一 worker（结果经消息队列回送控制台）"""
+    def decorator(handler):
+        _forwarded_handlers[event] = handler
+
+        @functools.wraps(handler)
+        def wrapper(data):
+            target = agent_registry.get_entry((data or {}).get('target_uuid')) if agent_registry.shared else None
+            if target and target['worker'] != WORKER_ID:
+                agent_registry.publish(target['worker'], {
+                    'type': 'console_request',
+                    'event': event,
+                    'data': data,
+                    'sid': request.sid,
+                })
+                return
+            return handler(data)
+        return wrapper
+    return decorator
+
+def _ensure_worker_tasks():
+    """共享注册表模式下启动信箱轮询与心跳后台任务"""
+    global _worker_tasks_started
+    if _worker_tasks_started or not agent_registry.shared:
+        return
+    _worker_tasks_started = True
+    agent_registry.heartbeat(WORKER_ID)
+    socketio.start_background_task(_worker_mailbox_loop)
+
+def _worker_mailbox_loop():
+    """后台任务：处理其他 worker 转发来的消息，并定期心跳、清理已下线的 worker"""
+    last_heartbeat = 0.0
+    while True:
+        try:
+            now = time.time()
+            if now - last_heartbeat >= WORKER_HEARTBEAT_INTERVAL:
+                last_heartbeat = now
+                agent_registry.heartbeat(WORKER_ID)
+                for worker in agent_registry.purge_dead_workers(WORKER_TIMEOUT):
+                    logger.info(f'清理已下线的 worker: {worker}')
+            messages = agent_registry.poll(WORKER_ID, WORKER_HEARTBEAT_INTERVAL)
+            for message in messages:
+                _handle_worker_message(message)
+            if not messages:
+                socketio.sleep(0.05)
+        except Exception as e:
+            logger.error(f'处理 worker 信箱失败: {e}')
+            socketio.sleep(1)
+
+def _handle_worker_message(message):
+    """执行其他 worker 转发来的请求"""
+    kind = message.get('type')
+    if kind == 'console_request':
+        handler = _forwarded_handlers.get(message['event'])
+        if not handler:
+            return
+        # 模拟 Flask-SocketIO 的事件上下文，使 emit()/request.sid 指向发起请求的控制台
+        with app.test_request_context('/'):
+            request.sid = message['sid']
+            request.namespace = '/'
+            handler(message['data'])
+    elif kind == 'fleet_dispatch':
+        _dispatch_fleet_target_locally(message)
+    elif kind == 'fleet_result':
+        _complete_fleet_target(message['job_id'], message['request_id'], message['status'],
+                               message.get('output', ''), message.get('error', ''))
+    elif kind == 'upload_relay':
+        upload_stagings[message['staging_id']] = {
+            'file_path': os.path.join(UPLOAD_STAGING_DIR, message['staging_id']),
+            'size': message['size'],
+            'refs': 0,
+        }
+        target_sid = agent_registry.get(message['uuid'])
+        if target_sid:
+            _start_upload_relay(message['staging_id'], message['uuid'], target_sid,
+                                message['path'], message['requester_sid'])
+        else:
+            _release_upload_staging(message['staging_id'])
+    elif kind == 'offline_flush':
+        target_sid = agent_registry.get(message['uuid'])
+        if target_sid in connected_clients:
+            _start_offline_flush(message['uuid'], target_sid)
+
+def _watch_room(client_uuid, codec=None):
+    """观察某个客户端的控制台所在房间；codec 为按压缩方式细分的子房间（'plain' 表示不解压的控制台）"""
+    return f'watch:{client_uuid}:{codec}' if codec else f'watch:{client_uuid}'
+
+def _new_request(client_uuid, event, timeout=None, requester_sid=None, job_id=None,
+                 job_worker=None, request_id=None, codec=None):
+    """为来自控制台的请求生成请求ID并登记到待回复表（默认发起者为当前请求的sid）"""
+    request_id = request_id or secrets.token_hex(8)
+    now = time.time()
+    pending_requests[request_id] = {
+        'uuid': client_uuid,
+        'requester_sid': requester_sid or request.sid,
+        'event': event,
+        'created_at': now,
+        'deadline': now + (timeout or REQUEST_TIMEOUT),
+        'job_id': job_id,
+        'job_worker': job_worker or WORKER_ID,  # 批量任务所在 worker
+        'codec': codec if codec in COMPRESSION_CODECS else None,  # 发起者能直接解压的压缩方式
+    }
+    _ensure_pending_sweeper()
+    return request_id
+
+def _ensure_pending_sweeper():
+    global _pending_sweeper_started
+    if not _pending_sweeper_started:
+        _pending_sweeper_started = True
+        socketio.start_background_task(_pending_request_sweeper)
+
+def _pending_request_sweeper():
+    """后台任务：清理超时的待回复请求与离线队列中过期的请求，并通知发起者"""
+    while True:
+        socketio.sleep(REQUEST_SWEEP_INTERVAL)
+        _expire_offline_requests()
+        now = time.time()
+        for request_id, pending in list(pending_requests.items()):
+            if pending['deadline'] > now:
+                continue
+            pending_requests.pop(request_id, None)
+            metric_request_timeouts.inc(pending['event'])
+            logger.info(f"请求超时: {request_id} ({pending['event']} -> {pending['uuid']})")
+            if request_id in listing_fetches:
+                # 目录读取超时：以错误结束该列表，通知所有等待的控制台
+                handle_list_dir_chunk({'request_id': request_id, 'error': '读取目录超时', 'eof': True})
+                continue
+            if pending['job_id']:
+                # 批量任务中的单台超时只记入任务结果，不单独通知
+                _report_fleet_result(pending, request_id, 'timeout', error='执行超时')
+                continue
+            if pending.get('screenshot_key'):
+                _fail_screenshot(pending, request_id, '截图超时')
+                continue
+            socketio.emit('request_timeout', {
+                'request_id': request_id,
+                'uuid': pending['uuid'],
+                'event': pending['event'],
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }, to=pending['requester_sid'])
+
+def _emit_to_console(event, payload, requester_sid, client_uuid, compressed=None, requester_codec=None):
+    """仅发送给发起请求的控制台与观察该客户端的控制台（同一sid只收到一次）
+    compressed 为客户端发来的压缩数据：能解压的控制台收到原样的压缩数据，其余收到解压后的 payload"""
+    if not compressed:
+        rooms = [_watch_room(client_uuid)]
+        if requester_sid:
+            rooms.append(requester_sid)
+        socketio.emit(event, payload, to=rooms)
+        return
+    codec = compressed['encoding']
+    compressed_rooms = [_watch_room(client_uuid, codec)]
+    plain_rooms = [_watch_room(client_uuid, 'plain')]
+    if requester_sid:
+        (compressed_rooms if requester_codec == codec else plain_rooms).append(requester_sid)
+    relay = {key: value for key, value in payload.items() if key not in compressed['fields']}
+    relay['compressed'] = {'encoding': codec, 'body': compressed['body']}
+    socketio.emit(event, relay, to=compressed_rooms)
+    socketio.emit(event, payload, to=plain_rooms)
+
+def _record_history(event, payload, client_uuid=None):
+    """写入历史并在载荷中附上序号 history_seq；写入失败不影响结果转发"""
+    try:
+        payload['history_seq'] = history_store.append(client_uuid or payload.get('uuid'), event,
+                                                      payload.get('request_id'), payload)
+    except Exception as e:
+        logger.error(f'写入历史失败: {e}')
+    return payload
+
+def _emit_reply(event, payload, request_id, client_uuid, done=True, compressed=None):
+    """按请求ID回送结果；done=False 表示同一请求后续还有消息，保留待回复记录"""
+    if not request_id:
+        # 旧版客户端不回传请求ID：退回广播，保证控制台仍能看到结果
+        socketio.emit(event, payload, room='web_clients')
+        return
+    pending = pending_requests.pop(request_id, None) if done else pending_requests.get(request_id)
+    if pending is None:
+        logger.info(f'请求 {request_id} 已超时或未知，仅发送给观察者')
+    elif done:
+        _observe_roundtrip(pending)
+    _emit_to_console(event, payload, pending['requester_sid'] if pending else None, client_uuid,
+                     compressed=compressed, requester_codec=pending['codec'] if pending else None)
+
+# ============ 离线请求队列 ============
+
+def _enqueue_offline(client_uuid, event, payload, options, requester_sid):
+    """把发往未连接客户端的请求写入离线队列，返回 (记录, 是否与已排队的请求重复)
+    options 为控制台请求中的 ttl（秒）、dedup_key 与 compression；队列已满时抛出 OverflowError"""
+    try:
+        ttl = int(options.get('ttl') or OFFLINE_QUEUE_TTL)
+    except (TypeError, ValueError):
+        ttl = OFFLINE_QUEUE_TTL
+    dedup_key = options.get('dedup_key')
+    job, duplicate = offline_queue.enqueue(
+        client_uuid, secrets.token_hex(8), event, payload, max(1, min(ttl, OFFLINE_QUEUE_MAX_TTL)),
+        requester_sid=requester_sid,
+        codec=options.get('compression') if options.get('compression') in COMPRESSION_CODECS else None,
+        dedup_key=str(dedup_key) if dedup_key else None)
+    metric_offline_requests.inc('deduplicated' if duplicate else 'queued')
+    _ensure_pending_sweeper()
+    if not duplicate:
+        logger.info(f"客户端 {client_uuid} 未连接，{event} 请求已排队 (请求ID: {job['request_id']})")
+        # 检查与入队之间客户端可能已经连上：立即下发
+        _kick_offline_flush(client_uuid)
+    return job, duplicate
+
+def _queue_offline_request(client_uuid, event, payload, data):
+    """控制台请求 queue_if_offline 时排队并回复 request_queued（写入历史，重连后的结果按同一请求ID回送）"""
+    try:
+        job, duplicate = _enqueue_offline(client_uuid, event, payload, data, request.sid)
+    except OverflowError as e:
+        emit('error', {'message': str(e)})
+        return
+    notice = {
+        'request_id': job['request_id'],
+        'target_uuid': client_uuid,
+        'event': event,
+        'command': payload.get('command'),
+        'operation': payload.get('operation'),
+        'path': payload.get('path'),
+        'deduplicated': duplicate,
+        'expires_at': datetime.fromtimestamp(job['expires_at']).strftime('%Y-%m-%d %H:%M:%S'),
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    emit('request_queued', notice if duplicate else _record_history('request_queued', notice, client_uuid))
+
+def _kick_offline_flush(client_uuid):
+    """客户端在线时让其所在 worker 下发离线队列"""
+    target = agent_registry.get_entry(client_uuid)
+    if not target:
+        return
+    if target['worker'] == WORKER_ID:
+        if target['sid'] in connected_clients:
+            _start_offline_flush(client_uuid, target['sid'])
+    else:
+        agent_registry.publish(target['worker'], {'type': 'offline_flush', 'uuid': client_uuid})
+
+def _start_offline_flush(client_uuid, sid):
+    """客户端（重新）注册：启动下发离线队列的后台任务（同一连接只启动一个）"""
+    if offline_flushes.get(client_uuid) == sid:
+        return
+    offline_flushes[client_uuid] = sid
+    socketio.start_background_task(_flush_offline_queue, client_uuid, sid)
+
+def _flush_offline_queue(client_uuid, sid):
+    """后台任务：按入队顺序成批下发离线队列，上一批全部回传结果（或超时）后再取下一批
+    结果以入队时的请求ID回送给原发起者与观察者，不需要控制台逐条确认；连接断开或被新连接取代时停止，
+    已取出的请求至多下发一次（断开时仍在执行的照常超时），未取出的留在队列中等待下次重连"""
+    def current():
         info = connected_clients.get(sid)
-        if not info:
-            continue
-        clients.append({
-            'uuid': uuid,
-            'connect_time': info['connect_time'].strftime('%Y-%m-%d %H:%M:%S'),
-            'ip': info.get('ip', 'Unknown')
-        })
-    return clients
+        return offline_flushes.get(client_uuid) == sid and info is not None and info.uuid == client_uuid
+
+    try:
+        while current():
+            jobs = offline_queue.take(client_uuid, OFFLINE_FLUSH_BATCH, OFFLINE_FLUSH_BATCH_BYTES)
+            if not jobs:
+                break
+            logger.info(f'向客户端 {client_uuid} 下发离线队列中的 {len(jobs)} 条请求')
+            waiting = _dispatch_offline_batch(client_uuid, sid, jobs)
+            while waiting and current():
+                socketio.sleep(OFFLINE_FLUSH_POLL)
+                remaining = [request_id for request_id in waiting if request_id in pending_requests]
+                if len(remaining) < len(waiting):
+                    # 批内按顺序执行：前面的请求有了结果，其余请求的超时从此刻重新计算
+                    deadline = time.time() + REQUEST_TIMEOUT
+                    for request_id in remaining:
+                        pending_requests[request_id]['deadline'] = deadline
+                waiting = remaining
+    except Exception as e:
+        logger.error(f'下发离线队列失败: {e}')
+    finally:
+        if offline_flushes.get(client_uuid) == sid:
+            del offline_flushes[client_uuid]
+
+def _dispatch_offline_batch(client_uuid, sid, jobs):
+    """以入队时的请求ID登记待回复并下发一批请求，返回请求ID列表
+    客户端声明 capabilities.batch 时整批作为一条 run_batch 消息（客户端按顺序执行），否则逐条发送"""
+    items = []
+    for job in jobs:
+        payload = dict(job['payload'], request_id=job['request_id'])
+        _new_request(client_uuid, job['event'], requester_sid=job['requester_sid'],
+                     request_id=job['request_id'], codec=job['codec'])
+        if job['event'] == 'file_operation':
+            path = payload.get('path', '')
+            pending_requests[job['request_id']]['path'] = path
+            if payload.get('operation') in ('write_file', 'delete_file', 'delete_dir'):
+                _invalidate_listings(client_uuid, path, recursive=payload['operation'] == 'delete_dir')
+        items.append({'event': OFFLINE_AGENT_EVENTS[job['event']], 'data': payload})
+    metric_offline_requests.inc('dispatched', amount=len(jobs))
+    # 批次大小已由 OFFLINE_FLUSH_BATCH / OFFLINE_FLUSH_BATCH_BYTES 限制，不受出站队列上限拒绝
+    if connected_clients[sid].batch:
+        bulk = any(item['data'].get('file_data') for item in items)
+        _send_to_agent(sid, 'run_batch', {'items': items}, BULK if bulk else COMMAND, force=True)
+    else:
+        for item in items:
+            _send_to_agent(sid, item['event'], item['data'], BULK if item['data'].get('file_data') else COMMAND,
+                           force=True)
+    return [job['request_id'] for job in jobs]
+
+def _expire_offline_requests():
+    """删除离线队列中过期的请求，通知发起者与观察者"""
+    try:
+        expired = offline_queue.expire()
+    except Exception as e:
+        logger.error(f'清理离线队列失败: {e}')
+        return
+    if expired:
+        metric_offline_requests.inc('expired', amount=len(expired))
+    for job in expired:
+        logger.info(f"离线请求过期: {job['request_id']} ({job['event']} -> {job['uuid']})")
+        _emit_to_console('request_timeout', {
+            'request_id': job['request_id'],
+            'uuid': job['uuid'],
+            'event': job['event'],
+            'queued': True,
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }, job['requester_sid'], job['uuid'])
+
+# ============ 消息压缩 ============
+
+def _negotiate_compression(auth):
+    """从客户端握手 auth.capabilities.compression 中选出服务端支持的压缩方式"""
+    capabilities = auth.get('capabilities') if isinstance(auth, dict) else None
+    offered = (capabilities or {}).get('compression') or []
+    return next((codec for codec in COMPRESSION_CODECS if codec in offered), None)
+
+def _negotiate_binary(auth):
+    """客户端握手声明 auth.capabilities.binary 且服务端启用 BINARY_PAYLOADS 时，原始字节以二进制附件收发"""
+    capabilities = auth.get('capabilities') if isinstance(auth, dict) else None
+    return BINARY_PAYLOADS and bool((capabilities or {}).get('binary'))
+
+def _negotiate_batch(auth):
+    """客户端握手声明 auth.capabilities.batch 时，离线队列以 run_batch 成批下发"""
+    capabilities = auth.get('capabilities') if isinstance(auth, dict) else None
+    return bool((capabilities or {}).get('batch'))
+
+def _read_agent_bytes(data, field):
+    """读取客户端消息中的原始字节：二进制帧 [4字节大端头长度][JSON头][字节] 的数据部分，
+    或旧版客户端 JSON 中的 <field>_base64 字段；返回 (消息头, 字节或 None)"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        header, body = _unpack_binary_frame(data)
+        return header, bytes(body)
+    encoded = data.get(f'{field}_base64')
+    if not encoded:
+        return data, None
+    return data, base64.b64decode(encoded)
+
+def _decode_agent_message(data):
+    """客户端消息可能是压缩帧：[4字节大端头长度][JSON头][zlib 压缩的 JSON 字段]。
+    返回 (合并后的消息, 压缩数据)；压缩数据 {encoding, body, fields} 用于原样转发给能解压的控制台，普通消息为 None"""
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        return data, None
+    header, body = _unpack_binary_frame(data)
+    encoding = header.pop('encoding', None)
+    if encoding not in COMPRESSION_CODECS:
+        raise ValueError(f'不支持的压缩方式: {encoding}')
+    body = bytes(body)
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(body, MAX_DECOMPRESSED_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError('解压后的消息过大')
+    fields = json.loads(raw)
+    header.update(fields)
+    return header, {'encoding': encoding, 'body': body, 'fields': list(fields)}
 
 # ============ WebSocket 事件处理器 ============
 
 @socketio.on('connect')
 def handle_connect(auth):
-    """客户端连接事件（支持从auth载荷读取UUID）"""
-    logger.info(f'客户端连接: {request.sid} auth={auth}')
+    """客户端连接事件（支持从auth载荷读取UUID）；带 UUID 的客户端握手经过准入控制，繁忙时拒绝并给出 retry_after"""
     # 从请求中获取客户端IP
     client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', 'Unknown'))
     
     # 临时存储连接信息，等待客户端注册UUID
     client_uuid = None
+    tags = []
     if isinstance(auth, dict):
         client_uuid = auth.get('uuid')
+        tags = [str(t) for t in (auth.get('tags') or []) if t]
+    if client_uuid:
+        retry_after = admission.try_acquire()
+        if retry_after is not None:
+            metric_handshakes.inc('rejected')
+            _close_refused_connection(request.sid)
+            raise ConnectionRefusedError('服务端繁忙，请稍后重连', {'retry_after': round(retry_after, 2)})
+        metric_handshakes.inc('accepted')
+    # 不记录完整 auth：其中可能带有凭据，重连风暴时也会产生大量日志
+    logger.info(f'客户端连接: {request.sid} uuid={client_uuid} ip={client_ip}')
 
-    connected_clients[request.sid] = {
-        'uuid': client_uuid,
-        'connect_time': datetime.now(),
-        'ip': client_ip,
-        'type': 'agent'  # 默认标记为代理客户端，Web端会在join_web_client中覆盖
-    }
+    # 默认标记为代理客户端，Web端会在join_web_client中覆盖
+    connected_clients.add(request.sid, client_ip, uuid=client_uuid, tags=tags,
+                          compression=_negotiate_compression(auth), binary=_negotiate_binary(auth),
+                          batch=_negotiate_batch(auth))
+    _ensure_worker_tasks()
+    _ensure_loop_monitor()
+    _ensure_download_sweeper()
     if client_uuid:
-        # 若已有旧 SID，移除旧记录并断开旧连接，确保不会在前端出现重复客户端
-        old_sid = client_uuid_mapping.get(client_uuid)
-        if old_sid and old_sid != request.sid:
+        try:
+            # 若已有旧 SID，移除旧记录（旧连接在收尾任务中断开），确保不会在前端出现重复客户端
+            old_sid = agent_registry.get(client_uuid)
+            if old_sid == request.sid:
+                old_sid = None
+            if old_sid:
+                connected_clients.remove(old_sid)
+            # 覆盖为最新 SID
+            _register_agent(client_uuid, request.sid)
+            schedule_client_list_update(client_uuid)
+        except Exception:
+            admission.release()
+            raise
+        socketio.start_background_task(_finish_agent_handshake, client_uuid, request.sid, old_sid)
+
+def _finish_agent_handshake(client_uuid, sid, old_sid):
+    """握手收尾（后台任务，在连接确认发出之后运行）：断开同一 UUID 的旧连接，下发协商结果，续传未完成的传输，
+    开始下发离线队列；完成后释放准入控制中进行中的名额"""
+    try:
+        if old_sid:
             try:
-                if old_sid in connected_clients:
-                    del connected_clients[old_sid]
                 # 主动断开旧SID（若仍存活）
-                disconnect(old_sid)
+                socketio.server.disconnect(old_sid, namespace='/')
             except Exception as e:
                 logger.error(f'清理旧连接失败: {e}')
-        # 覆盖为最新 SID
-        client_uuid_mapping[client_uuid] = request.sid
-        logger.info(f'客户端注册(握手auth): {client_uuid} (SID: {request.sid})')
-        emit_client_list_update()
+        info = connected_clients.get(sid)
+        if info is None:
+            return  # 收尾前已断开
+        if info.compression or info.binary:
+            # 在 connect 处理函数中 emit 会排在连接确认之前，
+            # 并发握手时还会让这些连接的握手拖到下一次心跳（ping_interval）才完成
+            socketio.emit('server_capabilities', {
+                'compression': info.compression,
+                'threshold': COMPRESSION_THRESHOLD,
+                'binary': info.binary
+            }, to=sid)
+        _resume_download_transfers(client_uuid, sid)
+        _resume_upload_relays(client_uuid, sid)
+        _start_offline_flush(client_uuid, sid)
+    except Exception as e:
+        logger.error(f'客户端 {client_uuid} 连接后处理失败: {e}')
+    finally:
+        admission.release()
+
+def _close_refused_connection(sid):
+    """拒绝握手后关闭底层 engine.io 连接：新版客户端收到 retry_after 后自行断开并延后重连，
+    旧版客户端不处理连接错误，靠连接关闭触发其自身的重连退避"""
+    eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+    if eio_sid:
+        socketio.start_background_task(_delayed_eio_close, eio_sid)
+
+def _delayed_eio_close(eio_sid):
+    socketio.sleep(HANDSHAKE_REFUSED_CLOSE_DELAY)  # 等错误包送达
+    socketio.server.eio.disconnect(eio_sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
@@ -141,17 +902,25 @@ def handle_disconnect():
     logger.info(f'客户端断开连接: {request.sid}')
     
     # 从连接列表中移除
-    if request.sid in connected_clients:
-        client_info = connected_clients[request.sid]
-        if client_info['uuid']:
-            # 仅当映射仍指向本次断开的 SID 时才移除，避免覆盖新连接
-            current_sid = client_uuid_mapping.get(client_info['uuid'])
-            if current_sid == request.sid:
-                client_uuid_mapping.pop(client_info['uuid'], None)
-        del connected_clients[request.sid]
+    client_info = connected_clients.remove(request.sid)
+    client_uuid = client_info.uuid if client_info else None
+    if client_uuid:
+        # 仅当注册表仍指向本次断开的 SID 时才移除，避免覆盖新连接
+        agent_registry.unregister(client_uuid, request.sid)
+        # 按客户端的字节计数随连接释放，标签数量不随历史客户端增长
+        metric_agent_received.remove(client_uuid)
+        metric_agent_sent.remove(client_uuid)
+    # 排队中的消息随连接丢弃：带请求ID的立即通知发起者，上传分块在重连后从已确认的 offset 续传
+    _fail_discarded(outbound.discard(request.sid), '客户端已断开')
+    _suspend_upload_relays(request.sid)
+    if client_uuid in screen_streams:
+        _stop_screen_stream(client_uuid, reason='客户端已断开', notify_agent=False)
+    for stream_uuid in [u for u, stream in screen_streams.items() if request.sid in stream['viewers']]:
+        _remove_screen_viewer(stream_uuid, request.sid)
     
-    # 通知所有Web客户端更新客户端列表
-    emit_client_list_update()
+    # 通知所有Web客户端更新客户端列表（合并为增量）
+    if client_uuid:
+        schedule_client_list_update(client_uuid)
 
 @socketio.on('register_client')
 def handle_client_register(data):
@@ -164,11 +933,16 @@ def handle_client_register(data):
 
         logger.info(f'客户端注册(事件): {client_uuid} (SID: {request.sid})')
         if request.sid in connected_clients:
-            connected_clients[request.sid]['uuid'] = client_uuid
-            connected_clients[request.sid]['type'] = 'agent'
-            client_uuid_mapping[client_uuid] = request.sid
+            connected_clients.set_uuid(request.sid, client_uuid)
+            connected_clients.set_type(request.sid, AGENT)
+            if data.get('tags'):
+                connected_clients[request.sid].tags = tuple(str(t) for t in data['tags'] if t)
+            _register_agent(client_uuid, request.sid)
             emit('register_success', {'message': '注册成功'})
-            emit_client_list_update()
+            schedule_client_list_update(client_uuid)
+            _resume_download_transfers(client_uuid, request.sid)
+            _resume_upload_relays(client_uuid, request.sid)
+            _start_offline_flush(client_uuid, request.sid)
         else:
             emit('error', {'message': '连接信息不存在'})
     except Exception as e:
@@ -179,49 +953,131 @@ def handle_client_register(data):
 def handle_command_output(data):
     """处理来自客户端的命令执行结果"""
     try:
+        data, compressed = _decode_agent_message(data)
         client_uuid = data.get('uuid')
         output_raw = data.get('output', '')
         error_raw = data.get('error', '')
-        # 保持控制台体验：不强制 strip，保留 \n；仅去掉我们自己的结束标记与 PS 提示符
-        output = _sanitize_output_text(output_raw)
-        error = _sanitize_output_text(error_raw)
+        if data.get('clean'):
+            # 客户端已按同样的规则清理（去掉结束标记与提示符行、统一换行、去掉首尾空白）：原样转发，
+            # 压缩数据与解压后的内容保持一致
+            output, error = output_raw, error_raw
+        else:
+            # 去掉我们自己的结束标记与 PS 提示符
+            output = _sanitize_output_text(output_raw)
+            error = _sanitize_output_text(error_raw)
+            if compressed and (output != output_raw or error != error_raw):
+                compressed = None  # 清理改动了内容：不再转发客户端的压缩数据
         command = data.get('command', '')
+        request_id = data.get('request_id')
+        streamed = bool(data.get('streamed'))
         
-        logger.info(f'收到客户端 {client_uuid} 的命令输出')
+        logger.info(f'收到客户端 {client_uuid} 的命令输出' + ('（流式结束）' if streamed else ''))
+        pending = pending_requests.get(request_id) if request_id else None
+        chunks = data.get('chunks', 0)
+        if streamed and pending and pending.get('sanitizers'):
+            # 送出清理器中尚未结束的行尾，序号接在客户端分块之后
+            for stream, sanitizer in pending.pop('sanitizers').items():
+                rest = sanitizer.finish()
+                if rest:
+                    _emit_reply('command_output_chunk', _record_history('command_output_chunk', {
+                        'uuid': client_uuid, 'request_id': request_id, 'seq': chunks,
+                        'stream': stream, 'data': rest
+                    }), request_id, client_uuid, done=False)
+                    chunks += 1
+        if pending and pending['job_id']:
+            # 批量任务的结果聚合到任务记录，不逐台回送
+            pending_requests.pop(request_id, None)
+            _observe_roundtrip(pending)
+            _report_fleet_result(pending, request_id, 'completed', output, error)
+            return
         
-        # 转发给所有Web客户端
-        socketio.emit('command_response', {
+        # 仅回送给发起请求的控制台与观察者
+        _emit_reply('command_response', _record_history('command_response', {
             'uuid': client_uuid,
+            'request_id': request_id,
             'command': command,
             'output': output,
             'error': error,
+            'streamed': streamed,
+            'chunks': chunks,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }, room='web_clients')
+        }), request_id, client_uuid, compressed=compressed)
         
     except Exception as e:
         logger.error(f'处理命令输出失败: {e}')
 
+@socketio.on('command_output_chunk')
+def handle_command_output_chunk(data):
+    """处理流式命令输出分块：立即转发给发起请求的控制台与观察者，命令结束时客户端另发 command_output"""
+    try:
+        data, compressed = _decode_agent_message(data)
+        client_uuid = data.get('uuid')
+        request_id = data.get('request_id')
+        stream = 'stderr' if data.get('stream') == 'stderr' else 'stdout'
+        pending = pending_requests.get(request_id) if request_id else None
+        if pending:
+            # 命令仍在产生输出：顺延超时，长时间运行的命令不会被误判超时
+            pending['deadline'] = time.time() + REQUEST_TIMEOUT
+        if data.get('clean'):
+            # 客户端已逐行去掉结束标记与提示符行：原样转发，压缩数据与解压后的内容保持一致
+            text = data.get('data', '')
+        elif pending:
+            # 每个请求的 stdout/stderr 各用一个增量清理器，跨分块保留未结束的行
+            sanitizer = pending.setdefault('sanitizers', {}).setdefault(stream, OutputSanitizer())
+            text = sanitizer.feed(data.get('data', ''))
+        else:
+            sanitizer = OutputSanitizer()
+            text = sanitizer.feed(data.get('data', '')) + sanitizer.finish()
+        payload = {
+            'uuid': client_uuid,
+            'request_id': request_id,
+            'seq': data.get('seq', 0),
+            'stream': stream,
+            'data': text
+        }
+        if text:
+            # 仅含未结束行首的空分块只用于保持序号连续，不写入历史
+            _record_history('command_output_chunk', payload)
+        _emit_reply('command_output_chunk', payload, request_id, client_uuid, done=False, compressed=compressed)
+    except Exception as e:
+        logger.error(f'处理命令输出分块失败: {e}')
+
 @socketio.on('file_operation_result')
 def handle_file_operation_result(data):
     """处理来自客户端的文件操作结果"""
     try:
+        data, compressed = _decode_agent_message(data)
         client_uuid = data.get('uuid')
         operation = data.get('operation')
         success = data.get('success', False)
         result_data = data.get('data', {})
         error = data.get('error', '')
+        request_id = data.get('request_id')
         
         logger.info(f'收到客户端 {client_uuid} 的文件操作结果: {operation}')
+        if request_id in listing_fetches:
+            # 旧版客户端不支持分批，整个目录作为一次结果返回
+            handle_list_dir_chunk({
+                'request_id': request_id,
+                'entries': result_data if success else [],
+                'error': None if success else (error or '读取目录失败'),
+                'eof': True
+            })
+            return
+        pending = pending_requests.get(request_id) if request_id else None
+        if success and pending and pending.get('path') and operation in ('write_file', 'delete_file', 'delete_dir'):
+            _invalidate_listings(client_uuid, pending['path'], recursive=operation == 'delete_dir')
         
-        # 转发给所有Web客户端
-        socketio.emit('file_operation_response', {
+        # 仅回送给发起请求的控制台与观察者
+        _emit_reply('file_operation_response', _record_history('file_operation_response', {
             'uuid': client_uuid,
+            'request_id': request_id,
             'operation': operation,
             'success': success,
             'data': result_data,
             'error': error,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }, room='web_clients')
+        }), request_id, client_uuid, compressed=compressed)
         
     except Exception as e:
         logger.error(f'处理文件操作结果失败: {e}')
@@ -234,40 +1090,277 @@ def handle_upload_file_result(data):
         success = data.get('success', False)
         path = data.get('path', '')
         error = data.get('error', '')
-        socketio.emit('upload_file_response', {
+        transfer_id = data.get('transfer_id')
+        relay = upload_relays.get(transfer_id)
+        if success and (path or relay):
+            _invalidate_listings(client_uuid, path or relay['path'])
+        if relay:
+            if success:
+                relay['acked'] = relay['size']
+                _emit_upload_progress(transfer_id, force=True)
+            _finish_upload_relay(transfer_id)
+            _pump_upload_relays(relay['sid'])  # 释放的窗口留给该客户端的其他上传
+        payload = {
             'uuid': client_uuid,
+            'transfer_id': transfer_id,
             'success': success,
             'path': path,
             'error': error,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }, room='web_clients')
+        }
+        if relay:
+            _emit_to_console('upload_file_response', payload, relay['requester_sid'], client_uuid)
+        else:
+            socketio.emit('upload_file_response', payload, room='web_clients')
     except Exception as e:
         logger.error(f'处理上传结果失败: {e}')
 
+def _unpack_binary_frame(frame):
+    """解析二进制分块帧：[4字节大端头长度][JSON头][原始数据]"""
+    if isinstance(frame, dict):
+        # 兼容以 Socket.IO 二进制附件形式发送的 {..., data: bytes}
+        payload = frame.get('data') or b''
+        header = {k: v for k, v in frame.items() if k != 'data'}
+        return header, bytes(payload)
+    frame = bytes(frame)
+    if len(frame) < 4:
+        raise ValueError('分块帧过短')
+    header_len = int.from_bytes(frame[:4], 'big')
+    if header_len > len(frame) - 4:
+        raise ValueError('分块帧头长度非法')
+    header = json.loads(frame[4:4 + header_len].decode('utf-8'))
+    return header, memoryview(frame)[4 + header_len:]
+
+def _pack_binary_frame(header, data):
+    """构造二进制分块帧，与 _unpack_binary_frame 对应"""
+    header_bytes = json.dumps(header).encode('utf-8')
+    return len(header_bytes).to_bytes(4, 'big') + header_bytes + bytes(data)
+
+def _new_download_transfer(client_uuid, path, requester_sid):
+    """登记一次分块下载传输，返回 transfer_id"""
+    _expire_download_transfers()
+    transfer_id = secrets.token_hex(8)
+    os.makedirs(DOWNLOAD_PARTIAL_DIR, exist_ok=True)
+    temp_path = os.path.join(DOWNLOAD_PARTIAL_DIR, f'{transfer_id}.part')
+    # 预先创建空临时文件，续传时按 offset 追加
+    open(temp_path, 'wb').close()
+    download_transfers[transfer_id] = {
+        'uuid': client_uuid,
+        'path': path,
+        'offset': 0,
+        'size': None,
+        'temp_path': temp_path,
+        'requester_sid': requester_sid,
+        'resume_sid': None,
+        'updated_at': time.time(),
+        'phase': 'digest',  # digest: 等待客户端上报摘要；waiting: 等待同内容的传输；chunks: 正在传输
+        'sha256': None,
+        'hasher': hashlib.sha256(),
+    }
+    return transfer_id
+
+def _request_download_chunks(transfer_id, target_sid):
+    """请求客户端从已确认的 offset 开始（继续）发送分块"""
+    transfer = download_transfers[transfer_id]
+    transfer['resume_sid'] = target_sid
+    # 请求本身很小且数量受进行中的传输数限制，不受排队上限约束
+    _send_to_agent(target_sid, 'download_file', {
+        'path': transfer['path'],
+        'transfer_id': transfer_id,
+        'offset': transfer['offset'],
+        'chunk_size': DOWNLOAD_CHUNK_SIZE,
+        # 先只上报内容摘要，服务端已有相同内容时无需传输（旧版客户端忽略该字段直接传输）
+        'digest_first': transfer['phase'] == 'digest',
+    }, COMMAND, force=True)
+
+def _resume_download_transfers(client_uuid, sid):
+    """客户端重连后，从最后确认的 offset 续传其未完成的下载"""
+    _expire_download_transfers()
+    for transfer_id, transfer in list(download_transfers.items()):
+        if transfer['uuid'] != client_uuid or transfer['resume_sid'] == sid:
+            continue
+        if transfer['phase'] == 'waiting':
+            # 等待同内容传输完成，无需客户端参与；仅更新续传目标
+            transfer['resume_sid'] = sid
+            continue
+        logger.info(f"续传下载 {transfer_id}: {transfer['path']} 自 offset={transfer['offset']}")
+        _request_download_chunks(transfer_id, sid)
+
+def _download_name(path):
+    return os.path.basename(path.replace('\\', '/')) or 'downloaded.bin'
+
+def _download_url(record):
+    return url_for('download_saved_file', filename=f"{record['id']}/{record['name']}")
+
+def _finish_download_transfer(transfer_id, success, error=''):
+    """结束传输：成功则存入下载存储（相同内容只保存一份）并通知控制台下载链接，失败则清理临时文件"""
+    transfer = download_transfers.pop(transfer_id, None)
+    if not transfer:
+        return
+    record = None
+    deduplicated = False
+    digest = transfer['sha256']
+    if success:
+        try:
+            name = _download_name(transfer['path'])
+            if transfer['phase'] == 'chunks':
+                received = transfer['hasher'].hexdigest()
+                if digest and received != digest:
+                    # 文件在上报摘要后被修改（例如仍在写入的日志）：以实际收到的内容为准
+                    logger.info(f'下载内容与上报摘要不一致 {transfer_id}，按实际内容保存')
+                digest = received
+                record, deduplicated = download_store.add_file(transfer['temp_path'], digest, transfer['offset'],
+                                                               transfer['uuid'], transfer['path'], name)
+                if not deduplicated:
+                    _schedule_precompress(record)
+            else:
+                record = download_store.add_existing(digest, transfer['uuid'], transfer['path'], name)
+                deduplicated = True
+                if record is None:
+                    raise ValueError('相同内容已被淘汰')
+            logger.info(f"客户端下载保存: {transfer['path']} -> {record['hash']}"
+                        f"{'（内容已存在，未重复写入）' if deduplicated else ''}")
+        except Exception as save_e:
+            logger.error(f'保存下载文件失败: {save_e}')
+            error = f'保存下载文件失败: {save_e}'
+            success = False
+    if not success or transfer['phase'] != 'chunks':
+        # 失败或未经传输（内容已存在）：临时文件不再需要；已传输成功的临时文件已移入存储
+        try:
+            os.remove(transfer['temp_path'])
+        except OSError:
+            pass
+    if transfer['sha256'] and download_digest_leaders.get(transfer['sha256']) == transfer_id:
+        download_digest_leaders.pop(transfer['sha256'])
+        _release_digest_waiters(transfer['sha256'], success and digest == transfer['sha256'])
+    _emit_to_console('file_download_response', {
+        'uuid': transfer['uuid'],
+        'transfer_id': transfer_id,
+        'success': success,
+        'path': transfer['path'],
+        'size': record['size'] if record else None,
+        'sha256': record['hash'] if record else None,
+        'deduplicated': deduplicated,
+        'download_url': _download_url(record) if record else None,
+        'error': error,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }, transfer['requester_sid'], transfer['uuid'])
+
+def _release_digest_waiters(digest, stored):
+    """同内容的传输结束：内容已入库时等待者直接完成，否则由第一个等待者接着传输"""
+    for transfer_id, transfer in list(download_transfers.items()):
+        if transfer['phase'] != 'waiting' or transfer['sha256'] != digest:
+            continue
+        if stored:
+            _finish_download_transfer(transfer_id, True)
+        elif digest not in download_digest_leaders:
+            transfer['phase'] = 'chunks'
+            download_digest_leaders[digest] = transfer_id
+            target_sid = agent_registry.get(transfer['uuid'])
+            if target_sid:
+                _request_download_chunks(transfer_id, target_sid)
+
+@socketio.on('download_file_digest')
+def handle_download_file_digest(data):
+    """客户端上报待下载文件的摘要：内容已存在则直接完成，同内容正在传输则等待，否则开始分块传输"""
+    try:
+        transfer_id = data.get('transfer_id')
+        transfer = download_transfers.get(transfer_id)
+        if not transfer or transfer['phase'] != 'digest':
+            return
+        digest = str(data.get('sha256') or '').lower()
+        size = int(data.get('size') or 0)
+        transfer['sha256'] = digest
+        transfer['size'] = size
+        transfer['updated_at'] = time.time()
+        if size > DOWNLOAD_STORE_MAX_BYTES:
+            _finish_download_transfer(transfer_id, False, '文件大小超过下载存储配额')
+            return
+        if download_store.has(digest) is not None:
+            _finish_download_transfer(transfer_id, True)
+            return
+        if digest in download_digest_leaders:
+            transfer['phase'] = 'waiting'
+            logger.info(f'下载 {transfer_id} 与传输 {download_digest_leaders[digest]} 内容相同，等待其完成')
+            return
+        transfer['phase'] = 'chunks'
+        download_digest_leaders[digest] = transfer_id
+        _request_download_chunks(transfer_id, request.sid)
+    except Exception as e:
+        logger.error(f'处理下载摘要失败: {e}')
+
+def _expire_download_transfers():
+    """清理长时间没有进展的未完成传输"""
+    now = time.time()
+    for transfer_id, transfer in list(download_transfers.items()):
+        if now - transfer['updated_at'] > DOWNLOAD_TRANSFER_TTL:
+            logger.info(f'下载传输超时清理: {transfer_id}')
+            _finish_download_transfer(transfer_id, False, '下载传输超时')
+
+@socketio.on('download_file_chunk')
+def handle_download_file_chunk(frame):
+    """处理客户端分块下载数据：校验 offset/长度/CRC32 后直接追加写入临时文件，返回确认的 offset"""
+    try:
+        header, chunk = _unpack_binary_frame(frame)
+        transfer_id = header.get('transfer_id')
+        transfer = download_transfers.get(transfer_id)
+        if not transfer:
+            return {'ok': False, 'error': '未知的传输ID'}
+        offset = int(header.get('offset', -1))
+        if offset != transfer['offset']:
+            # 乱序或重复分块（例如重连后旧连接残留），告知客户端应从何处继续
+            return {'ok': False, 'offset': transfer['offset'], 'error': 'offset 不匹配'}
+        if int(header.get('length', -1)) != len(chunk):
+            return {'ok': False, 'offset': transfer['offset'], 'error': '分块长度不匹配'}
+        if header.get('crc32') is not None and zlib.crc32(chunk) != int(header['crc32']):
+            return {'ok': False, 'offset': transfer['offset'], 'error': '分块校验失败'}
+        with open(transfer['temp_path'], 'r+b') as f:
+            f.seek(offset)
+            f.write(chunk)
+            f.truncate()
+        # 分块严格按 offset 顺序追加，边收边计算摘要，完成时无需重新读取文件
+        transfer['phase'] = 'chunks'
+        transfer['hasher'].update(chunk)
+        transfer['offset'] = offset + len(chunk)
+        transfer['updated_at'] = time.time()
+        if header.get('total_size') is not None:
+            transfer['size'] = int(header['total_size'])
+        if header.get('eof'):
+            _finish_download_transfer(transfer_id, True)
+        return {'ok': True, 'offset': transfer['offset']}
+    except Exception as e:
+        logger.error(f'处理下载分块失败: {e}')
+        return {'ok': False, 'error': str(e)}
+
 @socketio.on('download_file_result')
 def handle_download_file_result(data):
-    """处理来自客户端的下载结果并转发给Web端"""
+    """处理来自客户端的下载结果：分块传输的失败回执，或不支持分块的客户端回传的整文件（二进制帧或 base64）"""
     try:
+        data, data_bytes = _read_agent_bytes(data, 'file')
+        transfer_id = data.get('transfer_id')
+        if transfer_id:
+            if not data.get('success', False):
+                logger.error(f"客户端分块下载失败 {transfer_id}: {data.get('error', '')}")
+                _finish_download_transfer(transfer_id, False, data.get('error', ''))
+            return
+        # 兼容不支持分块的客户端：整文件一次回传，仅向控制台发送下载链接
         client_uuid = data.get('uuid')
         success = data.get('success', False)
         path = data.get('path', '')
-        file_base64 = data.get('file_base64', '')
         error = data.get('error', '')
-        download_url = None
-        if success and file_base64:
+        record = None
+        deduplicated = False
+        if success and data_bytes:
             try:
-                # 保存到服务器下载目录
-                os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-                base_name = os.path.basename(path) or 'downloaded.bin'
-                ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-                safe_name = f"{ts}_{base_name}"
-                import base64
-                data_bytes = base64.b64decode(file_base64)
-                server_path = os.path.join(DOWNLOAD_DIR, safe_name)
-                with open(server_path, 'wb') as f:
+                os.makedirs(DOWNLOAD_PARTIAL_DIR, exist_ok=True)
+                temp_path = os.path.join(DOWNLOAD_PARTIAL_DIR, f'{secrets.token_hex(8)}.part')
+                with open(temp_path, 'wb') as f:
                     f.write(data_bytes)
-                download_url = url_for('download_saved_file', filename=safe_name)
-                logger.info(f"客户端下载保存: {server_path} -> {download_url}")
+                record, deduplicated = download_store.add_file(temp_path, hashlib.sha256(data_bytes).hexdigest(),
+                                                               len(data_bytes), client_uuid, path, _download_name(path))
+                if not deduplicated:
+                    _schedule_precompress(record)
+                logger.info(f"客户端下载保存: {path} -> {record['hash']}")
             except Exception as save_e:
                 logger.error(f'保存下载文件失败: {save_e}')
                 error = f'保存下载文件失败: {save_e}'
@@ -276,93 +1369,729 @@ def handle_download_file_result(data):
             'uuid': client_uuid,
             'success': success,
             'path': path,
-            'file_base64': file_base64,
-            'download_url': download_url,
+            'size': record['size'] if record else None,
+            'sha256': record['hash'] if record else None,
+            'deduplicated': deduplicated,
+            'download_url': _download_url(record) if record else None,
             'error': error,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }, room='web_clients')
     except Exception as e:
         logger.error(f'处理下载结果失败: {e}')
         
+def _stage_upload(stream):
+    """将上传数据流按块写入暂存文件（内存占用与文件大小无关），返回 staging_id
+    超过 MAX_UPLOAD_SIZE 时删除已写入的部分并抛出 ValueError"""
+    os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+    staging_id = secrets.token_hex(8)
+    file_path = os.path.join(UPLOAD_STAGING_DIR, staging_id)
+    size = 0
+    try:
+        with open(file_path, 'wb') as f:
+            while True:
+                block = stream.read(UPLOAD_CHUNK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                if size > MAX_UPLOAD_SIZE:
+                    raise ValueError(f'上传文件超过大小上限 {MAX_UPLOAD_SIZE} 字节')
+                f.write(block)
+    except BaseException:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+        raise
+    upload_stagings[staging_id] = {'file_path': file_path, 'size': size, 'refs': 0}
+    return staging_id
+
+def _link_or_copy(src, dst):
+    """为其他 worker 准备一份暂存文件：优先硬链接，跨文件系统或不支持硬链接（EXDEV / EPERM 等）时复制"""
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        logger.info(f'硬链接暂存文件失败（{e}），改为复制')
+        shutil.copyfile(src, dst)
+
+def _release_upload_staging(staging_id):
+    """暂存文件的所有转发结束后删除"""
+    staging = upload_stagings.get(staging_id)
+    if not staging:
+        return
+    staging['refs'] -= 1
+    if staging['refs'] <= 0:
+        upload_stagings.pop(staging_id, None)
+        try:
+            os.remove(staging['file_path'])
+        except OSError:
+            pass
+
+def _start_upload_relay(staging_id, target_uuid, target_sid, path, requester_sid):
+    """为一个目标客户端登记转发并发送首个窗口，返回 transfer_id"""
+    staging = upload_stagings[staging_id]
+    staging['refs'] += 1
+    _invalidate_listings(target_uuid, path)
+    transfer_id = secrets.token_hex(8)
+    upload_relays[transfer_id] = {
+        'uuid': target_uuid,
+        'sid': target_sid,
+        'path': path,
+        'staging_id': staging_id,
+        'size': staging['size'],
+        'sent': 0,
+        'acked': 0,
+        'eof_sent': False,
+        'requester_sid': requester_sid,
+        'last_progress': 0.0,
+    }
+    _pump_upload_relays(target_sid)
+    return transfer_id
+
+def _pump_upload_relays(sid):
+    """在窗口允许范围内继续向客户端发送分块：同一客户端的所有上传共享 UPLOAD_WINDOW_SIZE 的未确认字节，
+    先开始的上传优先；窗口用满时暂停，等待客户端确认。在途的批量数据有上限，之后发给该客户端的命令最多等待一个窗口"""
+    if sid is None:
+        return
+    relays = [(tid, r) for tid, r in upload_relays.items() if r['sid'] == sid]
+    in_flight = sum(r['sent'] - r['acked'] for _, r in relays)
+    for tid, r in relays:
+        while not r['eof_sent'] and in_flight < UPLOAD_WINDOW_SIZE:
+            in_flight += _send_upload_chunk(tid, r)
+
+def _send_upload_chunk(transfer_id, relay):
+    """发送转发的下一块，返回发送的字节数"""
+    offset = relay['sent']
+    with open(upload_stagings[relay['staging_id']]['file_path'], 'rb') as f:
+        f.seek(offset)
+        chunk = f.read(UPLOAD_CHUNK_SIZE)
+    eof = offset + len(chunk) >= relay['size']
+    # 先推进 sent 再发送，避免发送期间并发确认导致重复发送同一分块
+    relay['sent'] = offset + len(chunk)
+    relay['eof_sent'] = eof
+    # 在途字节已由确认窗口限制，分块不受排队上限约束，但排在控制与命令消息之后
+    _send_to_agent(relay['sid'], 'upload_file_chunk', _pack_binary_frame({
+        'transfer_id': transfer_id,
+        'path': relay['path'],
+        'offset': offset,
+        'length': len(chunk),
+        'total_size': relay['size'],
+        'crc32': zlib.crc32(chunk),
+        'eof': eof,
+    }, chunk), BULK, force=True)
+    return len(chunk)
+
+def _emit_upload_progress(transfer_id, force=False):
+    """向控制台推送上传进度（节流）"""
+    relay = upload_relays.get(transfer_id)
+    if not relay:
+        return
+    now = time.time()
+    if not force and now - relay['last_progress'] < UPLOAD_PROGRESS_INTERVAL:
+        return
+    relay['last_progress'] = now
+    _emit_to_console('upload_file_progress', {
+        'uuid': relay['uuid'],
+        'transfer_id': transfer_id,
+        'path': relay['path'],
+        'offset': relay['acked'],
+        'size': relay['size'],
+    }, relay['requester_sid'], relay['uuid'])
+
+def _finish_upload_relay(transfer_id):
+    """结束一次转发并释放暂存文件引用"""
+    relay = upload_relays.pop(transfer_id, None)
+    if relay:
+        _release_upload_staging(relay['staging_id'])
+    return relay
+
+def _suspend_upload_relays(sid):
+    """客户端断开：暂停其转发，等待重连后从已确认的 offset 续传"""
+    for relay in upload_relays.values():
+        if relay['sid'] == sid:
+            relay['sid'] = None
+
+def _resume_upload_relays(client_uuid, sid):
+    """客户端重连后，从最后确认的 offset 续传未完成的上传"""
+    for transfer_id, relay in list(upload_relays.items()):
+        if relay['uuid'] != client_uuid or relay['sid'] == sid:
+            continue
+        logger.info(f"续传上传 {transfer_id}: {relay['path']} 自 offset={relay['acked']}")
+        relay['sid'] = sid
+        relay['sent'] = relay['acked']
+        relay['eof_sent'] = False
+    _pump_upload_relays(sid)
+
+@app.route('/upload', methods=['POST'])
+def upload_to_clients():
+    """流式上传：请求体为原始文件数据，落盘暂存后分块转发到一个或多个客户端
+    查询参数：target_uuid（可重复）、path（客户端保存路径，含文件名）、sid（可选）
+    """
+    if not session.get('authenticated'):
+        return {'success': False, 'error': '未认证'}, 401
+    target_uuids = request.args.getlist('target_uuid')
+    path = request.args.get('path')
+    requester_sid = request.args.get('sid')  # 发起上传的控制台 Socket.IO sid（可选）
+    if not target_uuids or not path:
+        return {'success': False, 'error': '缺少目标UUID或路径'}, 400
+    if (request.content_length or 0) > MAX_UPLOAD_SIZE:
+        return {'success': False, 'error': f'上传文件超过大小上限 {MAX_UPLOAD_SIZE} 字节'}, 413
+    try:
+        staging_id = _stage_upload(request.stream)
+    except ValueError as e:
+        # 未声明 Content-Length（分块传输）时在写入过程中发现超限
+        return {'success': False, 'error': str(e)}, 413
+    except Exception as e:
+        logger.error(f'上传暂存失败: {e}')
+        return {'success': False, 'error': f'上传暂存失败: {e}'}, 500
+    transfers = []
+    errors = []
+    for target_uuid in target_uuids:
+        target = agent_registry.get_entry(target_uuid)
+        if not target:
+            errors.append({'uuid': target_uuid, 'error': f'客户端 {target_uuid} 未连接'})
+            continue
+        if target['worker'] != WORKER_ID:
+            # 客户端在其他 worker：为其硬链接一份暂存文件（需共享 UPLOAD_STAGING_DIR），由该 worker 负责转发
+            link_id = secrets.token_hex(8)
+            link_path = os.path.join(UPLOAD_STAGING_DIR, link_id)
+            try:
+                _link_or_copy(upload_stagings[staging_id]['file_path'], link_path)
+                agent_registry.publish(target['worker'], {
+                    'type': 'upload_relay',
+                    'staging_id': link_id,
+                    'size': upload_stagings[staging_id]['size'],
+                    'uuid': target_uuid,
+                    'path': path,
+                    'requester_sid': requester_sid,
+                })
+            except Exception as e:
+                logger.error(f"转发上传到 worker {target['worker']} 失败: {e}")
+                try:
+                    os.remove(link_path)
+                except OSError:
+                    pass
+                errors.append({'uuid': target_uuid, 'error': f'转发到客户端所在 worker 失败: {e}'})
+                continue
+            logger.info(f"转发上传到 worker {target['worker']} 上的客户端 {target_uuid}: {path}")
+            transfers.append({'uuid': target_uuid, 'transfer_id': None})
+            continue
+        transfer_id = _start_upload_relay(staging_id, target_uuid, target['sid'], path, requester_sid)
+        logger.info(f'转发上传到客户端 {target_uuid}: {path} (传输ID: {transfer_id})')
+        transfers.append({'uuid': target_uuid, 'transfer_id': transfer_id})
+    size = upload_stagings[staging_id]['size']
+    if upload_stagings[staging_id]['refs'] == 0:
+        # 本 worker 没有需要转发的目标时立即清理暂存文件
+        _release_upload_staging(staging_id)
+    return {
+        'success': bool(transfers),
+        'size': size,
+        'transfers': transfers,
+        'errors': errors,
+    }
+
+@socketio.on('upload_file_ack')
+def handle_upload_file_ack(data):
+    """客户端确认已写入的 offset，推进发送窗口"""
+    try:
+        transfer_id = data.get('transfer_id')
+        relay = upload_relays.get(transfer_id)
+        if not relay:
+            return
+        offset = int(data.get('offset', 0))
+        if offset > relay['acked']:
+            relay['acked'] = min(offset, relay['size'])
+        _emit_upload_progress(transfer_id)
+        _pump_upload_relays(relay['sid'])
+    except Exception as e:
+        logger.error(f'处理上传确认失败: {e}')
+
+def _schedule_precompress(record):
+    if DOWNLOAD_PRECOMPRESS and record['size'] >= PRECOMPRESS_MIN_SIZE:
+        socketio.start_background_task(_precompress_download, record['hash'])
+
+def _precompress_download(digest):
+    """后台为下载内容生成 gzip 预压缩版本；抽样压缩率不理想（已压缩的文件等）时跳过"""
+    src = download_store.blob_path(digest)
+    dst = download_store.variant_path(digest)
+    tmp = dst + '.part'
+    try:
+        with open(src, 'rb') as f:
+            sample = f.read(PRECOMPRESS_SAMPLE)
+            if len(zlib.compress(sample, 6)) > len(sample) * PRECOMPRESS_MAX_RATIO:
+                return
+            f.seek(0)
+            size = 0
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31：gzip 格式
+            with open(tmp, 'wb') as out:
+                while True:
+                    block = f.read(PRECOMPRESS_SAMPLE)
+                    if not block:
+                        break
+                    size += len(block)
+                    out.write(compressor.compress(block))
+                    socketio.sleep(0)  # 按块让出事件循环
+                out.write(compressor.flush())
+        gz_size = os.path.getsize(tmp)
+        if gz_size > size * PRECOMPRESS_MAX_RATIO:
+            os.remove(tmp)
+            return
+        os.replace(tmp, dst)
+        if download_store.set_variant(digest, gz_size):
+            logger.info(f'生成下载预压缩版本: {digest} {size} -> {gz_size} 字节')
+    except Exception as e:
+        logger.error(f'生成预压缩版本失败 {digest}: {e}')
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def _ensure_download_sweeper():
+    global _download_sweeper_started
+    if not _download_sweeper_started:
+        _download_sweeper_started = True
+        socketio.start_background_task(_download_store_sweeper)
+
+def _download_store_sweeper():
+    """后台任务：启动时及之后定期淘汰下载存储中过期与超出配额的内容，并清理过期的旧版下载文件"""
+    while True:
+        _sweep_downloads()
+        socketio.sleep(DOWNLOAD_STORE_SWEEP_INTERVAL)
+
+def _sweep_downloads():
+    try:
+        removed = download_store.evict()
+        if removed:
+            logger.info(f'下载存储淘汰内容: {removed} 个')
+    except Exception as e:
+        logger.error(f'下载存储淘汰失败: {e}')
+    cutoff = time.time() - DOWNLOAD_STORE_MAX_AGE_DAYS * 86400
+    try:
+        entries = list(os.scandir(DOWNLOAD_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if (LEGACY_DOWNLOAD_NAME.match(entry.name) and entry.is_file(follow_symlinks=False)
+                    and entry.stat().st_mtime < cutoff):
+                os.remove(entry.path)
+                logger.info(f'清理过期的旧版下载文件: {entry.name}')
+        except OSError as e:
+            logger.error(f'清理旧版下载文件失败 {entry.name}: {e}')
+
+class _SendfileResponse(Response):
+    """接管 eventlet 连接：写出响应头后用 os.sendfile 发送文件区间，数据不经过 Python；发送完毕关闭连接"""
+
+    def __init__(self, response, file_path, offset, length, sock):
+        super().__init__(status=response.status, headers=response.headers)
+        self.sendfile_args = (file_path, offset, length, sock)
+
+    def __call__(self, environ, start_response):
+        from eventlet import wsgi as eventlet_wsgi
+        file_path, offset, length, sock = self.sendfile_args
+        headers = self.get_wsgi_headers(environ)
+        if 'Date' not in headers:
+            headers['Date'] = http_date()
+        headers['Connection'] = 'close'
+        head = [f"{environ.get('SERVER_PROTOCOL', 'HTTP/1.1')} {self.status}"]
+        head.extend(f'{key}: {value}' for key, value in headers.to_wsgi_list())
+        try:
+            sock.sendall(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+            with open(file_path, 'rb') as f:
+                _sendfile_all(sock, f.fileno(), offset, length)
+        except (OSError, TimeoutError) as e:
+            logger.info(f'下载连接中断: {e}')
+        # 告知 eventlet 响应已自行发送，不再写出任何内容
+        eventlet_wsgi.WSGI_LOCAL.already_handled = True
+        return []
+
+def _sendfile_all(sock, in_fd, offset, length):
+    from eventlet.hubs import trampoline
+    out_fd = sock.fileno()
+    while length > 0:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset, min(length, SENDFILE_BLOCK))
+        except BlockingIOError:
+            # 套接字发送缓冲区已满：挂起当前协程直到可写
+            trampoline(sock, write=True, timeout=SENDFILE_IDLE_TIMEOUT, timeout_exc=TimeoutError)
+            continue
+        if sent == 0:
+            break  # 文件被截断
+        offset += sent
+        length -= sent
+        socketio.sleep(0)
+
+def _zero_copy(response, file_path):
+    """满足条件时把 send_file 的响应换成 _SendfileResponse；否则原样返回（经 Python 分块读取发送）"""
+    length = response.content_length
+    if (request.method != 'GET' or response.status_code not in (200, 206) or not length
+            or length < SENDFILE_MIN_SIZE or not hasattr(os, 'sendfile')):
+        return response
+    request_input = request.environ.get('eventlet.input')
+    sock = request_input.get_socket() if request_input is not None else None
+    # HTTPS 直接由 eventlet 终止时数据需经 TLS 加密，不能绕过 Python
+    if sock is None or request.environ.get('wsgi.url_scheme') == 'https':
+        return response
+    offset = response.content_range.start if response.status_code == 206 else 0
+    response.close()  # 关闭 send_file 打开的文件，改由 sendfile 自行打开
+    return _SendfileResponse(response, file_path, offset, length, sock)
+
 @app.route('/download/<path:filename>')
 def download_saved_file(filename):
-    """提供服务器已保存的下载文件"""
-    return send_from_directory(DOWNLOAD_DIR, filename, as_attachment=True)
+    """提供服务器已保存的下载文件（需已登录）：<下载记录ID>/<文件名>；兼容旧版直接保存在下载目录中的文件
+    支持 Range 续传与条件请求；客户端接受 gzip 且存在预压缩版本时发送压缩版本"""
+    if not session.get('authenticated'):
+        return {'success': False, 'error': '未认证'}, 401
+    record_id, _, name = filename.partition('/')
+    record = download_store.get(record_id) if name else None
+    if record:
+        use_gzip = bool(record['gz_size']) and request.accept_encodings['gzip'] > 0
+        file_path = record['gz_path'] if use_gzip else record['blob_path']
+        response = send_file(file_path, as_attachment=True, download_name=record['name'], conditional=True,
+                             etag=record['hash'] + ('-gz' if use_gzip else ''),
+                             last_modified=record['created_at'], max_age=0)
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        if record['gz_size']:
+            response.vary.add('Accept-Encoding')
+        return _zero_copy(response, file_path)
+    # 不暴露存储目录与未完成的分块
+    file_path = None if name or filename.startswith('.') else safe_join(DOWNLOAD_DIR, filename)
+    if not file_path or not os.path.isfile(file_path):
+        return {'success': False, 'error': '文件不存在或已被清理'}, 404
+    return _zero_copy(send_file(file_path, as_attachment=True, conditional=True, max_age=0), file_path)
+
+def _screenshot_key(client_uuid, display_index):
+    try:
+        return (client_uuid, int(display_index or 0))
+    except (TypeError, ValueError):
+        return (client_uuid, 0)
+
+def _cache_screenshot(key, image_bytes):
+    """写入缓存帧，超出内存上限时淘汰最久未使用的帧"""
+    global _screenshot_cache_bytes
+    old = screenshot_cache.pop(key, None)
+    if old:
+        _screenshot_cache_bytes -= len(old['data'])
+    entry = {
+        'data': image_bytes,
+        'etag': hashlib.blake2b(image_bytes, digest_size=12).hexdigest(),
+        'captured_at': time.time()
+    }
+    screenshot_cache[key] = entry
+    _screenshot_cache_bytes += len(image_bytes)
+    while _screenshot_cache_bytes > SCREENSHOT_CACHE_MAX_BYTES and len(screenshot_cache) > 1:
+        _, evicted = screenshot_cache.popitem(last=False)
+        _screenshot_cache_bytes -= len(evicted['data'])
+    return entry
+
+def _get_cached_screenshot(key, max_age=None):
+    """读取缓存帧（过期则移除）；max_age 限定可复用的帧龄"""
+    global _screenshot_cache_bytes
+    entry = screenshot_cache.get(key)
+    if not entry:
+        return None
+    age = time.time() - entry['captured_at']
+    if age > SCREENSHOT_CACHE_TTL:
+        del screenshot_cache[key]
+        _screenshot_cache_bytes -= len(entry['data'])
+        return None
+    if max_age is not None and age > max_age:
+        return None
+    screenshot_cache.move_to_end(key)
+    return entry
+
+def _shared_screenshot_path(key):
+    client_uuid, display_index = key
+    name = hashlib.blake2b(f'{client_uuid}\0{display_index}'.encode(), digest_size=12).hexdigest()
+    return os.path.join(SCREENSHOT_SHARED_DIR, f'{name}.png')
+
+def _share_screenshot(key, image_bytes):
+    """多 worker 部署：把最近一帧写入共享目录（先写临时文件再替换，读取方不会读到半帧）"""
+    if not agent_registry.shared:
+        return
+    path = _shared_screenshot_path(key)
+    try:
+        os.makedirs(SCREENSHOT_SHARED_DIR, exist_ok=True)
+        tmp = f'{path}.{WORKER_ID.replace(":", "_")}.part'
+        with open(tmp, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.error(f'写入共享截图失败: {e}')
+
+def _read_shared_screenshot(key):
+    """本 worker 没有缓存帧时读取其他 worker 写入共享目录的最近一帧（超过缓存保留时长的视为不存在）"""
+    if not agent_registry.shared:
+        return None
+    path = _shared_screenshot_path(key)
+    try:
+        captured_at = os.path.getmtime(path)
+        if time.time() - captured_at > SCREENSHOT_CACHE_TTL:
+            os.remove(path)
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    return {'data': data, 'etag': hashlib.blake2b(data, digest_size=12).hexdigest(), 'captured_at': captured_at}
+
+def _fail_screenshot(pending, request_id, error):
+    """截图请求未得到结果（超时、未能发出）：以失败的 screenshot_response 结束发起者与等待同一次截图的控制台"""
+    key = tuple(pending['screenshot_key'])
+    inflight = screenshot_inflight.get(key)
+    waiters = set()
+    if inflight and inflight['request_id'] == request_id:
+        del screenshot_inflight[key]
+        waiters = inflight['waiters']
+    payload = {
+        'uuid': pending['uuid'],
+        'display_index': key[1],
+        'request_id': request_id,
+        'success': False,
+        'error': error,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    _emit_to_console('screenshot_response', payload, pending['requester_sid'], pending['uuid'])
+    if waiters:
+        socketio.emit('screenshot_response', payload, to=list(waiters))
+
+def _screenshot_notice(key, entry):
+    """截图更新通知：只携带图片地址与版本，控制台再通过 HTTP 获取图片"""
+    client_uuid, display_index = key
+    return {
+        'uuid': client_uuid,
+        'display_index': display_index,
+        'success': True,
+        'image_url': url_for('get_screenshot', client_uuid=client_uuid, display_index=display_index, v=entry['etag']),
+        'etag': entry['etag'],
+        'size': len(entry['data']),
+        'captured_at': datetime.fromtimestamp(entry['captured_at']).strftime('%Y-%m-%d %H:%M:%S'),
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+@app.route('/history')
+def get_history():
+    """分页读取命令/结果历史（按序号倒序翻页）
+    查询参数：uuid、request_id、since（Unix 时间戳）、before_seq、limit（默认 100，最大 500）；
+    watch、request_ids（逗号分隔）任一存在时只返回属于这些客户端或请求的记录（与 join_web_client 的补发范围一致）
+    """
+    if not session.get('authenticated'):
+        return {'success': False, 'error': '未认证'}, 401
+    try:
+        before_seq = request.args.get('before_seq', type=int)
+        limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+        uuids, request_ids = (None if value is None else [x for x in value.split(',') if x]
+                              for value in (request.args.get('watch'), request.args.get('request_ids')))
+        entries, next_before_seq = history_store.page(
+            uuid=request.args.get('uuid') or None,
+            request_id=request.args.get('request_id') or None,
+            before_seq=before_seq,
+            since=request.args.get('since', type=float),
+            limit=limit,
+            uuids=uuids,
+            request_ids=request_ids)
+        return {'success': True, 'entries': entries, 'next_before_seq': next_before_seq}
+    except Exception as e:
+        logger.error(f'读取历史失败: {e}')
+        return {'success': False, 'error': str(e)}, 500
+
+@app.route('/metrics')
+def get_metrics():
+    """导出运行指标（Prometheus 文本格式）；设置 METRICS_TOKEN 时用 Bearer 令牌认证，否则需要登录"""
+    if METRICS_TOKEN:
+        if not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            return {'success': False, 'error': '未认证'}, 401
+    elif not session.get('authenticated'):
+        return {'success': False, 'error': '未认证'}, 401
+    _ensure_loop_monitor()
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/screenshot/<client_uuid>')
+def get_screenshot(client_uuid):
+    """提供客户端最近一帧截图（原始 PNG），支持 If-None-Match / If-Modified-Since 条件请求"""
+    if not session.get('authenticated'):
+        return {'success': False, 'error': '未认证'}, 401
+    key = _screenshot_key(client_uuid, request.args.get('display_index'))
+    entry = _get_cached_screenshot(key) or _read_shared_screenshot(key)
+    if not entry:
+        return {'success': False, 'error': '没有可用的截图'}, 404
+    response = app.response_class(entry['data'], mimetype='image/png')
+    response.set_etag(entry['etag'])
+    response.last_modified = datetime.fromtimestamp(entry['captured_at'], tz=timezone.utc)
+    # 允许浏览器缓存，但每次使用前带 ETag 重新验证（未变化时返回 304）
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @socketio.on('screenshot_result')
 def handle_screenshot_result(data):
-    """处理客户端截图结果，转发给Web端"""
+    """处理客户端截图结果：PNG 写入缓存（二进制帧直接使用，旧版客户端 base64 解码一次），向控制台只发送更新通知"""
     try:
+        data, image = _read_agent_bytes(data, 'image')
         client_uuid = data.get('uuid')
         success = data.get('success', False)
-        image_base64 = data.get('image_base64', '')
         error = data.get('error', '')
-        socketio.emit('screenshot_response', {
-            'uuid': client_uuid,
-            'success': success,
-            'image_base64': image_base64,
-            'error': error,
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }, room='web_clients')
+        request_id = data.get('request_id')
+        pending = pending_requests.get(request_id) if request_id else None
+        key = pending.get('screenshot_key') if pending else None
+        key = tuple(key) if key else _screenshot_key(client_uuid, 0)
+        if success:
+            entry = _cache_screenshot(key, image or b'')
+            _share_screenshot(key, entry['data'])
+            payload = {**_screenshot_notice(key, entry), 'request_id': request_id}
+        else:
+            payload = {
+                'uuid': client_uuid,
+                'request_id': request_id,
+                'success': False,
+                'error': error,
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+        inflight = screenshot_inflight.get(key)
+        if inflight and inflight['request_id'] == request_id:
+            del screenshot_inflight[key]
+        _emit_reply('screenshot_response', payload, request_id, client_uuid)
+        if inflight and inflight['request_id'] == request_id and inflight['waiters']:
+            # 截图进行中加入等待的控制台共享同一次截图
+            socketio.emit('screenshot_response', payload, to=list(inflight['waiters']))
     except Exception as e:
         logger.error(f'处理截图结果失败: {e}')
 
 # ============ Web客户端事件处理器 ============
 
 @socketio.on('join_web_client')
-def handle_join_web_client():
-    """Web客户端加入房间"""
+def handle_join_web_client(data=None):
+    """Web客户端加入房间；只补发该控制台发起的请求（request_ids）及其观察的客户端（watch）的历史：
+    携带 since_seq 时补发该序号之后的记录，否则发送最近一页"""
+    data = data or {}
     join_room('web_clients')
     # 标记此连接为web控制台端，以防被误认为agent
     if request.sid in connected_clients:
-        connected_clients[request.sid]['type'] = 'web'
-    emit('client_list', {'clients': get_client_list()})
+        connected_clients.set_type(request.sid, WEB)
+    emit('client_list', {'clients': get_client_list(), 'seq': agent_registry.current_seq()})
+    # 重连的控制台在加入时恢复观察
+    for target_uuid in data.get('watch') or []:
+        if target_uuid:
+            _join_watch(str(target_uuid), data.get('compression'))
+    uuids, request_ids = _console_history_scope(data.get('request_ids'))
+    since_seq = data.get('since_seq')
+    try:
+        before_seq = None
+        if since_seq is not None:
+            entries, more = history_store.since(int(since_seq), limit=HISTORY_REPLAY_LIMIT,
+                                                uuids=uuids, request_ids=request_ids)
+            if more:
+                since_seq = None  # 断开期间的记录超过补发上限：改为发送最近一页，更早的由控制台分页加载
+        if since_seq is None:
+            entries, before_seq = history_store.page(limit=HISTORY_REPLAY_LIMIT, uuids=uuids, request_ids=request_ids)
+        emit('history_replay', {
+            'entries': entries,
+            'since_seq': since_seq,
+            'before_seq': before_seq,  # 非空表示还有更早的记录，可通过 /history?before_seq=… 加载
+            'latest_seq': history_store.latest_seq()
+        })
+    except Exception as e:
+        logger.error(f'补发历史失败: {e}')
     logger.info(f'Web客户端加入: {request.sid}')
 
+def _console_history_scope(request_ids):
+    """控制台可见的历史范围：(当前连接观察的客户端, 控制台上报的自己发起的请求ID)，请求ID最多取最近的补发条数"""
+    subrooms = tuple(f':{codec}' for codec in ('plain', *COMPRESSION_CODECS))
+    uuids = [room[len('watch:'):] for room in rooms()
+             if room.startswith('watch:') and not room.endswith(subrooms)]
+    if isinstance(request_ids, str):
+        request_ids = request_ids.split(',')
+    request_ids = [str(r) for r in (request_ids or []) if r][-HISTORY_REPLAY_LIMIT:]
+    return uuids, request_ids
+
+@socketio.on('get_client_list_snapshot')
+def handle_get_client_list_snapshot():
+    """控制台发现增量序号不连续时请求完整快照"""
+    emit('client_list', {'clients': get_client_list(), 'seq': agent_registry.current_seq()})
+
 @socketio.on('leave_web_client')
 def handle_leave_web_client():
     """Web客户端离开房间"""
     leave_room('web_clients')
     logger.info(f'Web客户端离开: {request.sid}')
 
+@socketio.on('watch_client')
+def handle_watch_client(data):
+    """控制台订阅某个客户端的全部结果（共享查看）"""
+    target_uuid = (data or {}).get('target_uuid')
+    if not target_uuid:
+        emit('error', {'message': '缺少目标UUID'})
+        return
+    _join_watch(target_uuid, data.get('compression'))
+
+def _join_watch(target_uuid, codec):
+    join_room(_watch_room(target_uuid))
+    # 压缩消息按控制台能否解压分两路发送，观察者另加入对应的子房间
+    join_room(_watch_room(target_uuid, codec if codec in COMPRESSION_CODECS else 'plain'))
+    logger.info(f'Web客户端 {request.sid} 开始观察 {target_uuid}')
+
+@socketio.on('unwatch_client')
+def handle_unwatch_client(data):
+    """控制台取消订阅某个客户端"""
+    target_uuid = (data or {}).get('target_uuid')
+    if target_uuid:
+        for room in (_watch_room(target_uuid), _watch_room(target_uuid, 'plain'),
+                     *(_watch_room(target_uuid, codec) for codec in COMPRESSION_CODECS)):
+            leave_room(room)
+
 @socketio.on('execute_command')
+@forward_to_agent_worker('execute_command')
 def handle_execute_command(data):
     """处理来自Web客户端的命令执行请求"""
     try:
         target_uuid = data.get('target_uuid')
         command = data.get('command')
         use_shared_context = data.get('use_shared_context', True)
+        stream = bool(data.get('stream', False))
         
         if not target_uuid or not command:
             emit('error', {'message': '缺少目标UUID或命令'})
             return
         
         # 查找目标客户端
-        target_sid = client_uuid_mapping.get(target_uuid)
+        target_sid = agent_registry.get(target_uuid)
         if not target_sid:
+            if data.get('queue_if_offline'):
+                _queue_offline_request(target_uuid, 'execute_command', {
+                    'command': command,
+                    'use_shared_context': use_shared_context,
+                    'stream': stream
+                }, data)
+                return
             emit('error', {'message': f'客户端 {target_uuid} 未连接'})
             return
         
-        logger.info(f'发送命令到客户端 {target_uuid}: {command}')
+        request_id = _new_request(target_uuid, 'execute_command', codec=data.get('compression'))
+        logger.info(f'发送命令到客户端 {target_uuid}: {command} (请求ID: {request_id})')
         
         # 发送命令到目标客户端
-        socketio.emit('run_command', {
+        if not _send_to_agent(target_sid, 'run_command', {
+            'request_id': request_id,
             'command': command,
-            'use_shared_context': use_shared_context
-        }, room=target_sid)
+            'use_shared_context': use_shared_context,
+            'stream': stream
+        }, COMMAND):
+            return
         
         # 通知Web客户端命令已发送
-        emit('command_sent', {
+        emit('command_sent', _record_history('command_sent', {
+            'request_id': request_id,
             'target_uuid': target_uuid,
             'command': command,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        })
+        }, target_uuid))
         
     except Exception as e:
         logger.error(f'执行命令失败: {e}')
         emit('error', {'message': f'执行命令失败: {str(e)}'})
 
 @socketio.on('file_operation')
+@forward_to_agent_worker('file_operation')
 def handle_file_operation(data):
     """处理来自Web客户端的文件操作请求"""
     try:
@@ -376,22 +2105,41 @@ def handle_file_operation(data):
             return
         
         # 查找目标客户端
-        target_sid = client_uuid_mapping.get(target_uuid)
+        target_sid = agent_registry.get(target_uuid)
         if not target_sid:
+            if data.get('queue_if_offline') and operation != 'list_dir':
+                # 目录列表依赖缓存与分页，不排队
+                _queue_offline_request(target_uuid, 'file_operation', {
+                    'operation': operation,
+                    'path': path,
+                    'file_data': file_data
+                }, data)
+                return
             emit('error', {'message': f'客户端 {target_uuid} 未连接'})
             return
         
-        logger.info(f'发送文件操作到客户端 {target_uuid}: {operation} - {path}')
+        if operation == 'list_dir':
+            _request_listing(target_uuid, target_sid, path, data)
+            return
+        if operation in ('write_file', 'delete_file', 'delete_dir'):
+            _invalidate_listings(target_uuid, path, recursive=operation == 'delete_dir')
+        
+        request_id = _new_request(target_uuid, 'file_operation', codec=data.get('compression'))
+        pending_requests[request_id]['path'] = path
+        logger.info(f'发送文件操作到客户端 {target_uuid}: {operation} - {path} (请求ID: {request_id})')
         
-        # 发送文件操作请求到目标客户端
-        socketio.emit('do_file_operation', {
+        # 发送文件操作请求到目标客户端（携带文件内容的写入按批量传输排队）
+        if not _send_to_agent(target_sid, 'do_file_operation', {
+            'request_id': request_id,
             'operation': operation,
             'path': path,
             'file_data': file_data
-        }, room=target_sid)
+        }, BULK if file_data else COMMAND):
+            return
         
         # 通知Web客户端请求已发送
         emit('file_operation_sent', {
+            'request_id': request_id,
             'target_uuid': target_uuid,
             'operation': operation,
             'path': path,
@@ -403,6 +2151,7 @@ def handle_file_operation(data):
         emit('error', {'message': f'文件操作失败: {str(e)}'})
 
 @socketio.on('restart_client')
+@forward_to_agent_worker('restart_client')
 def handle_restart_client(data):
     """处理来自Web客户端的重启目标客户端请求"""
     try:
@@ -410,17 +2159,20 @@ def handle_restart_client(data):
         if not target_uuid:
             emit('error', {'message': '缺少目标UUID'})
             return
-        target_sid = client_uuid_mapping.get(target_uuid)
+        target_sid = agent_registry.get(target_uuid)
         if not target_sid:
             emit('error', {'message': f'客户端 {target_uuid} 未连接'})
             return
         logger.info(f'发送重启到客户端 {target_uuid}')
-        socketio.emit('restart', {}, room=target_sid)
+        if not _send_to_agent(target_sid, 'restart', {}, CONTROL):
+            emit('error', {'message': f'客户端 {target_uuid} 的发送队列已满，请稍后重试'})
+            return
         emit('info', {'message': f'已通知客户端 {target_uuid} 重启'})
     except Exception as e:
         logger.error(f'重启请求失败: {e}')
         emit('error', {'message': f'重启请求失败: {str(e)}'})
 @socketio.on('reset_context')
+@forward_to_agent_worker('reset_context')
 def handle_reset_context(data):
     """处理来自Web客户端的重置共享上下文请求"""
     try:
@@ -428,17 +2180,20 @@ def handle_reset_context(data):
         if not target_uuid:
             emit('error', {'message': '缺少目标UUID'})
             return
-        target_sid = client_uuid_mapping.get(target_uuid)
+        target_sid = agent_registry.get(target_uuid)
         if not target_sid:
             emit('error', {'message': f'客户端 {target_uuid} 未连接'})
             return
         logger.info(f'发送上下文重置到客户端 {target_uuid}')
-        socketio.emit('reset_context', {}, room=target_sid)
+        if not _send_to_agent(target_sid, 'reset_context', {}, CONTROL):
+            emit('error', {'message': f'客户端 {target_uuid} 的发送队列已满，请稍后重试'})
+            return
         emit('info', {'message': f'已通知客户端 {target_uuid} 重置共享上下文'})
     except Exception as e:
         logger.error(f'上下文重置请求失败: {e}')
         emit('error', {'message': f'上下文重置请求失败: {str(e)}'})
 @socketio.on('screenshot')
+@forward_to_agent_worker('screenshot')
 def handle_screenshot(data):
     """处理来自Web客户端的截图请求"""
     try:
@@ -447,18 +2202,33 @@ def handle_screenshot(data):
         if not target_uuid:
             emit('error', {'message': '缺少目标UUID'})
             return
-        target_sid = client_uuid_mapping.get(target_uuid)
+        target_sid = agent_registry.get(target_uuid)
         if not target_sid:
             emit('error', {'message': f'客户端 {target_uuid} 未连接'})
             return
-        socketio.emit('screenshot', {
+        key = _screenshot_key(target_uuid, display_index)
+        cached = _get_cached_screenshot(key, max_age=float(data.get('max_age', SCREENSHOT_MAX_AGE)))
+        if cached:
+            # 多个控制台短时间内查看同一客户端时共享一次截图
+            emit('screenshot_response', {**_screenshot_notice(key, cached), 'request_id': None, 'cached': True})
+            return
+        inflight = screenshot_inflight.get(key)
+        if inflight and inflight['request_id'] in pending_requests:
+            inflight['waiters'].add(request.sid)
+            return
+        request_id = _new_request(target_uuid, 'screenshot', timeout=SCREENSHOT_TIMEOUT)
+        pending_requests[request_id]['screenshot_key'] = key
+        screenshot_inflight[key] = {'request_id': request_id, 'waiters': set()}
+        _send_to_agent(target_sid, 'screenshot', {
+            'request_id': request_id,
             'display_index': display_index
-        }, room=target_sid)
+        }, COMMAND)
     except Exception as e:
         logger.error(f'截图请求失败: {e}')
         emit('error', {'message': f'截图请求失败: {str(e)}'})
 
 @socketio.on('upload_file_to_client')
+@forward_to_agent_worker('upload_file_to_client')
 def handle_upload_file_to_client(data):
     """处理来自Web客户端的上传请求并转发到目标客户端"""
     try:
@@ -468,20 +2238,21 @@ def handle_upload_file_to_client(data):
         if not target_uuid or not path or not file_base64:
             emit('error', {'message': '缺少目标UUID、路径或文件数据'})
             return
-        target_sid = client_uuid_mapping.get(target_uuid)
+        target_sid = agent_registry.get(target_uuid)
         if not target_sid:
             emit('error', {'message': f'客户端 {target_uuid} 未连接'})
             return
-        logger.info(f'转发上传到客户端 {target_uuid}: {path}')
-        socketio.emit('upload_file', {
-            'path': path,
-            'file_base64': file_base64,
-        }, room=target_sid)
+        # 兼容旧的 base64 上传：解码后落盘暂存，走与 HTTP 上传相同的分块转发
+        staging_id = _stage_upload(io.BytesIO(base64.b64decode(file_base64)))
+        del file_base64
+        transfer_id = _start_upload_relay(staging_id, target_uuid, target_sid, path, request.sid)
+        logger.info(f'转发上传到客户端 {target_uuid}: {path} (传输ID: {transfer_id})')
     except Exception as e:
         logger.error(f'上传转发失败: {e}')
         emit('error', {'message': f'上传转发失败: {str(e)}'})
 
 @socketio.on('download_file_from_client')
+@forward_to_agent_worker('download_file_from_client')
 def handle_download_file_from_client(data):
     """处理来自Web客户端的下载请求并转发到目标客户端"""
     try:
@@ -490,25 +2261,687 @@ def handle_download_file_from_client(data):
         if not target_uuid or not path:
             emit('error', {'message': '缺少目标UUID或路径'})
             return
-        target_sid = client_uuid_mapping.get(target_uuid)
+        target_sid = agent_registry.get(target_uuid)
         if not target_sid:
             emit('error', {'message': f'客户端 {target_uuid} 未连接'})
             return
-        logger.info(f'转发下载到客户端 {target_uuid}: {path}')
-        socketio.emit('download_file', {
-            'path': path,
-        }, room=target_sid)
+        transfer_id = _new_download_transfer(target_uuid, path, request.sid)
+        logger.info(f'转发下载到客户端 {target_uuid}: {path} (传输ID: {transfer_id})')
+        _request_download_chunks(transfer_id, target_sid)
     except Exception as e:
         logger.error(f'下载转发失败: {e}')
         emit('error', {'message': f'下载转发失败: {str(e)}'})
 
-def emit_client_list_update():
-    """向所有Web客户端发送客户端列表更新"""
+@socketio.on('get_queued_requests')
+def handle_get_queued_requests(data):
+    """查看某客户端离线队列中等待下发的请求（不含文件内容）"""
+    target_uuid = (data or {}).get('target_uuid')
+    if not target_uuid:
+        emit('error', {'message': '缺少目标UUID'})
+        return
+    jobs, total = offline_queue.list(target_uuid, limit=max(1, min(int(data.get('limit') or 100), 1000)))
+    emit('queued_requests', {
+        'uuid': target_uuid,
+        'total': total,
+        'requests': [{
+            'request_id': job['request_id'],
+            'event': job['event'],
+            **job['payload'],
+            'dedup_key': job['dedup_key'],
+            'created_at': datetime.fromtimestamp(job['created_at']).strftime('%Y-%m-%d %H:%M:%S'),
+            'expires_at': datetime.fromtimestamp(job['expires_at']).strftime('%Y-%m-%d %H:%M:%S'),
+        } for job in jobs]
+    })
+
+@socketio.on('cancel_queued_request')
+def handle_cancel_queued_request(data):
+    """取消一条尚未下发的离线请求"""
+    request_id = (data or {}).get('request_id')
+    job = offline_queue.cancel(request_id) if request_id else None
+    if not job:
+        emit('error', {'message': '请求不存在或已下发'})
+        return
+    metric_offline_requests.inc('cancelled')
+    _emit_to_console('queued_request_cancelled', _record_history('queued_request_cancelled', {
+        'request_id': request_id,
+        'uuid': job['uuid'],
+        'event': job['event'],
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }), request.sid, job['uuid'])
+
+# ============ 目录列表（分页与缓存） ============
+
+def _listing_path(path):
+    """缓存键使用的规范化路径（客户端为 Windows：不区分大小写，统一反斜杠）"""
+    return ntpath.normcase(ntpath.normpath(path or '.'))
+
+def _drop_listing(key):
+    global _listing_cache_entries
+    entry = listing_cache.pop(key, None)
+    if entry:
+        _listing_cache_entries -= len(entry['entries'])
+
+def _get_listing(key):
+    """读取缓存的目录列表：已完成且超过 LISTING_CACHE_TTL 的视为过期"""
+    entry = listing_cache.get(key)
+    if not entry:
+        return None
+    if entry['complete'] and time.time() - entry['fetched_at'] > LISTING_CACHE_TTL:
+        _drop_listing(key)
+        return None
+    listing_cache.move_to_end(key)
+    return entry
+
+def _trim_listing_cache():
+    """缓存条目总数超过上限时淘汰最久未使用的已完成列表"""
+    for key in list(listing_cache):
+        if _listing_cache_entries <= LISTING_CACHE_MAX_ENTRIES:
+            break
+        if listing_cache[key]['complete']:
+            _drop_listing(key)
+
+def _invalidate_listings(client_uuid, path, recursive=False):
+    """写入/删除/上传后使受影响的目录列表失效：路径本身与其父目录，recursive 时包括全部子目录"""
+    target = _listing_path(path)
+    parent = ntpath.dirname(target)
+    prefix = target.rstrip('\\') + '\\'
+    for key in [k for k in listing_cache if k[0] == client_uuid]:
+        if key[1] in (target, parent) or (recursive and key[1].startswith(prefix)):
+            if listing_cache[key]['complete']:
+                _drop_listing(key)
+            else:
+                # 读取中的列表照常交付等待者，但完成后不再缓存
+                listing_cache[key]['invalidated'] = True
+
+def _sorted_listing(entry, sort):
+    """按排序键返回列表（同一列表每种排序只计算一次）；none 为目录原始顺序"""
+    if sort == 'none':
+        return entry['entries']
+    if sort not in entry['sorted']:
+        key = sort.lstrip('-')
+        if key == 'name':
+            keyfunc = lambda item: (not item.get('is_dir'), str(item.get('name', '')).lower())
+        else:
+            keyfunc = lambda item: item.get(key) or 0
+        entry['sorted'][sort] = sorted(entry['entries'], key=keyfunc, reverse=sort.startswith('-'))
+    return entry['sorted'][sort]
+
+def _listing_page_ready(entry, waiter):
+    """排序需要完整列表；原始顺序在已收到足够条目时即可先返回一页"""
+    if entry['complete']:
+        return True
+    return waiter['sort'] == 'none' and len(entry['entries']) >= waiter['offset'] + waiter['page_size']
+
+def _send_listing_page(key, entry, waiter, cached):
+    client_uuid = key[0]
+    payload = {
+        'uuid': client_uuid,
+        'request_id': waiter['request_id'],
+        'operation': 'list_dir',
+        'path': entry['path'],
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    if entry['error']:
+        payload.update({'success': False, 'data': None, 'error': entry['error']})
+    else:
+        items = _sorted_listing(entry, waiter['sort'])
+        page = items[waiter['offset']:waiter['offset'] + waiter['page_size']]
+        next_offset = waiter['offset'] + len(page)
+        more = next_offset < len(items) or not entry['complete']
+        payload.update({
+            'success': True,
+            'data': page,
+            'error': '',
+            'sort': waiter['sort'],
+            'offset': waiter['offset'],
+            'total': len(items) if entry['complete'] else None,
+            'next_cursor': f"{entry['version']}:{waiter['sort']}:{next_offset}" if more else None,
+            'cached': cached,
+            'stale_cursor': waiter['stale']
+        })
+    _emit_to_console('file_operation_response', _record_history('file_operation_response', payload),
+                     waiter['sid'], client_uuid)
+
+def _request_listing(target_uuid, target_sid, path, options):
+    """处理控制台的目录列表请求：命中缓存直接返回一页，否则向客户端分批读取，读取期间的同目录请求共用一次读取"""
+    sort = options.get('sort') or 'name'
+    if sort != 'none' and sort.lstrip('-') not in LISTING_SORT_KEYS:
+        sort = 'name'
+    page_size = max(1, min(int(options.get('page_size') or LISTING_PAGE_SIZE), LISTING_MAX_PAGE_SIZE))
+    key = (target_uuid, _listing_path(path))
+    entry = _get_listing(key)
+    offset = 0
+    stale = False
+    cursor = options.get('cursor')
+    if cursor:
+        # 续页游标：<列表版本>:<排序键>:<偏移>
+        try:
+            version, sort, offset = cursor.split(':', 2)
+            offset = max(0, int(offset))
+            if sort != 'none' and sort.lstrip('-') not in LISTING_SORT_KEYS:
+                raise ValueError(sort)  # 排序键来自控制台，同样只接受已知的键
+        except ValueError:
+            emit('error', {'message': '无效的列表游标'})
+            return
+        stale = not entry or entry['version'] != version  # 列表已重新读取：按相同偏移继续，并提示控制台
+    waiter = {'sid': request.sid, 'request_id': secrets.token_hex(8), 'sort': sort, 'offset': offset,
+              'page_size': page_size, 'stale': stale}
+    if entry and not entry['error'] and (entry['complete'] or entry['request_id'] in pending_requests):
+        if _listing_page_ready(entry, waiter):
+            _send_listing_page(key, entry, waiter, cached=entry['complete'])
+        else:
+            entry['waiters'].append(waiter)
+        return
+    # 未缓存、已过期、上次读取失败或超时：重新向客户端读取（沿用仍在等待的请求）
+    waiters = (entry['waiters'] if entry else []) + [waiter]
+    _drop_listing(key)
+    request_id = _new_request(target_uuid, 'file_operation')
+    listing_cache[key] = {
+        'version': secrets.token_hex(4),
+        'path': path,
+        'entries': [],
+        'complete': False,
+        'error': None,
+        'fetched_at': 0.0,
+        'request_id': request_id,
+        'sorted': {},
+        'waiters': waiters,
+        'invalidated': False
+    }
+    listing_fetches[request_id] = key
+    logger.info(f'读取客户端 {target_uuid} 目录: {path} (请求ID: {request_id})')
+    _send_to_agent(target_sid, 'do_file_operation', {
+        'request_id': request_id,
+        'operation': 'list_dir',
+        'path': path,
+        'file_data': '',
+        'chunk_size': LISTING_CHUNK_SIZE
+    }, COMMAND)
+
+@socketio.on('list_dir_chunk')
+def handle_list_dir_chunk(data):
+    """处理客户端分批回传的目录条目：累积到缓存，满足条件的等待者立即获得对应页"""
+    global _listing_cache_entries
+    try:
+        data, _ = _decode_agent_message(data)  # 条目在服务端分页，不原样转发
+        request_id = data.get('request_id')
+        key = listing_fetches.get(request_id)
+        entry = listing_cache.get(key) if key else None
+        if not entry or entry['request_id'] != request_id:
+            return
+        pending = pending_requests.get(request_id)
+        if pending:
+            pending['deadline'] = time.time() + REQUEST_TIMEOUT
+        if data.get('error'):
+            entry['error'] = data['error']
+        else:
+            entries = data.get('entries') or []
+            entry['entries'].extend(entries)
+            _listing_cache_entries += len(entries)
+        if data.get('eof') or entry['error']:
+            entry['complete'] = True
+            entry['fetched_at'] = time.time()
+            listing_fetches.pop(request_id, None)
+            pending = pending_requests.pop(request_id, None)
+            if pending:
+                _observe_roundtrip(pending)
+        waiting = []
+        for waiter in entry['waiters']:
+            if _listing_page_ready(entry, waiter):
+                _send_listing_page(key, entry, waiter, cached=False)
+            else:
+                waiting.append(waiter)
+        entry['waiters'] = waiting
+        if entry['complete'] and (entry['error'] or entry['invalidated']):
+            _drop_listing(key)
+        _trim_listing_cache()
+    except Exception as e:
+        logger.error(f'处理目录列表分批结果失败: {e}')
+
+# ============ 实时画面（Screen streaming） ============
+
+def _stop_screen_stream(client_uuid, reason=None, notify_agent=True):
+    """结束某客户端的画面推送并通知仍在观看的控制台"""
+    stream = screen_streams.pop(client_uuid, None)
+    if not stream:
+        return
+    if notify_agent:
+        target_sid = agent_registry.get(client_uuid)
+        if target_sid:
+            _send_to_agent(target_sid, 'stop_screen_stream', {'stream_id': stream['stream_id']}, CONTROL, force=True)
+    if stream['viewers']:
+        socketio.emit('screen_stream_stopped', {'uuid': client_uuid, 'reason': reason},
+                      to=list(stream['viewers']))
+
+def _remove_screen_viewer(client_uuid, viewer_sid):
+    stream = screen_streams.get(client_uuid)
+    if not stream or stream['viewers'].pop(viewer_sid, None) is None:
+        return
+    if not stream['viewers']:
+        logger.info(f'客户端 {client_uuid} 的画面已无人观看，停止推送')
+        _stop_screen_stream(client_uuid)
+
+def _send_screen_frame(client_uuid, stream, viewer_sid, viewer):
+    """把观看者待发送的瓦片合并为一帧发出；确认前不再发送，期间的新帧只合并进待发送瓦片"""
+    tiles = viewer['pending']
+    viewer['pending'] = None
+    viewer['seq'] += 1
+    header = {
+        'uuid': client_uuid,
+        'seq': viewer['seq'],
+        'keyframe': viewer['keyframe'],
+        'width': stream['width'],
+        'height': stream['height'],
+        'tiles': [[x, y, w, h, len(data)] for x, y, w, h, data in tiles.values()]
+    }
+    viewer['keyframe'] = False
+    viewer['in_flight'] = viewer['seq']
+    viewer['sent_at'] = time.time()
+    frame = _pack_binary_frame(header, b''.join(tile[4] for tile in tiles.values()))
+    socketio.emit('screen_frame', frame, to=viewer_sid)
+
+@socketio.on('screen_frame')
+def handle_screen_frame(frame):
+    """处理客户端推送的画面帧：更新服务端的完整画面，并把变化合并进各观看者的待发送瓦片"""
+    try:
+        header, data = _unpack_binary_frame(frame)
+        info = connected_clients.get(request.sid)
+        client_uuid = info.uuid if info else None
+        stream = screen_streams.get(client_uuid)
+        if not stream or header.get('stream_id') != stream['stream_id']:
+            # 推送已结束（或重连后残留的旧任务），让客户端停止
+            emit('stop_screen_stream', {'stream_id': header.get('stream_id')})
+            return
+        tiles = {}
+        offset = 0
+        for index, x, y, w, h, length in header.get('tiles', []):
+            # 复制出独立的 bytes，避免单个瓦片引用整帧缓冲区使旧帧无法释放
+            tiles[index] = (x, y, w, h, bytes(data[offset:offset + length]))
+            offset += length
+        keyframe = bool(header.get('keyframe'))
+        if keyframe:
+            stream['tiles'] = tiles
+            stream['width'], stream['height'] = header.get('width'), header.get('height')
+        else:
+            stream['tiles'].update(tiles)
+        now = time.time()
+        for viewer_sid, viewer in list(stream['viewers'].items()):
+            if viewer['in_flight'] is not None and now - viewer['sent_at'] > SCREEN_VIEWER_TIMEOUT:
+                logger.info(f'观看者 {viewer_sid} 长时间未确认画面帧，移除')
+                _remove_screen_viewer(client_uuid, viewer_sid)
+                continue
+            if viewer['pending'] is not None:
+                viewer['dropped'] += 1  # 上一帧尚未发出即被本帧覆盖
+            if keyframe:
+                viewer['pending'] = dict(tiles)
+                viewer['keyframe'] = True
+            else:
+                if viewer['pending'] is None:
+                    viewer['pending'] = {}
+                viewer['pending'].update(tiles)
+            if viewer['in_flight'] is None:
+                _send_screen_frame(client_uuid, stream, viewer_sid, viewer)
+    except Exception as e:
+        logger.error(f'处理画面帧失败: {e}')
+
+@socketio.on('screen_stream_error')
+def handle_screen_stream_error(data):
+    """客户端截屏失败，推送已中止"""
+    client_uuid = data.get('uuid')
+    stream = screen_streams.get(client_uuid)
+    if stream and data.get('stream_id') == stream['stream_id']:
+        logger.error(f'客户端 {client_uuid} 画面推送失败: {data.get("error")}')
+        _stop_screen_stream(client_uuid, reason=data.get('error'), notify_agent=False)
+
+@socketio.on('start_screen_stream')
+@forward_to_agent_worker('start_screen_stream')
+def handle_start_screen_stream(data):
+    """开始观看客户端画面：同一客户端的多个观看者共用一路推送"""
+    try:
+        target_uuid = data.get('target_uuid')
+        if not target_uuid:
+            emit('error', {'message': '缺少目标UUID'})
+            return
+        target_sid = agent_registry.get(target_uuid)
+        if not target_sid:
+            emit('error', {'message': f'客户端 {target_uuid} 未连接'})
+            return
+        stream = screen_streams.get(target_uuid)
+        if not stream:
+            fps = max(1, min(int(data.get('fps') or SCREEN_DEFAULT_FPS), SCREEN_MAX_FPS))
+            stream = screen_streams[target_uuid] = {
+                'stream_id': secrets.token_hex(8),
+                'display_index': data.get('display_index'),
+                'fps': fps,
+                'width': 0,
+                'height': 0,
+                'tiles': {},
+                'viewers': {}
+            }
+            _send_to_agent(target_sid, 'start_screen_stream', {
+                'stream_id': stream['stream_id'],
+                'display_index': stream['display_index'],
+                'fps': fps
+            }, CONTROL, force=True)
+            logger.info(f'开始客户端 {target_uuid} 的画面推送 ({fps} fps)')
+        viewer = stream['viewers'].setdefault(request.sid, {
+            'pending': None, 'keyframe': False, 'in_flight': None, 'sent_at': 0, 'seq': 0, 'dropped': 0
+        })
+        emit('screen_stream_started', {
+            'uuid': target_uuid,
+            'fps': stream['fps'],
+            'display_index': stream['display_index']
+        })
+        if stream['tiles'] and viewer['in_flight'] is None:
+            # 中途加入的观看者直接从服务端保存的完整画面获得关键帧
+            viewer['pending'] = dict(stream['tiles'])
+            viewer['keyframe'] = True
+            _send_screen_frame(target_uuid, stream, request.sid, viewer)
+    except Exception as e:
+        logger.error(f'开始画面推送失败: {e}')
+        emit('error', {'message': f'开始画面推送失败: {str(e)}'})
+
+@socketio.on('stop_screen_stream')
+@forward_to_agent_worker('stop_screen_stream')
+def handle_stop_screen_stream(data):
+    """停止观看客户端画面；最后一个观看者离开时停止推送"""
+    target_uuid = data.get('target_uuid')
+    if target_uuid:
+        _remove_screen_viewer(target_uuid, request.sid)
+
+@socketio.on('screen_frame_ack')
+@forward_to_agent_worker('screen_frame_ack')
+def handle_screen_frame_ack(data):
+    """观看者确认已绘制某帧：有合并后的待发送瓦片则立即发送下一帧"""
+    stream = screen_streams.get(data.get('target_uuid'))
+    viewer = stream['viewers'].get(request.sid) if stream else None
+    if not viewer or viewer['in_flight'] != data.get('seq'):
+        return
+    viewer['in_flight'] = None
+    if viewer['pending']:
+        _send_screen_frame(data.get('target_uuid'), stream, request.sid, viewer)
+
+# ============ 批量执行（Fleet） ============
+
+def _select_fleet_targets(data):
+    """解析目标选择器：uuids 列表、tag 标签或 all（全部在线客户端）"""
+    if data.get('all'):
+        return agent_registry.uuids()
+    tag = data.get('tag')
+    if tag:
+        return [uuid for uuid, entry in agent_registry.entries()
+                if tag in entry['info'].get('tags', [])]
+    uuids = data.get('uuids') or []
+    # 保序去重
+    return list(dict.fromkeys(u for u in uuids if u))
+
+def _fleet_summary(job):
+    """任务进度汇总"""
+    counts = {'completed': 0, 'timeout': 0, 'offline': 0, 'queued': 0, 'failed': 0}
+    for result in job['results'].values():
+        if result['status'] in counts:
+            counts[result['status']] += 1
+    return {
+        'job_id': job['job_id'],
+        'command': job['command'],
+        'total': job['total'],
+        'pending': len(job['queue']),
+        'running': len(job['inflight']),
+        'done': job['total'] - len(job['queue']) - len(job['inflight']),
+        **counts,
+        'finished': job['finished'],
+        'elapsed_ms': int((time.time() - job['created_at']) * 1000),
+    }
+
+def _emit_fleet_progress(job_id, force=False):
+    """推送进度汇总并附带自上次推送以来完成的结果（节流合并，而非逐台推送）"""
+    job = fleet_jobs.get(job_id)
+    if not job:
+        return
+    now = time.time()
+    wait = FLEET_PROGRESS_INTERVAL - (now - job['last_progress'])
+    if not force and wait > 0:
+        if not job['flush_scheduled']:
+            job['flush_scheduled'] = True
+            socketio.start_background_task(_delayed_fleet_flush, job_id, wait)
+        return
+    job['last_progress'] = now
+    partial = job['unsent']
+    job['unsent'] = []
+    socketio.emit('fleet_job_done' if job['finished'] else 'fleet_job_progress', {
+        **_fleet_summary(job),
+        'results': partial,
+    }, to=job['requester_sid'])
+
+def _delayed_fleet_flush(job_id, wait):
+    """节流窗口结束后补发积压的进度"""
+    socketio.sleep(wait)
+    job = fleet_jobs.get(job_id)
+    if job:
+        job['flush_scheduled'] = False
+        if job['unsent'] and not job['finished']:
+            _emit_fleet_progress(job_id, force=True)
+
+def _record_fleet_result(job, client_uuid, status, output='', error='', latency_ms=None, request_id=None):
+    """记录单台客户端结果，并加入待推送的增量结果"""
+    result = {
+        'uuid': client_uuid,
+        'status': status,
+        'latency_ms': latency_ms,
+        'output': output,
+        'error': error,
+    }
+    if request_id:
+        # 已排队：客户端重连后结果按该请求ID单独回送
+        result['request_id'] = request_id
+    job['results'][client_uuid] = result
+    job['unsent'].append(result)
+
+def _pump_fleet_job(job_id):
+    """在并发窗口内继续派发；离线客户端直接记为 offline（或按 queue_if_offline 排队记为 queued），不占用窗口
+    派发过程中同步完成的目标（未连接、发送失败）会经 _complete_fleet_target 回到这里：只记录结果，由外层循环继续派发"""
+    job = fleet_jobs.get(job_id)
+    if not job or job['finished'] or job['pumping']:
+        return
+    job['pumping'] = True
+    try:
+        _dispatch_fleet_targets(job_id, job)
+    finally:
+        job['pumping'] = False
+    if not job['queue'] and not job['inflight']:
+        job['finished'] = True
+        logger.info(f"批量任务完成: {job_id} ({job['total']} 台)")
+        _emit_fleet_progress(job_id, force=True)
+        _trim_fleet_jobs()
+    else:
+        _emit_fleet_progress(job_id)
+
+def _dispatch_fleet_targets(job_id, job):
+    while job['queue'] and len(job['inflight']) < job['concurrency']:
+        target_uuid = job['queue'].popleft()
+        target = agent_registry.get_entry(target_uuid)
+        if not target:
+            if job['offline_options'] is None:
+                _record_fleet_result(job, target_uuid, 'offline', error=f'客户端 {target_uuid} 未连接')
+                continue
+            try:
+                queued, _ = _enqueue_offline(target_uuid, 'execute_command', {
+                    'command': job['command'],
+                    'use_shared_context': job['use_shared_context'],
+                    'stream': False
+                }, job['offline_options'], job['requester_sid'])
+                _record_fleet_result(job, target_uuid, 'queued', request_id=queued['request_id'])
+            except OverflowError as e:
+                _record_fleet_result(job, target_uuid, 'offline', error=str(e))
+            continue
+        request_id = secrets.token_hex(8)
+        job['inflight'][request_id] = (target_uuid, time.time())
+        job['results'][target_uuid] = {'uuid': target_uuid, 'status': 'running'}
+        dispatch = {
+            'type': 'fleet_dispatch',
+            'job_id': job_id,
+            'job_worker': WORKER_ID,
+            'request_id': request_id,
+            'uuid': target_uuid,
+            'command': job['command'],
+            'use_shared_context': job['use_shared_context'],
+            'timeout': job['timeout'],
+            'requester_sid': job['requester_sid'],
+        }
+        try:
+            if target['worker'] == WORKER_ID:
+                _dispatch_fleet_target_locally(dispatch)
+            else:
+                # 客户端连接在其他 worker：由该 worker 派发并登记待回复，结果再转发回本 worker
+                agent_registry.publish(target['worker'], dispatch)
+        except Exception as e:
+            pending_requests.pop(request_id, None)
+            job['inflight'].pop(request_id, None)
+            _record_fleet_result(job, target_uuid, 'failed', error=f'派发失败: {e}')
+
+def _dispatch_fleet_target_locally(dispatch):
+    """向本 worker 上的客户端派发批量任务中的一台，并以任务给定的请求ID登记待回复"""
+    target_sid = agent_registry.get(dispatch['uuid'])
+    pending = {'job_id': dispatch['job_id'], 'job_worker': dispatch['job_worker']}
+    if not target_sid or target_sid not in connected_clients:
+        _report_fleet_result(pending, dispatch['request_id'], 'offline', error=f"客户端 {dispatch['uuid']} 未连接")
+        return
+    _new_request(dispatch['uuid'], 'execute_command', timeout=dispatch['timeout'],
+                 requester_sid=dispatch['requester_sid'], job_id=dispatch['job_id'],
+                 job_worker=dispatch['job_worker'], request_id=dispatch['request_id'])
+    _send_to_agent(target_sid, 'run_command', {
+        'request_id': dispatch['request_id'],
+        'command': dispatch['command'],
+        'use_shared_context': dispatch['use_shared_context']
+    }, COMMAND)
+
+def _report_fleet_result(pending, request_id, status, output='', error=''):
+    """把单台结果交给批量任务所在的 worker（本 worker 则直接记录）"""
+    if pending['job_worker'] == WORKER_ID:
+        _complete_fleet_target(pending['job_id'], request_id, status, output, error)
+        return
+    agent_registry.publish(pending['job_worker'], {
+        'type': 'fleet_result',
+        'job_id': pending['job_id'],
+        'request_id': request_id,
+        'status': status,
+        'output': output,
+        'error': error,
+    })
+
+def _complete_fleet_target(job_id, request_id, status, output='', error=''):
+    """记录单台客户端的结果（完成或超时）并继续派发"""
+    job = fleet_jobs.get(job_id)
+    if not job:
+        return
+    entry = job['inflight'].pop(request_id, None)
+    if not entry:
+        return
+    target_uuid, started_at = entry
+    _record_fleet_result(job, target_uuid, status, output, error,
+                         latency_ms=int((time.time() - started_at) * 1000))
+    _pump_fleet_job(job_id)
+
+def _trim_fleet_jobs():
+    """仅保留最近 FLEET_JOB_HISTORY 个已完成任务"""
+    finished = [job_id for job_id, job in fleet_jobs.items() if job['finished']]
+    for job_id in finished[:max(0, len(finished) - FLEET_JOB_HISTORY)]:
+        fleet_jobs.pop(job_id, None)
+
+@socketio.on('execute_fleet_command')
+def handle_execute_fleet_command(data):
+    """批量执行：{ command, uuids? | tag? | all?, use_shared_context?, concurrency?, timeout?, queue_if_offline?, ttl?, dedup_key? }"""
+    try:
+        command = data.get('command')
+        if not command:
+            emit('error', {'message': '缺少命令'})
+            return
+        targets = _select_fleet_targets(data)
+        if not targets:
+            emit('error', {'message': '没有匹配的目标客户端'})
+            return
+        concurrency = int(data.get('concurrency') or FLEET_DEFAULT_CONCURRENCY)
+        job_id = secrets.token_hex(8)
+        fleet_jobs[job_id] = {
+            'job_id': job_id,
+            'command': command,
+            'use_shared_context': data.get('use_shared_context', True),
+            'requester_sid': request.sid,
+            'concurrency': max(1, min(concurrency, FLEET_MAX_CONCURRENCY)),
+            'timeout': int(data.get('timeout') or FLEET_DEFAULT_TIMEOUT),
+            # 离线目标排队时的 ttl / dedup_key；None 表示离线目标直接记为 offline
+            'offline_options': {'ttl': data.get('ttl'), 'dedup_key': data.get('dedup_key')}
+                               if data.get('queue_if_offline') else None,
+            'total': len(targets),
+            'queue': deque(targets),
+            'inflight': {},  # {request_id: (uuid, started_at)}
+            'results': {},  # {uuid: {uuid, status, latency_ms, output, error}}
+            'unsent': [],
+            'created_at': time.time(),
+            'last_progress': 0.0,
+            'flush_scheduled': False,
+            'pumping': False,  # 正在派发，防止同步完成的目标重入
+            'finished': False,
+        }
+        logger.info(f'批量任务 {job_id}: {len(targets)} 台客户端, 命令: {command}')
+        emit('fleet_job_started', {
+            'job_id': job_id,
+            'command': command,
+            'total': len(targets),
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        })
+        _pump_fleet_job(job_id)
+    except Exception as e:
+        logger.error(f'批量执行失败: {e}')
+        emit('error', {'message': f'批量执行失败: {str(e)}'})
+
+@socketio.on('get_fleet_job')
+def handle_get_fleet_job(data):
+    """获取批量任务的完整记录（汇总与每台客户端结果）"""
+    job = fleet_jobs.get((data or {}).get('job_id'))
+    if not job:
+        emit('error', {'message': '任务不存在或已过期'})
+        return
+    emit('fleet_job', {**_fleet_summary(job), 'results': list(job['results'].values())})
+
+def schedule_client_list_update(client_uuid):
+    """记录某客户端的列表变化，在合并窗口结束后统一推送增量（O(1)，避免每次事件重建完整列表）"""
+    global _client_list_flush_scheduled
+    _client_list_dirty.add(client_uuid)
+    if not _client_list_flush_scheduled:
+        _client_list_flush_scheduled = True
+        socketio.start_background_task(_flush_client_list_update)
+
+def _flush_client_list_update():
+    """合并窗口内的变化计算为 added/removed/changed 增量，以递增序号推送给所有Web客户端"""
+    global _client_list_flush_scheduled
+    socketio.sleep(CLIENT_LIST_DEBOUNCE)
+    _client_list_flush_scheduled = False
+    dirty = list(_client_list_dirty)
+    _client_list_dirty.clear()
+    added, removed, changed = [], [], []
+    for uuid in dirty:
+        entry = _client_entry(uuid)
+        if entry and uuid not in _client_list_published:
+            added.append(entry)
+            _client_list_published.add(uuid)
+        elif entry:
+            changed.append(entry)
+        elif uuid in _client_list_published:
+            removed.append(uuid)
+            _client_list_published.discard(uuid)
+    if not (added or removed or changed):
+        return
     try:
-        socketio.emit('client_list_update', {
-            'clients': get_client_list()
+        seq = agent_registry.next_seq()
+        socketio.emit('client_list_delta', {
+            'seq': seq,
+            'base_seq': seq - 1,
+            'added': added,
+            'removed': removed,
+            'changed': changed,
         }, room='web_clients')
-        logger.info('已推送客户端列表更新')
+        logger.info(f'已推送客户端列表增量 #{seq}: +{len(added)} -{len(removed)} ~{len(changed)}')
     except Exception as e:
         logger.error(f'推送客户端列表更新失败: {e}')
 
@@ -527,6 +2960,7 @@ if __name__ == '__main__':
         os.makedirs(DOWNLOAD_DIR, exist_ok=True)
     except Exception as e:
         logger.error(f'创建下载目录失败: {e}')
+    _ensure_download_sweeper()  # 启动时先淘汰一次，之后定期执行
     
     logger.info(f'启动服务器: {host}:{port} (Debug: {debug})')
-    socketio.run(app, host=host, port=port, debug=debug)
+    socketio.run(app, host=host, port=port, debug=debug, max_size=MAX_CONNECTIONS)
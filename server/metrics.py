@@ -0,0 +1,147 @@
+"""运行指标（Prometheus 文本格式）
+
+计数器、直方图按标签值元组保存为普通 dict/list，由 eventlet 协程在同一线程内更新（协程只在 IO 处切换），
+更新时无需加锁；直方图只累加命中的那个桶，导出时才计算累计值，记录一次观测的开销是一次二分查找和几次加法。
+仪表可以直接 set，也可以注册为回调，在导出时读取当前值。
+"""
+from bisect import bisect_left
+from itertools import islice
+
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROUNDTRIP_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+PAYLOAD_SAMPLE_ITEMS = 8  # 估算载荷大小时每个容器最多查看的元素数，其余按抽样的平均大小推算
+PAYLOAD_SAMPLE_DEPTH = 5  # 展开的容器层数（足以覆盖 run_batch 的 参数 → 载荷 → items → 条目 → data），更深的按 8 字节计
+
+
+def payload_size(value, depth=PAYLOAD_SAMPLE_DEPTH):
+    """估算事件载荷的字节数（在每个事件的收发路径上调用，不做完整序列化也不遍历整个载荷）：
+    字符串与二进制附件直接取长度；容器只展开有限层数，元素较多时抽样前几个按比例推算；其余标量按 8 字节计"""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, memoryview):
+        return value.nbytes
+    if not depth or not isinstance(value, (dict, list, tuple)):
+        return 8
+    count = len(value)
+    sampled = count > PAYLOAD_SAMPLE_ITEMS
+    if isinstance(value, dict):
+        items = islice(value.items(), PAYLOAD_SAMPLE_ITEMS) if sampled else value.items()
+        total = sum(len(key) + payload_size(item, depth - 1) for key, item in items)
+    else:
+        items = islice(value, PAYLOAD_SAMPLE_ITEMS) if sampled else value
+        total = sum(payload_size(item, depth - 1) for item in items)
+    return total * count // PAYLOAD_SAMPLE_ITEMS if sampled else total
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def remove(self, *labels):
+        self._values.pop(labels, None)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        return [f'{self.name}{_labels(self.labelnames, labels)} {value}' for labels, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function  # 导出时调用：无标签时返回数值，有标签时返回 {标签值元组: 数值}
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def _samples(self):
+        if self._function is not None:
+            value = self._function()
+            self._values = value if self.labelnames else {(): value}
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            # [各桶（非累计）计数..., +Inf 桶, 总和]
+            state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def _samples(self):
+        lines = []
+        for labels, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state):
+                cumulative += count
+                bucket = _labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{bucket} {cumulative}')
+            base = _labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{base} {state[-1]}')
+            lines.append(f'{self.name}_count{base} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._add(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """导出全部指标（Prometheus 文本格式 0.0.4）"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,121 @@
+"""离线请求队列（SQLite）
+
+目标客户端未连接时，控制台可以选择把命令与文件操作排队：按客户端保存，带过期时间与可选的去重键
+（同一客户端同一去重键只保留一条未下发的请求）。客户端重连后按入队顺序取出下发，取出即删除（至多下发一次）。
+文件与 history.db 一样可被同一主机上的多个 worker 共享；取出在写事务中完成，同一条请求只会被一个 worker 取到。
+"""
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+
+
+class OfflineQueue:
+    _COLUMNS = ('id, uuid, request_id, event, payload, size, requester_sid, codec, dedup_key, '
+                'created_at, expires_at')
+
+    def __init__(self, path, max_per_client=10000):
+        self.max_per_client = max_per_client
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS offline_queue '
+                         '(id INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT NOT NULL, request_id TEXT NOT NULL, '
+                         'event TEXT NOT NULL, payload TEXT NOT NULL, size INTEGER NOT NULL, requester_sid TEXT, '
+                         'codec TEXT, dedup_key TEXT, created_at REAL NOT NULL, expires_at REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS offline_queue_uuid ON offline_queue (uuid, id)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS offline_queue_expiry ON offline_queue (expires_at)')
+        self._db.execute('CREATE UNIQUE INDEX IF NOT EXISTS offline_queue_dedup ON offline_queue (uuid, dedup_key) '
+                         'WHERE dedup_key IS NOT NULL')
+
+    @staticmethod
+    def _job(row):
+        return {'id': row[0], 'uuid': row[1], 'request_id': row[2], 'event': row[3], 'payload': json.loads(row[4]),
+                'size': row[5], 'requester_sid': row[6], 'codec': row[7], 'dedup_key': row[8],
+                'created_at': row[9], 'expires_at': row[10]}
+
+    def enqueue(self, uuid, request_id, event, payload, ttl, requester_sid=None, codec=None, dedup_key=None):
+        """入队一条请求，返回 (记录, 是否与已排队的请求重复)；重复时返回已有记录，不再入队
+        该客户端的排队数已达上限时抛出 OverflowError"""
+        now = time.time()
+        body = json.dumps(payload, ensure_ascii=False)
+        with self._transaction():
+            if dedup_key is not None:
+                row = self._db.execute(f'SELECT {self._COLUMNS} FROM offline_queue '
+                                       'WHERE uuid = ? AND dedup_key = ? AND expires_at > ?',
+                                       (uuid, dedup_key, now)).fetchone()
+                if row:
+                    return self._job(row), True
+                # 已过期但尚未清理的同键记录让位给新请求
+                self._db.execute('DELETE FROM offline_queue WHERE uuid = ? AND dedup_key = ?', (uuid, dedup_key))
+            if self.count(uuid) >= self.max_per_client:
+                raise OverflowError(f'客户端 {uuid} 的离线队列已有 {self.max_per_client} 条请求')
+            cur = self._db.execute(
+                'INSERT INTO offline_queue (uuid, request_id, event, payload, size, requester_sid, codec, dedup_key, '
+                'created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (uuid, request_id, event, body, len(body), requester_sid, codec, dedup_key, now, now + ttl))
+            row = self._db.execute(f'SELECT {self._COLUMNS} FROM offline_queue WHERE id = ?',
+                                   (cur.lastrowid,)).fetchone()
+        return self._job(row), False
+
+    def take(self, uuid, limit, max_bytes):
+        """按入队顺序取出并删除至多 limit 条未过期的请求，载荷累计不超过 max_bytes（至少取一条）"""
+        with self._transaction():
+            rows = self._db.execute(f'SELECT {self._COLUMNS} FROM offline_queue WHERE uuid = ? AND expires_at > ? '
+                                    'ORDER BY id LIMIT ?', (uuid, time.time(), limit)).fetchall()
+            taken, total = [], 0
+            for row in rows:
+                if taken and total + row[5] > max_bytes:
+                    break
+                taken.append(row)
+                total += row[5]
+            if taken:
+                self._db.execute(f'DELETE FROM offline_queue WHERE id IN ({",".join("?" * len(taken))})',
+                                 [row[0] for row in taken])
+        return [self._job(row) for row in taken]
+
+    def expire(self, limit=1000):
+        """取出并删除已过期的请求（用于通知发起者）"""
+        with self._transaction():
+            rows = self._db.execute(f'SELECT {self._COLUMNS} FROM offline_queue WHERE expires_at <= ? '
+                                    'ORDER BY id LIMIT ?', (time.time(), limit)).fetchall()
+            if rows:
+                self._db.execute(f'DELETE FROM offline_queue WHERE id IN ({",".join("?" * len(rows))})',
+                                 [row[0] for row in rows])
+        return [self._job(row) for row in rows]
+
+    def cancel(self, request_id):
+        """取消一条尚未下发的请求，返回被删除的记录或 None"""
+        with self._transaction():
+            row = self._db.execute(f'SELECT {self._COLUMNS} FROM offline_queue WHERE request_id = ?',
+                                   (request_id,)).fetchone()
+            if row:
+                self._db.execute('DELETE FROM offline_queue WHERE id = ?', (row[0],))
+        return self._job(row) if row else None
+
+    def list(self, uuid, limit=100):
+        """某客户端排队中的请求（按入队顺序），返回 (记录, 总条数)；记录不含载荷中的文件内容"""
+        rows = self._db.execute(f'SELECT {self._COLUMNS} FROM offline_queue WHERE uuid = ? AND expires_at > ? '
+                                'ORDER BY id LIMIT ?', (uuid, time.time(), limit)).fetchall()
+        jobs = []
+        for row in rows:
+            job = self._job(row)
+            job['payload'].pop('file_data', None)
+            jobs.append(job)
+        return jobs, self.count(uuid)
+
+    def count(self, uuid=None):
+        if uuid:
+            return self._db.execute('SELECT COUNT(*) FROM offline_queue WHERE uuid = ?', (uuid,)).fetchone()[0]
+        return self._db.execute('SELECT COUNT(*) FROM offline_queue').fetchone()[0]
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT：读取与删除之间不会被其他 worker 插入写操作"""
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
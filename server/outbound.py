@@ -0,0 +1,115 @@
+"""发往客户端的出站调度：每个连接按优先级（控制 > 命令 > 批量传输）排队，并限制每类的排队条数与字节数
+
+没有排队的消息且底层传输（engine.io 的发送队列）已空时直接发送，不增加延迟；否则按优先级入队，
+由该连接的发送协程在传输队列排空后逐条发出，高优先级的消息总是先于已排队的低优先级消息。
+已交给传输层的消息不可抢占，所以至多等待正在写出的那一条：批量数据应分块发送（分块上传每块 256KB）。
+同一优先级内保持先后顺序，不同优先级之间不保证。
+"""
+import time
+from collections import deque
+
+CONTROL, COMMAND, BULK = 0, 1, 2
+PRIORITY_NAMES = ('control', 'command', 'bulk')
+
+
+class QueueFull(Exception):
+    """该优先级的排队条数或字节数已达上限"""
+
+    def __init__(self, priority, queued, queued_bytes):
+        super().__init__(f'{PRIORITY_NAMES[priority]} 队列已有 {queued} 条 / {queued_bytes} 字节')
+        self.priority = priority
+        self.queued = queued
+        self.queued_bytes = queued_bytes
+
+
+class _Outbox:
+    __slots__ = ('queues', 'queued_bytes')
+
+    def __init__(self):
+        self.queues = (deque(), deque(), deque())  # 每项为 (event, payload, size, enqueued_at)
+        self.queued_bytes = [0, 0, 0]
+
+
+class OutboundScheduler:
+    def __init__(self, send, backlog, spawn, sleep, max_messages, max_bytes, on_sent=None, on_dropped=None,
+                 poll_interval=0.005):
+        self._send = send  # send(sid, event, payload)
+        self._backlog = backlog  # backlog(sid)：传输层尚未写出的包数，未知时返回 None（视为空闲）
+        self._spawn = spawn
+        self._sleep = sleep
+        self.max_messages = max_messages  # 每个优先级的排队条数上限
+        self.max_bytes = tuple(max_bytes)  # 各优先级的排队字节数上限
+        self._on_sent = on_sent  # on_sent(priority, waited_seconds)：排队的消息发出时调用
+        self._on_dropped = on_dropped  # on_dropped(sid, [(priority, event, payload)], error)：发送协程出错时未发出的消息
+        self.poll_interval = poll_interval
+        self._outboxes = {}  # {sid: _Outbox} 仅有排队消息的连接
+
+    def submit(self, sid, priority, event, payload, size, force=False):
+        """发送或排队一条消息；超过上限时抛出 QueueFull
+        该优先级队列为空时总是接受（单条超过字节上限的消息也能发出）；force=True 用于已由确认窗口限流的分块"""
+        outbox = self._outboxes.get(sid)
+        if outbox is None:
+            if not self._backlog(sid):
+                self._send(sid, event, payload)
+                return
+            outbox = self._outboxes[sid] = _Outbox()
+            outbox.queues[priority].append((event, payload, size, time.time()))
+            outbox.queued_bytes[priority] = size
+            self._spawn(self._pump, sid, outbox)
+            return
+        queue = outbox.queues[priority]
+        queued_bytes = outbox.queued_bytes[priority]
+        if queue and not force and (len(queue) >= self.max_messages or queued_bytes + size > self.max_bytes[priority]):
+            raise QueueFull(priority, len(queue), queued_bytes)
+        queue.append((event, payload, size, time.time()))
+        outbox.queued_bytes[priority] = queued_bytes + size
+
+    def discard(self, sid):
+        """连接断开：丢弃其排队的消息，返回 [(priority, event, payload)]"""
+        outbox = self._outboxes.pop(sid, None)
+        if outbox is None:
+            return []
+        return [(priority, event, payload) for priority, queue in enumerate(outbox.queues)
+                for event, payload, _, _ in queue]
+
+    def stats(self):
+        """各优先级的排队总条数与字节数：([条数...], [字节数...])"""
+        counts, sizes = [0, 0, 0], [0, 0, 0]
+        for outbox in self._outboxes.values():
+            for priority, queue in enumerate(outbox.queues):
+                counts[priority] += len(queue)
+                sizes[priority] += outbox.queued_bytes[priority]
+        return counts, sizes
+
+    def _pump(self, sid, outbox):
+        """连接的发送协程：传输队列排空后发出优先级最高的一条，队列全部发完后退出
+        发送出错时，出错的一条与其余排队的消息一并交给 on_dropped（由调用方结束对应的请求），不会静默丢弃"""
+        try:
+            while self._outboxes.get(sid) is outbox:
+                if self._backlog(sid):
+                    self._sleep(self.poll_interval)
+                    continue
+                priority = next((p for p, queue in enumerate(outbox.queues) if queue), None)
+                if priority is None:
+                    break
+                item = outbox.queues[priority].popleft()
+                event, payload, size, enqueued_at = item
+                outbox.queued_bytes[priority] -= size
+                try:
+                    self._send(sid, event, payload)
+                except Exception:
+                    outbox.queues[priority].appendleft(item)
+                    outbox.queued_bytes[priority] += size
+                    raise
+                if self._on_sent:
+                    self._on_sent(priority, time.time() - enqueued_at)
+                self._sleep(0)
+        except Exception as e:
+            if self._outboxes.get(sid) is outbox:
+                dropped = self.discard(sid)
+                if self._on_dropped:
+                    self._on_dropped(sid, dropped, e)
+        finally:
+            # 队列发完或发送出错时退出；之后的消息重新走直接发送的路径
+            if self._outboxes.get(sid) is outbox:
+                del self._outboxes[sid]
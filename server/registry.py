@@ -0,0 +1,236 @@
+"""客户端注册表后端（可插拔）
+
+单进程部署使用进程内注册表；多进程/多节点部署时注册表放在共享后端中，
+各 worker 通过它查找客户端所在的 worker，并借助其中的信箱互相转发请求。
+
+条目格式：{uuid: {sid, worker, info: {connect_time, ip, tags}}}
+"""
+import json
+import sqlite3
+import time
+
+
+def create_registry(url):
+    """按 URL 创建注册表：memory（默认）、sqlite:///path/to.db、redis://host:port/db"""
+    if not url or url == 'memory':
+        return LocalAgentRegistry()
+    if url.startswith('sqlite:///'):
+        return SqliteAgentRegistry(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisAgentRegistry(url)
+    raise ValueError(f'不支持的注册表后端: {url}')
+
+
+class LocalAgentRegistry:
+    """进程内注册表（默认，单进程部署；也用于测试）"""
+    shared = False
+
+    def __init__(self):
+        self._agents = {}
+        self._seq = 0
+
+    def register(self, uuid, sid, worker, info):
+        self._agents[uuid] = {'sid': sid, 'worker': worker, 'info': info}
+
+    def unregister(self, uuid, sid):
+        """仅当注册表仍指向该 sid 时才移除，避免覆盖新连接"""
+        entry = self._agents.get(uuid)
+        if entry and entry['sid'] == sid:
+            del self._agents[uuid]
+            return True
+        return False
+
+    def get_entry(self, uuid):
+        return self._agents.get(uuid)
+
+    def get(self, uuid, default=None):
+        """返回客户端当前的 sid"""
+        entry = self._agents.get(uuid)
+        return entry['sid'] if entry else default
+
+    def uuids(self):
+        return list(self._agents)
+
+    def entries(self):
+        return list(self._agents.items())
+
+    def next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    def current_seq(self):
+        return self._seq
+
+    def publish(self, worker, message):
+        raise RuntimeError('进程内注册表不支持跨 worker 转发')
+
+    def poll(self, worker, timeout):
+        return []
+
+    def heartbeat(self, worker):
+        pass
+
+    def purge_dead_workers(self, max_age):
+        return []
+
+
+class SqliteAgentRegistry:
+    """SQLite 共享注册表：同一主机上的多个 worker 共用一个数据库文件"""
+    shared = True
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS agents '
+                         '(uuid TEXT PRIMARY KEY, sid TEXT NOT NULL, worker TEXT NOT NULL, info TEXT NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS mailbox '
+                         '(id INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT NOT NULL, message TEXT NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS mailbox_worker ON mailbox (worker, id)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, last_seen REAL NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('client_list_seq', 0)")
+
+    @staticmethod
+    def _entry(row):
+        return {'sid': row[0], 'worker': row[1], 'info': json.loads(row[2])}
+
+    def register(self, uuid, sid, worker, info):
+        self._db.execute('INSERT OR REPLACE INTO agents (uuid, sid, worker, info) VALUES (?, ?, ?, ?)',
+                         (uuid, sid, worker, json.dumps(info)))
+
+    def unregister(self, uuid, sid):
+        cur = self._db.execute('DELETE FROM agents WHERE uuid = ? AND sid = ?', (uuid, sid))
+        return cur.rowcount > 0
+
+    def get_entry(self, uuid):
+        row = self._db.execute('SELECT sid, worker, info FROM agents WHERE uuid = ?', (uuid,)).fetchone()
+        return self._entry(row) if row else None
+
+    def get(self, uuid, default=None):
+        row = self._db.execute('SELECT sid FROM agents WHERE uuid = ?', (uuid,)).fetchone()
+        return row[0] if row else default
+
+    def uuids(self):
+        return [row[0] for row in self._db.execute('SELECT uuid FROM agents')]
+
+    def entries(self):
+        return [(row[0], self._entry(row[1:]))
+                for row in self._db.execute('SELECT uuid, sid, worker, info FROM agents')]
+
+    def next_seq(self):
+        row = self._db.execute("UPDATE meta SET value = value + 1 WHERE key = 'client_list_seq' "
+                               "RETURNING value").fetchone()
+        return row[0]
+
+    def current_seq(self):
+        return self._db.execute("SELECT value FROM meta WHERE key = 'client_list_seq'").fetchone()[0]
+
+    def publish(self, worker, message):
+        self._db.execute('INSERT INTO mailbox (worker, message) VALUES (?, ?)', (worker, json.dumps(message)))
+
+    def poll(self, worker, timeout):
+        """取出并删除该 worker 信箱中的全部消息（无消息时立即返回，由调用方控制轮询间隔）"""
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._db.execute('SELECT id, message FROM mailbox WHERE worker = ? ORDER BY id',
+                                    (worker,)).fetchall()
+            if rows:
+                self._db.execute('DELETE FROM mailbox WHERE worker = ? AND id <= ?', (worker, rows[-1][0]))
+            self._db.execute('COMMIT')
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        return [json.loads(row[1]) for row in rows]
+
+    def heartbeat(self, worker):
+        self._db.execute('INSERT OR REPLACE INTO workers (worker, last_seen) VALUES (?, ?)', (worker, time.time()))
+
+    def purge_dead_workers(self, max_age):
+        """清理超过 max_age 秒未心跳的 worker 及其客户端条目，返回被清理的 worker 列表"""
+        cutoff = time.time() - max_age
+        dead = [row[0] for row in self._db.execute('SELECT worker FROM workers WHERE last_seen < ?', (cutoff,))]
+        for worker in dead:
+            self._db.execute('DELETE FROM agents WHERE worker = ?', (worker,))
+            self._db.execute('DELETE FROM mailbox WHERE worker = ?', (worker,))
+            self._db.execute('DELETE FROM workers WHERE worker = ?', (worker,))
+        return dead
+
+
+class RedisAgentRegistry:
+    """Redis 共享注册表：多节点部署（可选依赖：pip install redis）"""
+    shared = True
+    _AGENTS = 'rc:agents'
+    _WORKERS = 'rc:workers'
+    _SEQ = 'rc:client_list_seq'
+    _MAILBOX = 'rc:mailbox:'
+    # 比较后删除，保证只移除仍指向该 sid 的条目
+    _UNREGISTER_LUA = """
+    local raw = redis.call('HGET', KEYS[1], ARGV[1])
+    if raw and cjson.decode(raw)['sid'] == ARGV[2] then
+        return redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url):
+        import redis
+        self._r = redis.Redis.from_url(url, decode_responses=True)
+        self._unregister = self._r.register_script(self._UNREGISTER_LUA)
+
+    def register(self, uuid, sid, worker, info):
+        self._r.hset(self._AGENTS, uuid, json.dumps({'sid': sid, 'worker': worker, 'info': info}))
+
+    def unregister(self, uuid, sid):
+        return bool(self._unregister(keys=[self._AGENTS], args=[uuid, sid]))
+
+    def get_entry(self, uuid):
+        raw = self._r.hget(self._AGENTS, uuid)
+        return json.loads(raw) if raw else None
+
+    def get(self, uuid, default=None):
+        entry = self.get_entry(uuid)
+        return entry['sid'] if entry else default
+
+    def uuids(self):
+        return self._r.hkeys(self._AGENTS)
+
+    def entries(self):
+        return [(uuid, json.loads(raw)) for uuid, raw in self._r.hgetall(self._AGENTS).items()]
+
+    def next_seq(self):
+        return self._r.incr(self._SEQ)
+
+    def current_seq(self):
+        return int(self._r.get(self._SEQ) or 0)
+
+    def publish(self, worker, message):
+        self._r.rpush(self._MAILBOX + worker, json.dumps(message))
+
+    def poll(self, worker, timeout):
+        """阻塞等待最多 timeout 秒，取出该 worker 信箱中的消息"""
+        first = self._r.blpop(self._MAILBOX + worker, timeout=max(1, int(timeout)))
+        if not first:
+            return []
+        messages = [first[1]]
+        while True:
+            raw = self._r.lpop(self._MAILBOX + worker)
+            if raw is None:
+                break
+            messages.append(raw)
+        return [json.loads(raw) for raw in messages]
+
+    def heartbeat(self, worker):
+        self._r.hset(self._WORKERS, worker, time.time())
+
+    def purge_dead_workers(self, max_age):
+        cutoff = time.time() - max_age
+        dead = [w for w, seen in self._r.hgetall(self._WORKERS).items() if float(seen) < cutoff]
+        if not dead:
+            return []
+        for uuid, raw in self._r.hgetall(self._AGENTS).items():
+            if json.loads(raw)['worker'] in dead:
+                self._r.hdel(self._AGENTS, uuid)
+        for worker in dead:
+            self._r.delete(self._MAILBOX + worker)
+            self._r.hdel(self._WORKERS, worker)
+        return dead
@@ -0,0 +1,124 @@
+"""命令输出清理
+
+去掉客户端共享会话追加的结束标记行（__RC_END__:<token>）与 PowerShell 提示符行（PS C:\\path>），
+并把 \\r\\n 统一为 \\n。
+
+实现上不按行拆分成列表：用 str.find 只定位以候选前缀开头的行（其余行不经过 Python 层），
+把它们之间的保留区段切片后一次 join；不含候选行时原样返回，不产生拷贝。
+OutputSanitizer 用于流式分块，跨分块边界保留未结束的行尾。
+"""
+
+_RC_END = '__RC_END__:'
+_PS_PREFIX = 'PS '
+_RC_NEEDLE = '\n' + _RC_END
+_PS_NEEDLE = '\n' + _PS_PREFIX
+
+# 未结束的行超过该长度且仍可能是提示符行时不再等待，直接透传（提示符行不会这么长）
+MAX_PENDING_LINE = 64 * 1024
+
+
+def _line_start(text, prefix, needle, pos):
+    """返回 pos 及之后第一个以 prefix 开头的行首位置，pos 必须是行首；找不到返回 -1"""
+    if pos == 0:
+        if text.startswith(prefix):
+            return 0
+        pos = 1
+    i = text.find(needle, pos - 1)
+    return i + 1 if i >= 0 else -1
+
+
+def _drop_marker_lines(text):
+    """删除结束标记行，以及以 "PS " 开头且以 ">" 结尾的提示符行（连同行尾换行）"""
+    n = len(text)
+    pieces = []
+    kept = 0
+    rc = _line_start(text, _RC_END, _RC_NEEDLE, 0)
+    ps = _line_start(text, _PS_PREFIX, _PS_NEEDLE, 0)
+    while rc >= 0 or ps >= 0:
+        is_rc = ps < 0 or 0 <= rc < ps
+        start = rc if is_rc else ps
+        nl = text.find('\n', start)
+        line_end = n if nl < 0 else nl
+        end = n if nl < 0 else nl + 1
+        if is_rc or text[line_end - 1] == '>':
+            pieces.append(text[kept:start])
+            kept = end
+        if end >= n:
+            break
+        if is_rc:
+            rc = _line_start(text, _RC_END, _RC_NEEDLE, end)
+        else:
+            ps = _line_start(text, _PS_PREFIX, _PS_NEEDLE, end)
+    if not pieces:
+        return text
+    pieces.append(text[kept:])
+    return ''.join(pieces)
+
+
+def _filter_lines(text):
+    if '\r' in text:
+        text = text.replace('\r\n', '\n')
+    return _drop_marker_lines(text)
+
+
+def sanitize_output_text(text):
+    """一次性清理完整输出（结果首尾空白会被去掉）"""
+    if not text:
+        return text
+    return _filter_lines(text).strip()
+
+
+def _may_be_marker(line_head):
+    """未结束的行首是否可能发展成需要删除的行"""
+    if line_head.startswith((_RC_END, _PS_PREFIX)):
+        return True
+    return _RC_END.startswith(line_head) or _PS_PREFIX.startswith(line_head)
+
+
+class OutputSanitizer:
+    """流式清理：feed() 返回可以立即输出的部分，finish() 返回剩余内容；不 strip，拼接结果保持原有换行"""
+    __slots__ = ('_partial', '_passthrough')
+
+    def __init__(self):
+        self._partial = ''         # 尚未结束、且可能需要删除的行首
+        self._passthrough = False  # 当前行已确定保留，直到下一个换行前直接透传
+
+    def feed(self, chunk):
+        if not chunk:
+            return ''
+        if self._partial:
+            chunk = self._partial + chunk
+            self._partial = ''
+        head = ''
+        if self._passthrough:
+            nl = chunk.find('\n')
+            if nl < 0:
+                if chunk.endswith('\r'):
+                    self._partial = '\r'
+                    return chunk[:-1]
+                return chunk
+            head, chunk = chunk[:nl + 1], chunk[nl + 1:]
+            self._passthrough = False
+            if head.endswith('\r\n'):
+                head = head[:-2] + '\n'
+        nl = chunk.rfind('\n')
+        if nl < 0:
+            body, tail = '', chunk
+        else:
+            body, tail = chunk[:nl + 1], chunk[nl + 1:]
+        if tail:
+            if _may_be_marker(tail) and len(tail) <= MAX_PENDING_LINE:
+                self._partial = tail
+                tail = ''
+            else:
+                self._passthrough = True
+                # 行尾的 \r 可能是被分块截断的 \r\n，留到下次判断（passthrough 分支中同理）
+                if tail.endswith('\r'):
+                    self._partial = '\r'
+                    tail = tail[:-1]
+        return head + _filter_lines(body) + tail if body else head + tail
+
+    def finish(self):
+        rest, self._partial = self._partial, ''
+        self._passthrough = False
+        return _filter_lines(rest) if rest else ''